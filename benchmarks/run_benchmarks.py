@@ -0,0 +1,263 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+# Permite importar los módulos de src/
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+sys.path.append(SRC_DIR)
+
+from config_reader import load_config
+
+# Archivo de referencia con los resultados esperados de cada conjunto de datos
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Métricas comparadas con la referencia: True si un valor mayor es una regresión
+METRICS = {
+    "total_time": True,
+    "peak_rss": True,
+    "pairs_evaluated": True,
+    "mean_fitness": False
+}
+
+def find_datasets(data_dir=DATA_DIR):
+    """
+    Busca los conjuntos de datos incluidos: cada subcarpeta de data/ con archivos .pcd.
+
+    Parámetros:
+        data_dir (str): Carpeta de datos.
+
+    Devuelve:
+        list: Nombres de los conjuntos de datos, ordenados.
+    """
+    datasets = []
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if os.path.isdir(path) and any(f.endswith(".pcd") for f in os.listdir(path)):
+            datasets.append(name)
+    return datasets
+
+def write_dataset_config(dataset, work_dir, base_config_file, overrides=None):
+    """
+    Escribe un archivo de configuración para ejecutar el procesamiento sobre un conjunto de datos sin ventanas.
+
+    Parámetros:
+        dataset (str): Nombre del conjunto de datos.
+        work_dir (str): Carpeta temporal de la ejecución (salida y caché).
+        base_config_file (str): Archivo de configuración del que se toman los parámetros.
+        overrides (dict): Parámetros que reemplazan a los del archivo base.
+
+    Devuelve:
+        str: Ruta del archivo de configuración escrito.
+    """
+    config_params = load_config(base_config_file)
+    config_params.update({
+        "show_result": False,
+        "cache_dir": os.path.join(work_dir, "cache"),
+        "profile_output": ""
+    })
+    config_params.update(overrides or {})
+
+    config_file = os.path.join(work_dir, "config.json")
+    with open(config_file, 'w') as f:
+        json.dump({
+            "input_path": os.path.join(DATA_DIR, dataset),
+            "config_params": config_params,
+            "output_file": os.path.join(work_dir, "output.pcd")
+        }, f, indent=4)
+    return config_file
+
+def run_pipeline(dataset, base_config_file, overrides=None):
+    """
+    Ejecuta main.py sobre un conjunto de datos en un proceso aparte y resume su traza de perfilado.
+
+    Parámetros:
+        dataset (str): Nombre del conjunto de datos.
+        base_config_file (str): Archivo de configuración del que se toman los parámetros.
+        overrides (dict): Parámetros que reemplazan a los del archivo base.
+
+    Devuelve:
+        dict: Tiempo total, pico de memoria, pares evaluados, fitness promedio y tiempos por etapa.
+    """
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_file = write_dataset_config(dataset, work_dir, base_config_file, overrides)
+        trace_file = os.path.join(work_dir, "trace.json")
+
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, "main.py", config_file], cwd=SRC_DIR,
+                                   env=dict(os.environ, PCG_PROFILE=trace_file),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        total_time = time.perf_counter() - start
+
+        if completed.returncode != 0 or not os.path.exists(trace_file):
+            print(f"Error: falló el procesamiento de '{dataset}':\n{completed.stderr}")
+            return None
+
+        with open(trace_file, 'r') as f:
+            trace = json.load(f)
+
+    stages = {stage["name"]: stage for stage in trace["stages"]}
+    fitness = [pair["fitness"] for pair in trace["pairs"]]
+    # Pico de toda la ejecución, incluidos los procesos de registro en paralelo
+    peak = [stage["process_peak_rss"] for stage in trace["stages"] if stage["process_peak_rss"] is not None]
+    return {
+        "total_time": total_time,
+        "peak_rss": max(peak) if peak else None,
+        "pairs_evaluated": len(trace["pairs"]),
+        "mean_fitness": float(np.mean(fitness)) if fitness else None,
+        "stages": {name: stage["wall_time"] for name, stage in stages.items()}
+    }
+
+def run_stages(dataset, base_config_file, repeat=1):
+    """
+    Mide cada etapa por separado sobre un conjunto de datos, dentro de este proceso.
+
+    Cada etapa se ejecuta repeat veces sobre la misma entrada y se reporta el
+    menor tiempo; el registro se mide sin almacén de resultados, con los mismos
+    parámetros de registro y de grafo de poses que la ejecución completa, y la
+    optimización se aplica cada vez sobre una copia del grafo sin optimizar.
+
+    Parámetros:
+        dataset (str): Nombre del conjunto de datos.
+        base_config_file (str): Archivo de configuración del que se toman los parámetros.
+        repeat (int): Cantidad de repeticiones por etapa.
+
+    Devuelve:
+        dict: Menor tiempo de cada etapa, en segundos.
+    """
+    from pc_reader import load_point_clouds
+    from pc_preprocessing import pc_preprocessing
+    from prepared_cloud import prepare_clouds
+    from pc_comparator import check_all_pc_combinability
+    from pc_full_registration import full_registration
+    from pc_stacking import resolve_registration_params
+    from pose_graph_optimization import optimize_pose_graph
+    from pc_writer import write_combined_pcd
+
+    def best_time(function, setup=None):
+        # setup prepara fuera de la medición la entrada de cada repetición
+        times = []
+        for _ in range(repeat):
+            args = (setup(),) if setup is not None else ()
+            start = time.perf_counter()
+            result = function(*args)
+            times.append(time.perf_counter() - start)
+        return min(times), result
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config_file = write_dataset_config(dataset, work_dir, base_config_file)
+        config_params = load_config(config_file)
+        voxel_size = config_params.get("voxel_size")
+        distance_coarse = voxel_size * 15
+        distance_fine = voxel_size * 1.5
+        registration_params = resolve_registration_params(config_params.get("registration_params"), voxel_size)
+
+        times = {}
+        times["load"], pcds = best_time(lambda: load_point_clouds(config_file))
+        times["preprocessing"], preprocessed = best_time(
+            lambda: pc_preprocessing(pcds, voxel_size, config_params.get("remove_outliers_params")))
+        times["prepare"], prepared = best_time(lambda: prepare_clouds(preprocessed, voxel_size))
+        times["combinability"], combinable = best_time(
+            lambda: check_all_pc_combinability(prepared, config_params.get("combinability_threshold"),
+                                               combinability_params=config_params.get("combinability_params")))
+        if len(combinable) < 2:
+            return times
+        times["registration"], pose_graph = best_time(
+            lambda: full_registration(combinable, distance_coarse, distance_fine,
+                                      num_workers=config_params.get("num_workers"),
+                                      parallel_min_clouds=config_params.get("parallel_min_clouds"),
+                                      registration_params=registration_params,
+                                      pose_graph_params=config_params.get("pose_graph_params")))
+        times["pose_graph_optimization"], pose_graph = best_time(
+            lambda graph: optimize_pose_graph(graph, distance_fine), setup=lambda: copy.deepcopy(pose_graph))
+        times["write"], _ = best_time(
+            lambda: write_combined_pcd(combinable, pose_graph, config_file, visualize=False))
+    return times
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    Compara los resultados con la referencia y devuelve las regresiones encontradas.
+
+    Parámetros:
+        results (dict): Resultados por conjunto de datos.
+        baseline (dict): Resultados de referencia por conjunto de datos.
+        tolerance (float): Variación relativa permitida antes de marcar una regresión.
+
+    Devuelve:
+        list: Descripción de cada regresión.
+    """
+    regressions = []
+    for dataset, metrics in results.items():
+        reference = baseline.get(dataset)
+        if reference is None:
+            continue
+        for metric, higher_is_worse in METRICS.items():
+            value, expected = metrics.get(metric), reference.get(metric)
+            if value is None or expected is None:
+                continue
+            if higher_is_worse and value > expected * (1 + tolerance):
+                regressions.append(f"{dataset}: {metric} {value:.4g} > {expected:.4g}")
+            elif not higher_is_worse and value < expected * (1 - tolerance):
+                regressions.append(f"{dataset}: {metric} {value:.4g} < {expected:.4g}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el procesamiento sobre los conjuntos de datos incluidos.")
+    parser.add_argument("--datasets", nargs="*", help="Conjuntos de datos a medir (todos por defecto).")
+    parser.add_argument("--config", default=os.path.join(DATA_DIR, "config.json"),
+                        help="Archivo de configuración del que se toman los parámetros.")
+    parser.add_argument("--stages", action="store_true", help="Medir además cada etapa por separado.")
+    parser.add_argument("--repeat", type=int, default=1, help="Repeticiones por etapa en el modo --stages.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Archivo JSON de referencia.")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Guardar los resultados como nueva referencia.")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Variación relativa permitida antes de marcar una regresión.")
+    parser.add_argument("--output", help="Archivo JSON donde guardar los resultados.")
+    args = parser.parse_args()
+
+    datasets = args.datasets or find_datasets()
+    results = {}
+    for dataset in datasets:
+        print(f"Midiendo '{dataset}'...")
+        result = run_pipeline(dataset, args.config)
+        if result is None:
+            continue
+        if args.stages:
+            result["isolated_stages"] = run_stages(dataset, args.config, args.repeat)
+        results[dataset] = result
+        print(f"  tiempo {result['total_time']:.2f} s, pares {result['pairs_evaluated']}, "
+              f"fitness {result['mean_fitness']}, memoria {result['peak_rss']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"Referencia actualizada en {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"Advertencia: no existe la referencia {args.baseline}; use --update-baseline para crearla.")
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"Regresión: {regression}")
+    if not regressions:
+        print("Sin regresiones respecto a la referencia.")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
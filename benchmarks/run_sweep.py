@@ -0,0 +1,304 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Permite importar los módulos de src/
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+DATA_DIR = os.path.join(ROOT_DIR, "data")
+sys.path.append(SRC_DIR)
+
+from config_reader import load_config
+from pc_reader import load_point_clouds
+from pc_preprocessing import pc_preprocessing, cloud_to_arrays, arrays_to_cloud
+from prepared_cloud import PreparedCloud, prepare_clouds
+from pc_comparator import check_all_pc_combinability
+from pc_full_registration import full_registration
+from pose_graph_optimization import optimize_pose_graph
+from pc_stacking import registration_key, resolve_registration_params
+from registration_cache import RegistrationCache
+from workers import resolve_num_workers
+
+# Parámetros de los que depende cada etapa; el resto de los parámetros del barrido afecta al registro
+PREPROCESS_PARAMS = ("voxel_size", "remove_outliers_params")
+COMBINABILITY_PARAMS = ("combinability_threshold", "combinability_params")
+
+# Estado de cada proceso trabajador: resultados de las etapas anteriores y nubes reconstruidas
+_worker_state = {}
+
+def expand_grid(grid):
+    """
+    Expande una grilla de parámetros en la lista de sus combinaciones.
+
+    Parámetros:
+        grid (dict): Lista de valores de cada parámetro, por ejemplo
+            {"voxel_size": [0.02, 0.05], "combinability_threshold": [0.3, 0.5]}.
+
+    Devuelve:
+        list: Diccionario de parámetros de cada configuración, en orden.
+    """
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+def stage_key(params, names):
+    """
+    Devuelve la llave de una etapa: los valores de los parámetros de los que depende.
+    """
+    return json.dumps({name: params.get(name) for name in names}, sort_keys=True)
+
+def _init_worker(state):
+    """
+    Inicializa un proceso trabajador con los resultados de las etapas anteriores.
+    """
+    _worker_state.clear()
+    _worker_state.update(state)
+    _worker_state["clouds"] = {}
+    # Los pares con el mismo contenido y parámetros se registran una sola vez por trabajador
+    _worker_state["cache"] = RegistrationCache()
+
+def _get_prepared_clouds(preprocess_key):
+    """
+    Devuelve las nubes preparadas de un preprocesamiento, reconstruyéndolas una sola vez por trabajador.
+    """
+    clouds = _worker_state["clouds"]
+    if preprocess_key not in clouds:
+        voxel_size, arrays = _worker_state["prepared"][preprocess_key]
+        clouds[preprocess_key] = [PreparedCloud.from_arrays(points, normals, voxel_size, colors)
+                                  for points, normals, colors in arrays]
+    return clouds[preprocess_key]
+
+def _run_jobs(function, jobs, state, num_workers):
+    """
+    Ejecuta los trabajos de una etapa, en paralelo si hay varios procesos y varios trabajos.
+    """
+    if num_workers <= 1 or len(jobs) <= 1:
+        _init_worker(state)
+        return [function(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs)),
+                             initializer=_init_worker, initargs=(state,)) as executor:
+        return list(executor.map(function, *zip(*jobs)))
+
+def _preprocess_job(key, voxel_size, remove_outliers_params):
+    """
+    Preprocesa y prepara todas las nubes con un tamaño de voxel y parámetros de atípicos.
+    """
+    start = time.perf_counter()
+    pcds = [arrays_to_cloud(*arrays) for arrays in _worker_state["pcds"]]
+    preprocessed = pc_preprocessing(pcds, voxel_size, remove_outliers_params)
+    prepared = prepare_clouds(preprocessed, voxel_size)
+    arrays = [(np.array(pcd.points), np.array(pcd.normals),
+               np.asarray(pcd.pcd.colors).copy() if pcd.pcd.has_colors() else None) for pcd in prepared]
+    return key, arrays, time.perf_counter() - start
+
+def _combinability_job(key, preprocess_key, threshold, combinability_params):
+    """
+    Calcula las nubes combinables de un preprocesamiento con un umbral.
+    """
+    start = time.perf_counter()
+    clouds = _get_prepared_clouds(preprocess_key)
+    combinable = check_all_pc_combinability(clouds, threshold, combinability_params=combinability_params)
+    position = {id(pcd): index for index, pcd in enumerate(clouds)}
+    return key, [position[id(pcd)] for pcd in combinable], time.perf_counter() - start
+
+def _registration_job(key, preprocess_key, indices, voxel_size, registration_params, pose_graph_params):
+    """
+    Registra las nubes combinables y optimiza el grafo de poses.
+    """
+    clouds = _get_prepared_clouds(preprocess_key)
+    combinable = [clouds[index] for index in indices]
+    registration_params = resolve_registration_params(registration_params, voxel_size)
+    cache = _worker_state["cache"]
+    distance_coarse = voxel_size * 15
+    distance_fine = voxel_size * 1.5
+
+    start = time.perf_counter()
+    pose_graph = full_registration(combinable, distance_coarse, distance_fine, cache=cache,
+                                   registration_params=registration_params,
+                                   pose_graph_params=pose_graph_params)
+    registration_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    optimize_pose_graph(pose_graph, distance_fine)
+    optimization_time = time.perf_counter() - start
+
+    # Fitness de las aristas del grafo, tomado de los resultados que el registro dejó en el almacén
+    fitness = []
+    for edge in pose_graph.edges:
+        source, target = combinable[edge.source_node_id], combinable[edge.target_node_id]
+        result = cache.get(registration_key(cache, source.content_hash, target.content_hash,
+                                            distance_coarse, distance_fine, registration_params))
+        if result is not None:
+            fitness.append(result["fitness"])
+    return key, {
+        "registration_time": registration_time,
+        "optimization_time": optimization_time,
+        "edges": len(pose_graph.edges),
+        "mean_fitness": float(np.mean(fitness)) if fitness else None
+    }
+
+def run_sweep(config_file, grid, num_workers=0):
+    """
+    Ejecuta el procesamiento para cada combinación de una grilla de parámetros, compartiendo etapas.
+
+    Las etapas forman un grafo de dependencias: una lectura, un
+    preprocesamiento por cada combinación de voxel y parámetros de atípicos,
+    una combinabilidad por preprocesamiento y umbral, y un registro con
+    optimización por cada conjunto distinto de nubes combinables y parámetros
+    de registro. Cada etapa única se calcula una sola vez y las de un mismo
+    nivel se reparten entre varios procesos; su resultado se comparte con
+    todas las configuraciones que dependen de ella.
+
+    Parámetros:
+        config_file (str): Archivo de configuración con la carpeta de entrada y los parámetros base.
+        grid (dict): Lista de valores de cada parámetro de config_params a barrer.
+        num_workers (int): Número de procesos (0 para usar todos los núcleos, 1 para ejecutar en serie).
+
+    Devuelve:
+        list: Una fila por configuración con sus parámetros, el tiempo de cada etapa,
+            el tiempo total, las nubes combinables, las aristas y el fitness promedio.
+    """
+    base_params = load_config(config_file)
+    overrides = expand_grid(grid)
+    configurations = [dict(base_params, **override) for override in overrides]
+    registration_names = sorted(set(grid) - set(PREPROCESS_PARAMS) - set(COMBINABILITY_PARAMS)
+                                | {"registration_params", "pose_graph_params"})
+    workers = resolve_num_workers(num_workers)
+    sweep_start = time.perf_counter()
+
+    ###====%%%   Lectura (una sola vez)   %%%====###
+    start = time.perf_counter()
+    pcds = load_point_clouds(config_file, base_params.get("num_workers"))
+    load_time = time.perf_counter() - start
+    if len(pcds) == 0:
+        return []
+    pcd_arrays = [cloud_to_arrays(pcd) for pcd in pcds]
+
+    ###====%%%   Preprocesamiento por voxel y parámetros de atípicos   %%%====###
+    preprocess_keys = [stage_key(params, PREPROCESS_PARAMS) for params in configurations]
+    jobs = {key: (key, params.get("voxel_size"), params.get("remove_outliers_params"))
+            for key, params in zip(preprocess_keys, configurations)}
+    prepared = {}
+    preprocess_times = {}
+    for key, arrays, elapsed in _run_jobs(_preprocess_job, list(jobs.values()), {"pcds": pcd_arrays}, workers):
+        prepared[key] = (jobs[key][1], arrays)
+        preprocess_times[key] = elapsed
+    state = {"prepared": prepared}
+
+    ###====%%%   Combinabilidad por preprocesamiento y umbral   %%%====###
+    combinability_keys = [preprocess_key + stage_key(params, COMBINABILITY_PARAMS)
+                          for preprocess_key, params in zip(preprocess_keys, configurations)]
+    jobs = {key: (key, preprocess_key, params.get("combinability_threshold"), params.get("combinability_params"))
+            for key, preprocess_key, params in zip(combinability_keys, preprocess_keys, configurations)}
+    combinable = {}
+    combinability_times = {}
+    for key, indices, elapsed in _run_jobs(_combinability_job, list(jobs.values()), state, workers):
+        combinable[key] = indices
+        combinability_times[key] = elapsed
+
+    ###====%%%   Registro y optimización por conjunto de nubes combinables   %%%====###
+    # Umbrales distintos que dejan las mismas nubes combinables comparten el registro
+    registration_stage_keys = [json.dumps([preprocess_key, sorted(combinable[combinability_key]),
+                                     stage_key(params, registration_names)])
+                         for preprocess_key, combinability_key, params
+                         in zip(preprocess_keys, combinability_keys, configurations)]
+    jobs = {}
+    for key, preprocess_key, combinability_key, params in zip(registration_stage_keys, preprocess_keys,
+                                                              combinability_keys, configurations):
+        if len(combinable[combinability_key]) >= 2:
+            jobs[key] = (key, preprocess_key, combinable[combinability_key], params.get("voxel_size"),
+                         params.get("registration_params"), params.get("pose_graph_params"))
+    registrations = dict(_run_jobs(_registration_job, list(jobs.values()), state, workers))
+
+    print(f"Etapas únicas para {len(configurations)} configuraciones: 1 lectura, "
+          f"{len(prepared)} preprocesamientos, {len(combinable)} combinabilidades y "
+          f"{len(registrations)} registros, en {time.perf_counter() - sweep_start:.2f} s.")
+
+    ###====%%%   Tabla de resultados   %%%====###
+    rows = []
+    for index, (override, preprocess_key, combinability_key, registration_stage_key) in enumerate(
+            zip(overrides, preprocess_keys, combinability_keys, registration_stage_keys)):
+        registration = registrations.get(registration_stage_key, {})
+        row = {"config": index}
+        row.update({name: json.dumps(value) if isinstance(value, (dict, list)) else value
+                    for name, value in override.items()})
+        row.update({
+            "load_time": load_time,
+            "preprocessing_time": preprocess_times[preprocess_key],
+            "combinability_time": combinability_times[combinability_key],
+            "registration_time": registration.get("registration_time"),
+            "optimization_time": registration.get("optimization_time"),
+            "combinable": len(combinable[combinability_key]),
+            "edges": registration.get("edges"),
+            "mean_fitness": registration.get("mean_fitness")
+        })
+        # Tiempo que tomaría la configuración ejecutada sola, sin compartir etapas
+        row["total_time"] = sum(row[name] or 0.0 for name in ("load_time", "preprocessing_time",
+                                                              "combinability_time", "registration_time",
+                                                              "optimization_time"))
+        rows.append(row)
+    return rows
+
+def print_table(rows):
+    """
+    Imprime la tabla de resultados con columnas alineadas.
+
+    Parámetros:
+        rows (list): Filas devueltas por run_sweep.
+    """
+    if not rows:
+        return
+    columns = list(rows[0])
+
+    def format_value(value):
+        if isinstance(value, float):
+            return f"{value:.4g}"
+        return "-" if value is None else str(value)
+
+    cells = [[format_value(row[column]) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(cell.ljust(width) for cell, width in zip(line, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Barre una grilla de parámetros compartiendo las etapas comunes.")
+    parser.add_argument("--config", default=os.path.join(DATA_DIR, "config.json"),
+                        help="Archivo de configuración con la carpeta de entrada y los parámetros base.")
+    parser.add_argument("--grid", help="Archivo JSON con la lista de valores de cada parámetro.")
+    parser.add_argument("--voxel-size", type=float, nargs="*", help="Valores de voxel_size.")
+    parser.add_argument("--threshold", type=float, nargs="*", help="Valores de combinability_threshold.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Número de procesos (0 para usar todos los núcleos).")
+    parser.add_argument("--output", help="Archivo CSV donde guardar la tabla de resultados.")
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid:
+        with open(args.grid, 'r') as f:
+            grid = json.load(f)
+    if args.voxel_size:
+        grid["voxel_size"] = args.voxel_size
+    if args.threshold:
+        grid["combinability_threshold"] = args.threshold
+    if not grid:
+        parser.error("Se debe indicar --grid, --voxel-size o --threshold.")
+
+    rows = run_sweep(args.config, grid, args.workers)
+    print_table(rows)
+
+    if args.output and rows:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Resultados guardados en {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,6 +31,67 @@ def load_config(config_file):
         "combinability_threshold": float
     }
 
+    # Parámetros opcionales y sus valores por defecto
+    optional_params = {
+        "cache_dir": "../cache",
+        "preprocessing_cache_mb": 1024,
+        "preprocessing_max_inflight_mb": 512,
+        "max_cloud_mb": 0,
+        "voxel_params": {
+            "mode": "fixed",
+            "target_points": 20000,
+            "sample_size": 0
+        },
+        "num_workers": 0,
+        "parallel_min_clouds": 4,
+        "candidate_k": 0,
+        "candidate_descriptor": "bbox",
+        "candidate_report": False,
+        "combinability_params": {
+            "mode": "exact",
+            "symmetric": False
+        },
+        "combinability_prefilter": {
+            "model": "",
+            "low": 0.1,
+            "high": 0.9,
+            "sample_size": 500
+        },
+        "registration_params": {
+            "mode": "two_pass",
+            "init": "identity"
+        },
+        "pose_graph_params": {
+            "sparsify": False,
+            "min_fitness": 0.3,
+            "min_correspondences": 100,
+            "max_loop_closures": 5,
+            "drop_gated": False
+        },
+        "submap_params": {
+            "mode": "none",
+            "size": 10,
+            "voxel_size": 0.0
+        },
+        "init_benchmark": False,
+        "output_format": "binary",
+        "merge_params": {
+            "enabled": False,
+            "voxel_size": 0.0,
+            "counts": False,
+            "max_memory_mb": 512
+        },
+        "lod_params": {
+            "enabled": False,
+            "max_level": 4,
+            "resolution": 128
+        },
+        "show_result": False,
+        "profile_output": "",
+        "incremental": False,
+        "incremental_neighbors": 3
+    }
+
     def validate_config(config, expected_params):
         """
         Valida que la configuración tenga los nombres esperados y valores numéricos.
@@ -61,14 +122,14 @@ def load_config(config_file):
         config_params = config.get("config_params", {})
         
         if validate_config(config_params, expected_params):
-            return config_params
+            return {**optional_params, **config_params}
         else:
             print(f"Advertencia: La configuración no es válida. Se utilizarán los valores por defecto: {default_config}")
-            return default_config
+            return {**optional_params, **default_config}
 
     except FileNotFoundError:
         print(f"Error: No se encontró el archivo de configuración {config_file}.")
-        return default_config
+        return {**optional_params, **default_config}
     except json.JSONDecodeError:
         print(f"Error: No se pudo analizar el archivo JSON {config_file}.")
-        return default_config
\ No newline at end of file
+        return {**optional_params, **default_config}
\ No newline at end of file
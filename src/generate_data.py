@@ -1,85 +1,146 @@
 import os
 import open3d as o3d
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pc_preprocessing import pc_preprocessing
+from pc_reader import list_point_cloud_files, read_point_clouds
+from workers import resolve_num_workers
 import csv
 
-def compute_alignment_quality(source, target):
+# Estado de cada proceso trabajador: puntos de las nubes y árboles KD ya construidos
+_worker_state = {}
+
+def build_kdtree(points):
+    """
+    Construye un índice de vecinos más cercanos sobre un arreglo de puntos.
+
+    Parámetros:
+        points (numpy.ndarray): Arreglo (N, 3) de coordenadas.
+
+    Devuelve:
+        open3d.core.nns.NearestNeighborSearch: Índice listo para consultas KNN.
+    """
+    kdtree = o3d.core.nns.NearestNeighborSearch(
+        o3d.core.Tensor(np.ascontiguousarray(points, dtype=np.float64)))
+    kdtree.knn_index()
+    return kdtree
+
+def alignment_features(source_points, target_points, target_kdtree):
+    """
+    Calcula el vector de características de alineación a partir de los arreglos de puntos.
+
+    Parámetros:
+        source_points (numpy.ndarray): Arreglo (N, 3) de la nube de origen.
+        target_points (numpy.ndarray): Arreglo (M, 3) de la nube de destino.
+        target_kdtree (open3d.core.nns.NearestNeighborSearch): Índice KD de la nube de destino.
+
+    Devuelve:
+        numpy.array: Diferencia de puntos, distancia promedio por índice y distancia promedio al vecino más cercano.
+    """
+    # Diferencia en el número de puntos
+    point_diff = abs(len(source_points) - len(target_points))
+
+    # Distancia promedio entre correspondencias (puntos con el mismo índice)
+    num_correspondences = min(len(source_points), len(target_points))
+    mean_distance = np.mean(np.linalg.norm(
+        source_points[:num_correspondences] - target_points[:num_correspondences], axis=1))
+
+    # Distancia promedio de cada punto de origen a su vecino más cercano en el destino
+    _, squared_distances = target_kdtree.knn_search(
+        o3d.core.Tensor(np.ascontiguousarray(source_points, dtype=np.float64)), 1)
+    average_distance = np.mean(np.sqrt(squared_distances.numpy()[:, 0]))
+
+    return np.array([point_diff, mean_distance, average_distance])
+
+def compute_alignment_quality(source, target, target_kdtree=None):
     """
     Calcula la calidad de la alineación entre dos nubes de puntos.
-    
+
     Parámetros:
         source (open3d.geometry.PointCloud): Nube de puntos de origen.
         target (open3d.geometry.PointCloud): Nube de puntos de destino.
-        
+        target_kdtree (open3d.core.nns.NearestNeighborSearch): Índice KD de la nube de destino
+            (None para construirlo).
+
     Devuelve:
         numpy.array: Vector de características que representan la calidad de la alineación.
     """
-    # Número total de puntos en cada nube de puntos
-    num_points_source = len(source.points)
-    num_points_target = len(target.points)
-    
-    # Diferencia en el número de puntos
-    point_diff = abs(num_points_source - num_points_target) 
-    
-    # Número de correspondencias
-    num_correspondences = min(num_points_source, num_points_target)
-    
-    # Distancia promedio entre correspondencias
-    distances = []
-    for i in range(num_correspondences):
-        dist = np.linalg.norm(np.asarray(source.points[i]) - np.asarray(target.points[i]))
-        distances.append(dist)
-    mean_distance = np.mean(distances)
-
-    distance = source.compute_point_cloud_distance(target)
-    distance_ = np.asarray(distance)
-    # Calcular la distancia promedio
-    average_distance = np.mean(distance_)
-    
-    # Combina todas las medidas en un vector de características
-    features = np.array([point_diff, mean_distance, average_distance])
-    
-    return features
-
-def process_point_clouds_in_folder(folder_path, output_file):
+    target_points = np.asarray(target.points)
+    if target_kdtree is None:
+        target_kdtree = build_kdtree(target_points)
+    return alignment_features(np.asarray(source.points), target_points, target_kdtree)
+
+def _init_worker(points):
+    """
+    Inicializa un proceso trabajador con los puntos de todas las nubes.
+    """
+    _worker_state["points"] = points
+    _worker_state["kdtrees"] = {}
+
+def _get_worker_kdtree(index):
+    """
+    Devuelve el índice KD de una nube, construyéndolo una sola vez por trabajador.
+    """
+    kdtrees = _worker_state["kdtrees"]
+    if index not in kdtrees:
+        kdtrees[index] = build_kdtree(_worker_state["points"][index])
+    return kdtrees[index]
+
+def _source_rows(source_id):
+    """
+    Calcula las características de una nube de origen contra todas las demás.
+    """
+    points = _worker_state["points"]
+    return [(source_id, target_id,
+             alignment_features(points[source_id], points[target_id], _get_worker_kdtree(target_id)))
+            for target_id in range(len(points)) if target_id != source_id]
+
+def process_point_clouds_in_folder(folder_path, output_file, num_workers=0):
     """
     Procesa cada par de nubes de puntos en una carpeta y guarda los resultados en un archivo CSV.
-    
+
+    Los pares se reparten por nube de origen entre varios procesos; cada
+    proceso construye el índice KD de cada nube una sola vez y las filas se
+    escriben en el archivo a medida que se completan, en orden.
+
     Parámetros:
         folder_path (str): Ruta de la carpeta que contiene las nubes de puntos.
         output_file (str): Ruta del archivo CSV de salida.
+        num_workers (int): Número de procesos (0 para usar todos los núcleos, 1 para calcular en serie).
     """
-    # Obtener la lista de archivos en la carpeta
-    files = os.listdir(folder_path)
-    num_files = len(files)
-    
-    pcds = []
-    for file in os.listdir(folder_path):
-        if file.endswith(".pcd"):
-            pcd_path = os.path.join(folder_path, file)
-            pcd = o3d.io.read_point_cloud(pcd_path)
-            pcds.append(pcd)
-            
+    # Obtener la lista de archivos .pcd de la carpeta, en orden natural
+    files = list_point_cloud_files(folder_path)
+    pcds = read_point_clouds([os.path.join(folder_path, file) for file in files])
+
     # Aplicar preprocesamiento
-    pre_processed_pcds = pc_preprocessing(pcds, voxel_size=0.02, 
+    pre_processed_pcds = pc_preprocessing(pcds, voxel_size=0.02,
                 remove_outliers_params={"nb_neighbors": 20, "std_ratio": 2.0})
     print(f"Se preprocesaron {len(pre_processed_pcds)} nubes de puntos.")
-    
+    points = [np.asarray(pcd.points) for pcd in pre_processed_pcds]
+
     # Crear o abrir el archivo CSV de salida
     with open(output_file, 'w', newline='') as csvfile:
         csvwriter = csv.writer(csvfile)
-        
+
         # Escribir encabezados de las columnas en el archivo CSV
-        csvwriter.writerow(['Source', 'Target', 'Point Difference', 
+        csvwriter.writerow(['Source', 'Target', 'Point Difference',
                             'Mean Distance', 'o3D Distance'])
-        
-        # Procesar cada par de nubes de puntos
-        for i in range(len(pre_processed_pcds)):
-            for j in range(len(pre_processed_pcds)):
-                if i != j:
-                    # Calcular características de calidad de alineación
-                    features = compute_alignment_quality(pre_processed_pcds[i], pre_processed_pcds[j])
-                    
-                    # Escribir resultados en el archivo CSV
+
+        workers = resolve_num_workers(num_workers)
+        if workers <= 1 or len(points) <= 2:
+            _init_worker(points)
+            rows = map(_source_rows, range(len(points)))
+            executor = None
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(points,))
+            rows = executor.map(_source_rows, range(len(points)))
+
+        try:
+            # Procesar cada par de nubes de puntos y escribir los resultados a medida que se obtienen
+            for source_rows in rows:
+                for i, j, features in source_rows:
                     csvwriter.writerow([files[i], files[j]] + list(features))
+                csvfile.flush()
+        finally:
+            if executor is not None:
+                executor.shutdown()
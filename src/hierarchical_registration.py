@@ -0,0 +1,177 @@
+import numpy as np
+import open3d as o3d
+from parallel_registration import register_pairs
+from workers import resolve_num_workers
+from pc_full_registration import full_registration
+from pose_graph_optimization import optimize_pose_graph
+from prepared_cloud import PreparedCloud, as_point_cloud
+
+def split_submaps(pcds, submap_size, mode="sequence", iterations=20):
+    """
+    Divide las nubes de puntos en submapas.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        submap_size: int
+            Cantidad de nubes por submapa (en el modo "spatial", cantidad promedio).
+        mode: str
+            "sequence" (bloques consecutivos de la secuencia) o "spatial"
+            (agrupamiento k-means de los centroides de las nubes).
+        iterations: int
+            Iteraciones del agrupamiento k-means.
+
+    Returns:
+        submaps: List[List[int]]
+            Índices de las nubes de cada submapa, ordenados.
+    """
+    n = len(pcds)
+    if mode == "sequence":
+        return [list(range(start, min(start + submap_size, n))) for start in range(0, n, submap_size)]
+    elif mode != "spatial":
+        raise ValueError(f"Modo de submapas desconocido: '{mode}'.")
+
+    centroids = np.array([as_point_cloud(pcd).get_center() for pcd in pcds])
+    num_submaps = int(np.ceil(n / submap_size))
+    # Inicialización determinista: centroides repartidos a lo largo de la secuencia
+    centers = centroids[np.linspace(0, n - 1, num_submaps).astype(int)]
+    for _ in range(iterations):
+        labels = np.argmin(np.linalg.norm(centroids[:, np.newaxis] - centers[np.newaxis], axis=2), axis=1)
+        new_centers = np.array([centroids[labels == c].mean(axis=0) if np.any(labels == c) else centers[c]
+                                for c in range(num_submaps)])
+        if np.allclose(new_centers, centers):
+            break
+        centers = new_centers
+
+    submaps = [np.flatnonzero(labels == c).tolist() for c in range(num_submaps)]
+    return sorted((submap for submap in submaps if submap), key=lambda submap: submap[0])
+
+def merge_submap(pcds, indices, poses, voxel_size):
+    """
+    Combina las nubes de un submapa en su marco local y reduce el resultado por voxeles.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos (no se modifican).
+        indices: List[int]
+            Índices de las nubes del submapa.
+        poses: dict
+            Pose local {índice: matriz 4x4} de cada nube del submapa.
+        voxel_size: float
+            Tamaño del voxel de la nube combinada.
+
+    Returns:
+        submap: prepared_cloud.PreparedCloud
+            Nube combinada y reducida del submapa.
+    """
+    merged = o3d.geometry.PointCloud()
+    for index in indices:
+        transformed = o3d.geometry.PointCloud(as_point_cloud(pcds[index]))
+        transformed.transform(poses[index])
+        merged += transformed
+    return PreparedCloud(merged.voxel_down_sample(voxel_size), voxel_size)
+
+def hierarchical_registration(pcds, max_correspondence_distance_coarse,
+                              max_correspondence_distance_fine, voxel_size,
+                              submap_size=10, mode="sequence", submap_voxel_size=None,
+                              cache=None, num_workers=1, parallel_min_clouds=4,
+                              registration_params=None, pose_graph_params=None):
+    """
+    Registra las nubes de puntos por submapas y devuelve sus poses globales.
+
+    Primero se registran todos los pares dentro de cada submapa (en paralelo)
+    y cada submapa se optimiza como un componente independiente del grafo;
+    luego cada submapa se combina en una nube reducida, los submapas se
+    registran y optimizan entre sí, y su pose se propaga a cada nube.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos a registrar.
+        max_correspondence_distance_coarse: float
+            Distancia máxima para buscar correspondencias durante el registro grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante el registro fino.
+        voxel_size: float
+            Tamaño del voxel de las nubes preprocesadas.
+        submap_size: int
+            Cantidad de nubes por submapa.
+        mode: str
+            Forma de dividir las nubes, ver split_submaps.
+        submap_voxel_size: float
+            Tamaño del voxel de las nubes combinadas de los submapas (None para 2 * voxel_size).
+        cache: registration_cache.RegistrationCache
+            Almacén de resultados de registro compartido (None para registrar siempre).
+        num_workers: int
+            Número de procesos para registrar los pares y optimizar los submapas (0 para usar todos los núcleos).
+        parallel_min_clouds: int
+            Cantidad mínima de nubes para registrar en paralelo; por debajo se registra en serie.
+        registration_params: dict
+            Parámetros del método de registro, ver pc_stacking.compute_pairwise_registration.
+        pose_graph_params: dict
+            Parámetros de la reducción del grafo de submapas, ver pc_full_registration.full_registration;
+            "drop_gated" se aplica también a los cierres de bucle dentro de cada submapa.
+
+    Returns:
+        pose_graph: open3d.pipelines.registration.PoseGraph
+            Grafo con la pose global de cada nube y las aristas dentro de los submapas.
+    """
+    submap_voxel_size = submap_voxel_size or 2 * voxel_size
+    workers = resolve_num_workers(num_workers) if len(pcds) >= parallel_min_clouds else 1
+    submaps = split_submaps(pcds, submap_size, mode)
+    print(f"Registro jerárquico: {len(pcds)} nubes en {len(submaps)} submapas.")
+
+    ###====%%%   Registro dentro de cada submapa   %%%====###
+    pairs = [(submap[k], submap[l]) for submap in submaps
+             for k in range(len(submap)) for l in range(k + 1, len(submap))]
+    odometry_pairs = [pair for submap in submaps for pair in zip(submap, submap[1:])]
+    results = register_pairs(pcds, pairs,
+                             max_correspondence_distance_coarse,
+                             max_correspondence_distance_fine,
+                             num_workers=workers, cache=cache,
+                             registration_params=registration_params,
+                             odometry_pairs=odometry_pairs)
+
+    # Un grafo con un componente por submapa; la primera nube de cada submapa es su origen
+    local_graph = o3d.pipelines.registration.PoseGraph()
+    local_poses = {}
+    for submap in submaps:
+        local_poses[submap[0]] = np.identity(4)
+        for previous, current in zip(submap, submap[1:]):
+            transformation = results[(previous, current)]["transformation"]
+            local_poses[current] = np.dot(local_poses[previous], np.linalg.inv(transformation))
+    for index in range(len(pcds)):
+        local_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(local_poses[index]))
+    position = {index: k for submap in submaps for k, index in enumerate(submap)}
+    drop_gated = (pose_graph_params or {}).get("drop_gated", False)
+    for source_id, target_id in pairs:
+        uncertain = position[target_id] != position[source_id] + 1
+        if uncertain and drop_gated and results[(source_id, target_id)].get("gated", False):
+            continue
+        local_graph.edges.append(
+            o3d.pipelines.registration.PoseGraphEdge(source_id, target_id,
+                                                     results[(source_id, target_id)]["transformation"],
+                                                     results[(source_id, target_id)]["information"],
+                                                     uncertain=uncertain))
+    local_graph = optimize_pose_graph(local_graph, max_correspondence_distance_fine, workers)
+    local_poses = {index: np.asarray(local_graph.nodes[index].pose) for index in range(len(pcds))}
+
+    if len(submaps) == 1:
+        return local_graph
+
+    ###====%%%   Registro entre submapas   %%%====###
+    submap_pcds = [merge_submap(pcds, submap, local_poses, submap_voxel_size) for submap in submaps]
+    submap_graph = full_registration(submap_pcds,
+                                     max_correspondence_distance_coarse,
+                                     max_correspondence_distance_fine,
+                                     cache=cache, num_workers=num_workers,
+                                     parallel_min_clouds=parallel_min_clouds,
+                                     registration_params=registration_params,
+                                     pose_graph_params=pose_graph_params)
+    submap_graph = optimize_pose_graph(submap_graph, max_correspondence_distance_fine)
+
+    # Pose global de cada nube: pose del submapa compuesta con su pose local
+    for s, submap in enumerate(submaps):
+        submap_pose = np.asarray(submap_graph.nodes[s].pose)
+        for index in submap:
+            local_graph.nodes[index].pose = np.dot(submap_pose, local_poses[index])
+    return local_graph
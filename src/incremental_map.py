@@ -0,0 +1,441 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import open3d as o3d
+from pc_reader import list_point_cloud_files, read_point_clouds
+from colorgen import generate_distinct_colors
+from pc_preprocessing import pc_preprocessing, adaptive_voxel_sizes
+from preprocessing_cache import PreprocessingCache
+from prepared_cloud import PreparedCloud, prepare_clouds, as_point_cloud
+from pc_candidates import compute_global_descriptor
+from pc_comparator import is_pair_combinable
+from parallel_registration import register_pairs
+from workers import resolve_num_workers
+from pc_stacking import resolve_registration_params
+from registration_cache import RegistrationCache
+from pose_graph_optimization import optimize_pose_graph
+from pc_writer import StreamingPCDWriter, transform_cloud_arrays, write_combined_pcd
+from profiler import profile_stage
+
+# Parámetros que invalidan el mapa guardado si cambian
+MAP_PARAMS = ("voxel_size", "voxel_params", "remove_outliers_params", "combinability_threshold",
+              "combinability_prefilter", "combinability_params", "registration_params", "output_format",
+              "merge_params", "lod_params")
+
+# Arreglos de cada nube del mapa, guardados en archivos .npy
+NODE_ARRAYS = ("points", "normals", "colors")
+
+def map_state_dir(cache_dir, config_file):
+    """
+    Devuelve la carpeta donde se guarda el estado del mapa de una carpeta de entrada y un archivo de salida.
+
+    Parameters:
+        cache_dir: str
+            Carpeta de resultados intermedios.
+        config_file: str
+            Ruta del archivo de configuración JSON (input_path y output_file).
+
+    Returns:
+        state_dir: str
+            Carpeta del estado del mapa.
+    """
+    with open(config_file, 'r') as f:
+        config_data = json.load(f)
+    paths = [os.path.abspath(config_data.get("input_path") or ""),
+             os.path.abspath(config_data.get("output_file") or "")]
+    return os.path.join(cache_dir, "maps", hashlib.sha1(repr(paths).encode()).hexdigest())
+
+def config_fingerprint(config_params):
+    """
+    Resume los parámetros que determinan el mapa en un hash.
+
+    Parameters:
+        config_params: dict
+            Parámetros de configuración.
+
+    Returns:
+        fingerprint: str
+            Hash SHA-1 hexadecimal de los parámetros del mapa.
+    """
+    params = {name: config_params.get(name) for name in MAP_PARAMS}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+def load_map_state(state_dir, fingerprint):
+    """
+    Lee el estado de un mapa guardado.
+
+    Parameters:
+        state_dir: str
+            Carpeta del estado del mapa.
+        fingerprint: str
+            Hash de los parámetros actuales, ver config_fingerprint.
+
+    Returns:
+        state: dict
+            Estado del mapa ("files", "nodes", "output_size", ...), o None si no existe
+            o se generó con otros parámetros.
+    """
+    state_file = os.path.join(state_dir, "state.json")
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        state = json.load(f)
+    if state.get("fingerprint") != fingerprint:
+        print("Los parámetros cambiaron desde la última ejecución; se reconstruye el mapa completo.")
+        return None
+    return state
+
+def save_map_state(state_dir, fingerprint, files, node_files, pcds, pose_graph, output_file,
+                   first_node=0, descriptors=None, voxel_size=None):
+    """
+    Guarda el estado del mapa: grafo de poses, nubes preparadas de cada nodo y archivos procesados.
+
+    Parameters:
+        state_dir: str
+            Carpeta del estado del mapa.
+        fingerprint: str
+            Hash de los parámetros, ver config_fingerprint.
+        files: List[str]
+            Todos los archivos de entrada ya procesados (incluidos los descartados).
+        node_files: List[str]
+            Archivo de cada nodo del grafo de poses, en orden.
+        pcds: List[prepared_cloud.PreparedCloud]
+            Nubes de los nodos a partir de first_node (las anteriores ya están guardadas).
+        pose_graph: open3d.pipelines.registration.PoseGraph
+            Grafo de poses optimizado.
+        output_file: str
+            Archivo de salida escrito con estas poses.
+        first_node: int
+            Índice del primer nodo de pcds.
+        descriptors: numpy.ndarray
+            Descriptores globales de todos los nodos (None para calcularlos a partir de pcds).
+        voxel_size: float
+            Tamaño de voxel de referencia usado en el registro (con voxeles adaptativos, la mediana).
+    """
+    if first_node == 0 and os.path.isdir(state_dir):
+        shutil.rmtree(state_dir)
+    os.makedirs(os.path.join(state_dir, "nodes"), exist_ok=True)
+
+    for offset, pcd in enumerate(pcds):
+        node_dir = os.path.join(state_dir, "nodes", str(first_node + offset))
+        os.makedirs(node_dir, exist_ok=True)
+        cloud = as_point_cloud(pcd)
+        for name in NODE_ARRAYS:
+            array = np.asarray(getattr(cloud, name))
+            if len(array) > 0:
+                np.save(os.path.join(node_dir, name + ".npy"), array)
+
+    if descriptors is None:
+        descriptors = np.array([compute_global_descriptor(pcd) for pcd in pcds])
+    np.save(os.path.join(state_dir, "descriptors.npy"), descriptors)
+    o3d.io.write_pose_graph(os.path.join(state_dir, "pose_graph.json"), pose_graph)
+
+    # state.json se escribe al final: un estado sin este archivo se ignora
+    tmp_file = os.path.join(state_dir, "state.json.tmp")
+    with open(tmp_file, 'w') as f:
+        json.dump({
+            "fingerprint": fingerprint,
+            "files": list(files),
+            "nodes": list(node_files),
+            "voxel_size": voxel_size,
+            "output_size": os.path.getsize(output_file) if os.path.exists(output_file) else None
+        }, f, indent=4)
+    os.replace(tmp_file, os.path.join(state_dir, "state.json"))
+
+def load_node_cloud(state_dir, index, voxel_size):
+    """
+    Lee la nube preparada de un nodo del mapa.
+
+    Parameters:
+        state_dir: str
+            Carpeta del estado del mapa.
+        index: int
+            Índice del nodo.
+        voxel_size: float
+            Tamaño del voxel usado para el radio de los descriptores FPFH.
+
+    Returns:
+        pcd: prepared_cloud.PreparedCloud
+            Nube preparada del nodo.
+    """
+    node_dir = os.path.join(state_dir, "nodes", str(index))
+    arrays = {}
+    for name in NODE_ARRAYS:
+        path = os.path.join(node_dir, name + ".npy")
+        # Vector3dVector no acepta arreglos de solo lectura, por lo que se leen completos
+        arrays[name] = np.load(path) if os.path.exists(path) else None
+    return PreparedCloud.from_arrays(arrays["points"], arrays["normals"], voxel_size, arrays["colors"])
+
+def pose_displacement(state_dir, index, old_pose, new_pose):
+    """
+    Calcula el desplazamiento máximo de los puntos de un nodo del mapa al cambiar su pose.
+
+    El desplazamiento de un punto es una función convexa de sus coordenadas,
+    por lo que su máximo sobre la nube está acotado por el de las esquinas de
+    la caja que la contiene.
+
+    Parameters:
+        state_dir: str
+            Carpeta del estado del mapa.
+        index: int
+            Índice del nodo.
+        old_pose: numpy.ndarray
+            Pose 4x4 con la que se escribió el nodo.
+        new_pose: numpy.ndarray
+            Pose 4x4 del nodo tras la optimización.
+
+    Returns:
+        displacement: float
+            Cota del desplazamiento máximo de los puntos del nodo.
+    """
+    delta = np.asarray(new_pose) - np.asarray(old_pose)
+    if not np.any(delta):
+        return 0.0
+    # Solo se leen las coordenadas, proyectadas en memoria, para obtener la caja de la nube
+    points = np.load(os.path.join(state_dir, "nodes", str(index), "points.npy"), mmap_mode='r')
+    if len(points) == 0:
+        return 0.0
+    bounds = np.stack([points.min(axis=0), points.max(axis=0)])
+    corners = np.array([[bounds[i, 0], bounds[j, 1], bounds[k, 2], 1.0]
+                        for i in range(2) for j in range(2) for k in range(2)])
+    return float(np.max(np.linalg.norm(corners @ delta[:3].T, axis=1)))
+
+def select_map_neighbors(descriptors, descriptor, k):
+    """
+    Elige los nodos del mapa con los que se compara una nube nueva.
+
+    El último nodo (continuación de la cadena de odometría) va siempre primero,
+    seguido de los k nodos con el descriptor global más cercano.
+
+    Parameters:
+        descriptors: numpy.ndarray
+            Descriptores globales de los nodos del mapa.
+        descriptor: numpy.ndarray
+            Descriptor global de la nube nueva.
+        k: int
+            Cantidad de vecinos por descriptor.
+
+    Returns:
+        neighbors: List[int]
+            Índices de los nodos vecinos.
+    """
+    last = len(descriptors) - 1
+    std = descriptors.std(axis=0)
+    std[std == 0] = 1.0
+    distances = np.linalg.norm((descriptors - descriptor) / std, axis=1)
+    nearest = [int(j) for j in np.argsort(distances, kind="stable") if j != last][:k]
+    return [last] + nearest
+
+def update_map(config_file, config_params, state_dir):
+    """
+    Agrega al mapa guardado solo las nubes nuevas de la carpeta de entrada.
+
+    Cada nube nueva se compara con la última nube del mapa y con sus vecinas
+    por descriptor global; se registran solo esos pares, se agregan los nodos
+    y aristas al grafo guardado, se reoptimiza y se agregan las nubes nuevas al
+    archivo de salida. Si la reoptimización mueve alguna nube ya escrita más
+    de medio voxel, el archivo se reescribe completo con las poses nuevas; si
+    no, esas nubes conservan en el grafo las poses con las que se escribieron,
+    de modo que el grafo guardado coincide siempre con el archivo de salida.
+
+    Parameters:
+        config_file: str
+            Ruta del archivo de configuración JSON.
+        config_params: dict
+            Parámetros de configuración.
+        state_dir: str
+            Carpeta del estado del mapa, ver map_state_dir.
+
+    Returns:
+        updated: bool
+            True si el mapa se actualizó (o no había nubes nuevas); False si hay que
+            reconstruirlo completo.
+    """
+    fingerprint = config_fingerprint(config_params)
+    state = load_map_state(state_dir, fingerprint)
+    if state is None:
+        return False
+
+    with open(config_file, 'r') as f:
+        config_data = json.load(f)
+    input_path = config_data.get("input_path")
+    output_file = config_data.get("output_file")
+    if input_path is None or not os.path.isdir(input_path):
+        return False
+
+    files = list_point_cloud_files(input_path)
+    known_files = set(state["files"])
+    if not known_files <= set(files):
+        print("Se eliminaron nubes de la carpeta de entrada; se reconstruye el mapa completo.")
+        return False
+    new_files = [file for file in files if file not in known_files]
+    if not new_files:
+        print("No hay nubes de puntos nuevas; el mapa está actualizado.")
+        return True
+    print(f"Actualizando el mapa con {len(new_files)} nubes de puntos nuevas.")
+
+    # Las nubes nuevas se registran con el mismo voxel de referencia que el mapa guardado
+    voxel_size = state.get("voxel_size") or config_params.get("voxel_size")
+    cache_dir = config_params.get("cache_dir")
+    max_correspondence_distance_coarse = voxel_size * 15
+    max_correspondence_distance_fine = voxel_size * 1.5
+
+    ###====%%%   Lectura y preprocesamiento de las nubes nuevas   %%%====###
+    # Las nubes nuevas demasiado grandes se dejan como rutas y se reducen por mosaicos, como en main.py
+    with profile_stage("load"):
+        new_pcds = read_point_clouds([os.path.join(input_path, file) for file in new_files],
+                                     config_params.get("num_workers"), config_params.get("max_cloud_mb"))
+    colors = generate_distinct_colors(len(files))
+    first_color = len(state["files"])
+    for i, pcd in enumerate(new_pcds):
+        if not isinstance(pcd, str):
+            pcd.paint_uniform_color(colors[first_color + i])
+
+    with profile_stage("preprocessing"):
+        preprocessing_cache = None
+        if config_params.get("preprocessing_cache_mb") > 0:
+            preprocessing_cache = PreprocessingCache(os.path.join(cache_dir, "preprocessing"),
+                                                     config_params.get("preprocessing_cache_mb") * 1024 ** 2)
+        workers = resolve_num_workers(config_params.get("num_workers")) \
+            if len(new_pcds) >= config_params.get("parallel_min_clouds") else 1
+        voxel_params = config_params.get("voxel_params")
+        preprocessing_voxel_sizes = voxel_size
+        if voxel_params.get("mode", "fixed") == "adaptive":
+            preprocessing_voxel_sizes = adaptive_voxel_sizes(new_pcds, voxel_params.get("target_points", 20000),
+                                                             voxel_params.get("sample_size", 0))
+        preprocessed_pcds = pc_preprocessing(new_pcds, preprocessing_voxel_sizes,
+                                             config_params.get("remove_outliers_params"),
+                                             cache=preprocessing_cache, num_workers=workers,
+                                             max_inflight_mb=config_params.get("preprocessing_max_inflight_mb"),
+                                             max_cloud_mb=config_params.get("max_cloud_mb") or 512,
+                                             sources=[os.path.join(input_path, file) for file in new_files])
+    for i, pcd in enumerate(preprocessed_pcds):
+        pcd.paint_uniform_color(colors[first_color + i])
+    prepared_pcds = prepare_clouds(preprocessed_pcds, voxel_size)
+
+    ###====%%%   Combinabilidad contra los vecinos en el mapa   %%%====###
+    pose_graph = o3d.io.read_pose_graph(os.path.join(state_dir, "pose_graph.json"))
+    descriptors = list(np.load(os.path.join(state_dir, "descriptors.npy")))
+    node_files = list(state["nodes"])
+    first_new_node = len(node_files)
+
+    # Solo se leen del disco las nubes del mapa que resultan vecinas de alguna nube nueva
+    clouds = {}
+    def get_cloud(index):
+        if index not in clouds:
+            clouds[index] = load_node_cloud(state_dir, index, voxel_size)
+        return clouds[index]
+
+    pairs = []
+    with profile_stage("combinability"):
+        for file, pcd in zip(new_files, prepared_pcds):
+            descriptor = compute_global_descriptor(pcd)
+            neighbors = select_map_neighbors(np.array(descriptors), descriptor,
+                                             config_params.get("incremental_neighbors"))
+            combinable = [j for j in neighbors
+                          if is_pair_combinable(get_cloud(j), pcd, config_params.get("combinability_threshold"),
+                                                config_params.get("combinability_params"))]
+            if not combinable:
+                print(f"La nube {file} no es combinable con el mapa; se descarta.")
+                continue
+            index = len(node_files)
+            node_files.append(file)
+            descriptors.append(descriptor)
+            clouds[index] = pcd
+            pairs += [(j, index) for j in combinable]
+
+    added = len(node_files) - first_new_node
+    if added == 0:
+        save_map_state(state_dir, fingerprint, files, node_files, [], pose_graph, output_file,
+                       first_node=first_new_node, descriptors=np.array(descriptors), voxel_size=voxel_size)
+        return True
+
+    ###====%%%   Registro de los pares nuevos   %%%====###
+    # Se registran solo las nubes involucradas, con índices locales
+    indices = sorted({index for pair in pairs for index in pair})
+    position = {index: i for i, index in enumerate(indices)}
+    registration_params = resolve_registration_params(config_params.get("registration_params"), voxel_size)
+    # La primera arista de cada nodo nuevo actúa como odometría (ver la construcción del grafo)
+    anchors = [next(pair for pair in pairs if pair[1] == index)
+               for index in range(first_new_node, len(node_files))]
+    registration_cache = RegistrationCache(os.path.join(cache_dir, "registration"))
+    workers = resolve_num_workers(config_params.get("num_workers"))
+    with profile_stage("registration"):
+        local_results = register_pairs([clouds[index] for index in indices],
+                                       [(position[s], position[t]) for s, t in pairs],
+                                       max_correspondence_distance_coarse,
+                                       max_correspondence_distance_fine,
+                                       num_workers=workers if len(indices) >= config_params.get("parallel_min_clouds") else 1,
+                                       cache=registration_cache,
+                                       registration_params=registration_params,
+                                       odometry_pairs=[(position[s], position[t]) for s, t in anchors])
+    results = {(s, t): local_results[(position[s], position[t])] for s, t in pairs}
+    registration_cache.report()
+
+    # La primera arista de cada nodo nuevo (la última nube del mapa, si es combinable)
+    # define su pose inicial y actúa como odometría; el resto son cierres de bucle
+    for index in range(first_new_node, len(node_files)):
+        node_pairs = [pair for pair in pairs if pair[1] == index]
+        anchor = node_pairs[0]
+        transformation = results[anchor]["transformation"]
+        pose = np.dot(pose_graph.nodes[anchor[0]].pose, np.linalg.inv(transformation))
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+        for pair in node_pairs:
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(pair[0], pair[1],
+                                                         results[pair]["transformation"],
+                                                         results[pair]["information"],
+                                                         uncertain=pair != anchor))
+    print(f"Se agregaron {added} nodos y {len(pairs)} aristas al grafo de poses.")
+
+    written_poses = [np.asarray(pose_graph.nodes[index].pose).copy() for index in range(first_new_node)]
+    with profile_stage("pose_graph_optimization"):
+        pose_graph = optimize_pose_graph(pose_graph, max_correspondence_distance_fine)
+
+    # Nubes ya escritas que la reoptimización movió de forma visible en la salida
+    moved = [index for index in range(first_new_node)
+             if pose_displacement(state_dir, index, written_poses[index],
+                                  pose_graph.nodes[index].pose) > 0.5 * voxel_size]
+    if moved:
+        print(f"La optimización movió {len(moved)} nubes ya escritas; se reescribe el archivo de salida.")
+    else:
+        for index, pose in enumerate(written_poses):
+            pose_graph.nodes[index].pose = pose
+
+    ###====%%%   Escritura de las nubes nuevas   %%%====###
+    new_nodes = [clouds[index] for index in range(first_new_node, len(node_files))]
+    with profile_stage("write"):
+        appended = False
+        # Los mosaicos de niveles de detalle y la combinación de duplicados abarcan todo el mapa: se reescribe
+        if (not moved and config_params.get("output_format") == "binary"
+                and not config_params.get("lod_params").get("enabled")
+                and not config_params.get("merge_params").get("enabled") and os.path.exists(output_file)
+                and os.path.getsize(output_file) == state.get("output_size")):
+            cloud = as_point_cloud(new_nodes[0])
+            try:
+                with StreamingPCDWriter(output_file, cloud.has_normals(), cloud.has_colors(),
+                                        append=True) as writer:
+                    for index, pcd in zip(range(first_new_node, len(node_files)), new_nodes):
+                        cloud = as_point_cloud(pcd)
+                        points, normals = transform_cloud_arrays(cloud, pose_graph.nodes[index].pose)
+                        writer.append(points, normals if writer.with_normals else None,
+                                      np.asarray(cloud.colors) if writer.with_colors else None)
+                print(f"Se agregaron nubes al archivo {output_file}, que ahora tiene {writer.num_points} puntos.")
+                appended = True
+            except ValueError as e:
+                print(f"Advertencia: {e}")
+        if not appended:
+            # El archivo no admite agregar puntos: se reescribe completo con todas las nubes
+            all_nodes = [get_cloud(index) for index in range(len(node_files))]
+            merge_params = dict(config_params.get("merge_params"))
+            merge_params["voxel_size"] = merge_params.get("voxel_size") or voxel_size
+            write_combined_pcd(all_nodes, pose_graph, config_file,
+                               output_format=config_params.get("output_format"), visualize=False,
+                               lod_params=config_params.get("lod_params"),
+                               merge_params=merge_params)
+
+    save_map_state(state_dir, fingerprint, files, node_files, new_nodes, pose_graph, output_file,
+                   first_node=first_new_node, descriptors=np.array(descriptors), voxel_size=voxel_size)
+    return True
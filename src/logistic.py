@@ -1,3 +1,4 @@
+import argparse
 import pandas as pd
 from joblib import dump
 from sklearn.model_selection import train_test_split
@@ -5,12 +6,18 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score
 
+# Umbral de combinabilidad con el que se etiquetan los pares; debe coincidir con combinability_threshold
+parser = argparse.ArgumentParser(description="Entrena el modelo de combinabilidad usado por el prefiltro.")
+parser.add_argument("--threshold", type=float, default=0.4,
+                    help="Umbral de distancia promedio para definir si deben combinarse o no.")
+args = parser.parse_args()
+
 # Cargar los datos
 data = pd.read_csv("train.csv")
 
 # Dividir en características (X) y etiquetas (y)
 X = data.drop(columns=["Source", "Target"])  # Eliminar columnas de identificación
-y = (data["o3D Distance"] > 0.4).astype(int)  # Umbral para definir si deben combinarse o no
+y = (data["o3D Distance"] > args.threshold).astype(int)  # Umbral para definir si deben combinarse o no
 
 # Escalamiento de características
 #scaler = StandardScaler()
@@ -26,8 +33,8 @@ print(X_test)
 model = LogisticRegression()
 model.fit(X_train, y_train)
 
-# Guardar el modelo entrenado en un archivo "modelo_entrenado.pkl"
-dump(model, "modelo_entrenado.pkl")
+# Guardar el modelo entrenado y su umbral en un archivo "modelo_entrenado.pkl"
+dump({"model": model, "threshold": args.threshold}, "modelo_entrenado.pkl")
 
 # Predicciones en el conjunto de prueba
 y_pred = model.predict(X_test)
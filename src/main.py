@@ -1,21 +1,66 @@
 from pc_reader import load_point_clouds
 from colorgen import generate_distinct_colors
 from config_reader import load_config
-from pc_preprocessing import pc_preprocessing
-from pc_stacking import pairwise_registration
+from pc_preprocessing import pc_preprocessing, adaptive_voxel_sizes, reference_voxel_size
 from pc_full_registration import full_registration
+from hierarchical_registration import hierarchical_registration
+from workers import resolve_num_workers
+from pc_stacking import compare_initializations, resolve_registration_params
 from pc_comparator import check_all_pc_combinability
+from pc_candidates import select_candidate_pairs, candidate_recall_report
 from pose_graph_optimization import optimize_pose_graph
-from pc_writer import write_combined_pcd
+from pc_writer import write_combined_pcd, OUTPUT_FORMATS
+from registration_cache import RegistrationCache
+from preprocessing_cache import PreprocessingCache
+from prepared_cloud import prepare_clouds
+from profiler import enable_profiling, profile_stage, count_points
+from incremental_map import map_state_dir, update_map, config_fingerprint, save_map_state
 import open3d as o3d
+import os
+import sys
+import json
 
-def main():
-    # Ruta al archivo de configuración JSON
-    config_file = "../data/config.json"
+def main(config_file="../data/config.json"):
+    """
+    Ejecuta el procesamiento completo: lectura, preprocesamiento, combinabilidad,
+    registro, optimización del grafo de poses y escritura de la nube combinada.
+
+    Parámetros:
+        config_file (str): Ruta al archivo de configuración JSON.
+    """
+
+    ###====%%%   Lectura de configuraciones   %%%====###
+    config_params = load_config(config_file)
+    print(f"Los parámetros de configuración son: {config_params}")
+    voxel_size = config_params.get("voxel_size")
+    remove_outliers_params = config_params.get("remove_outliers_params")
+    combinability_threshold = config_params.get("combinability_threshold")
+    cache_dir = config_params.get("cache_dir")
+    show_result = config_params.get("show_result")
+
+    # El formato de salida se valida antes de procesar, no al escribir el resultado
+    if config_params.get("output_format") not in OUTPUT_FORMATS:
+        print(f"Error: Formato de salida desconocido: '{config_params.get('output_format')}'. "
+              f"Los formatos admitidos son: {', '.join(OUTPUT_FORMATS)}.")
+        return
+
+    # Perfilado por etapas (desactivado salvo que se configure profile_output o PCG_PROFILE)
+    enable_profiling(config_params.get("profile_output"))
+
+    ###====%%%   Actualización incremental del mapa   %%%====###
+    # Si existe un mapa guardado con los mismos parámetros, se registran solo las nubes nuevas
+    incremental = config_params.get("incremental")
+    if incremental:
+        state_dir = map_state_dir(cache_dir, config_file)
+        if update_map(config_file, config_params, state_dir):
+            return
     
     ###==============%%%   Lectura de nubes de puntos   %%%==============###
     # Cargar nubes de puntos desde el archivo de configuración
-    pcds = load_point_clouds(config_file)
+    with profile_stage("load") as stage:
+        pcds, files = load_point_clouds(config_file, config_params.get("num_workers"), return_files=True,
+                                        max_cloud_mb=config_params.get("max_cloud_mb"))
+        stage.points_out = count_points(pcds)
     if len(pcds) == 0:
         return   
     # Imprimir el número de nubes de puntos cargadas
@@ -26,31 +71,76 @@ def main():
     colors = generate_distinct_colors(n)
 
     ###====%%%   Visualización de nubes originales   %%%====###
+    # Las nubes demasiado grandes (dadas por su ruta) no se cargan ni se muestran
+    loaded_pcds = []
     for i in range(n):
-        pcds[i].paint_uniform_color(colors[i])
-    o3d.visualization.draw(pcds)
+        if not isinstance(pcds[i], str):
+            pcds[i].paint_uniform_color(colors[i])
+            loaded_pcds.append(pcds[i])
+    if show_result:
+        o3d.visualization.draw(loaded_pcds)
     
     ###==============%%%   Preprocesamiento de nubes   %%%==============###
-    
-    ###====%%%   Lectura de configuraciones   %%%====###
-    config_params = load_config(config_file)
-    print(f"Los parámetros de configuración son: {config_params}")
-    voxel_size = config_params.get("voxel_size")
-    remove_outliers_params = config_params.get("remove_outliers_params")
-    combinability_threshold = config_params.get("combinability_threshold")
     print(f"Éxito al validar los contenidos del archivo de configuración, iniciando el procesamiento") 
        
     ###====%%%   Downsampling y outlier detection   %%%====###
-    preprocessed_pcds = pc_preprocessing(pcds, voxel_size, remove_outliers_params)
+    with profile_stage("preprocessing", points_in=count_points(pcds)) as stage:
+        preprocessing_cache_mb = config_params.get("preprocessing_cache_mb")
+        preprocessing_cache = None
+        if preprocessing_cache_mb > 0:
+            preprocessing_cache = PreprocessingCache(os.path.join(cache_dir, "preprocessing"),
+                                                     preprocessing_cache_mb * 1024 ** 2)
+        preprocessing_workers = resolve_num_workers(config_params.get("num_workers")) \
+            if n >= config_params.get("parallel_min_clouds") else 1
+        # En el modo adaptativo cada nube usa su propio voxel y el registro usa la mediana de esos voxeles
+        voxel_params = config_params.get("voxel_params")
+        preprocessing_voxel_sizes = voxel_size
+        if voxel_params.get("mode", "fixed") == "adaptive":
+            preprocessing_voxel_sizes = adaptive_voxel_sizes(pcds, voxel_params.get("target_points", 20000),
+                                                             voxel_params.get("sample_size", 0))
+            voxel_size = reference_voxel_size(preprocessing_voxel_sizes, voxel_size)
+            print(f"Tamaño de voxel de referencia para el registro: {voxel_size:.4g}")
+        # Las llaves del almacén dependen del contenido de los archivos, no de los colores asignados arriba
+        with open(config_file, 'r') as f:
+            input_path = json.load(f).get("input_path")
+        preprocessed_pcds = pc_preprocessing(pcds, preprocessing_voxel_sizes, remove_outliers_params,
+                                             cache=preprocessing_cache,
+                                             sources=[os.path.join(input_path, file) for file in files],
+                                             num_workers=preprocessing_workers,
+                                             max_inflight_mb=config_params.get("preprocessing_max_inflight_mb"),
+                                             max_cloud_mb=config_params.get("max_cloud_mb") or 512)
+        stage.points_out = count_points(preprocessed_pcds)
     print(f"Se preprocesaron {len(preprocessed_pcds)} nubes de puntos.")
     
     ###====%%%   Visualización de nubes preprocesadas   %%%====###
     for i in range(len(preprocessed_pcds)):
         preprocessed_pcds[i].paint_uniform_color(colors[i])
-    o3d.visualization.draw(preprocessed_pcds)
+    if show_result:
+        o3d.visualization.draw(preprocessed_pcds)
+
+    ###====%%%   Preparación de nubes (normales, árbol KD y descriptores)   %%%====###
+    candidate_k = config_params.get("candidate_k")
+    candidate_descriptor = config_params.get("candidate_descriptor")
+    with profile_stage("prepare", points_in=count_points(preprocessed_pcds)) as stage:
+        prepared_pcds = prepare_clouds(preprocessed_pcds, voxel_size,
+                                       compute_features=candidate_k > 0 and candidate_descriptor == "fpfh")
+        stage.points_out = count_points(prepared_pcds)
     
+    ###====%%%   Selección de pares candidatos   %%%====###
+    candidate_pairs = None
+    if candidate_k > 0:
+        with profile_stage("candidates", points_in=count_points(prepared_pcds)):
+            candidate_pairs = select_candidate_pairs(prepared_pcds, candidate_k, candidate_descriptor, voxel_size)
+        print(f"Se seleccionaron {len(candidate_pairs)} pares candidatos.")
+        if config_params.get("candidate_report"):
+            candidate_recall_report(prepared_pcds, candidate_pairs, combinability_threshold)
+
     ###====%%%   Combinabilidad   %%%====###
-    combinable_pcds = check_all_pc_combinability(preprocessed_pcds, combinability_threshold)
+    with profile_stage("combinability", points_in=count_points(prepared_pcds)) as stage:
+        combinable_pcds = check_all_pc_combinability(prepared_pcds, combinability_threshold, candidate_pairs,
+                                                     config_params.get("combinability_params"),
+                                                     config_params.get("combinability_prefilter"))
+        stage.points_out = count_points(combinable_pcds)
     print("Pares combinables:", combinable_pcds)
     print("Cantidad de nubes combinables:", len(combinable_pcds))
 
@@ -64,26 +154,93 @@ def main():
         print("Éxito, combinando las siguientes nubes de puntos: ")
         max_correspondence_distance_coarse = voxel_size * 15
         max_correspondence_distance_fine = voxel_size * 1.5
+
+        # Almacén de resultados de registro compartido por todas las etapas
+        registration_cache = RegistrationCache(os.path.join(cache_dir, "registration"))
     
-        n_pcds = len(combinable_pcds)
-        for source_id in range(n_pcds):
-            for target_id in range(source_id + 1, n_pcds):
-                transformation_icp, information_icp = pairwise_registration(combinable_pcds[source_id], combinable_pcds[target_id], max_correspondence_distance_coarse, max_correspondence_distance_fine)
-                print("transformation_icp: ", transformation_icp)
-                print("information_icp: ", information_icp)
+        # Método de registro; el modo multiescala y la inicialización global usan voxel_size
+        registration_params = resolve_registration_params(config_params.get("registration_params"), voxel_size)
+
+        # Comparación de la inicialización global contra la identidad sobre la cadena de odometría
+        if config_params.get("init_benchmark") and registration_params.get("init", "identity") != "identity":
+            odometry_pairs = [(i, i + 1) for i in range(len(combinable_pcds) - 1)]
+            compare_initializations(combinable_pcds, odometry_pairs,
+                                    max_correspondence_distance_coarse,
+                                    max_correspondence_distance_fine, registration_params)
+
+        # Pares candidatos para los cierres de bucle entre las nubes combinables
+        loop_closure_pairs = None
+        if candidate_k > 0:
+            loop_closure_pairs = select_candidate_pairs(combinable_pcds, candidate_k, candidate_descriptor, voxel_size)
+
+        submap_params = config_params.get("submap_params")
+        if submap_params.get("mode", "none") != "none":
+            # Registro jerárquico: submapas optimizados por separado y luego entre sí
+            with profile_stage("registration", points_in=count_points(combinable_pcds)):
+                pose_graph_optimized = hierarchical_registration(
+                    combinable_pcds,
+                    max_correspondence_distance_coarse,
+                    max_correspondence_distance_fine,
+                    voxel_size,
+                    submap_size=submap_params.get("size", 10),
+                    mode=submap_params["mode"],
+                    submap_voxel_size=submap_params.get("voxel_size") or None,
+                    cache=registration_cache,
+                    num_workers=config_params.get("num_workers"),
+                    parallel_min_clouds=config_params.get("parallel_min_clouds"),
+                    registration_params=registration_params,
+                    pose_graph_params=config_params.get("pose_graph_params"))
+            registration_cache.report()
+        else:
+            # Registro de todos los pares (en paralelo) usando el almacén compartido
+            with profile_stage("registration", points_in=count_points(combinable_pcds)):
+                pose_graph = full_registration(combinable_pcds,
+                                               max_correspondence_distance_coarse,
+                                               max_correspondence_distance_fine,
+                                               cache=registration_cache,
+                                               num_workers=config_params.get("num_workers"),
+                                               parallel_min_clouds=config_params.get("parallel_min_clouds"),
+                                               candidate_pairs=loop_closure_pairs,
+                                               registration_params=registration_params,
+                                               pose_graph_params=config_params.get("pose_graph_params"))
+
+            for edge in pose_graph.edges:
+                print("transformation_icp: ", edge.transformation)
+                print("information_icp: ", edge.information)
                 print("========================")
-                
-        pose_graph = full_registration(combinable_pcds,
-                                       max_correspondence_distance_coarse,
-                                       max_correspondence_distance_fine)
+            registration_cache.report()
 
-        # Llama a la función optimize_pose_graph para optimizar el grafo de poses
-        pose_graph_optimized = optimize_pose_graph(pose_graph, max_correspondence_distance_fine)
+            # Llama a la función optimize_pose_graph para optimizar el grafo de poses
+            with profile_stage("pose_graph_optimization"):
+                pose_graph_optimized = optimize_pose_graph(pose_graph, max_correspondence_distance_fine,
+                                                           resolve_num_workers(config_params.get("num_workers")))
         
         print(f"Éxito al aplicar el algoritmo, guardando archivo de salida") 
         # Llamar a la función write_combined_pcd para escribir las nubes de puntos combinadas en un archivo .pcd
-        write_combined_pcd(combinable_pcds, pose_graph_optimized, config_file)
+        # La combinación de duplicados usa el voxel del preprocesamiento si no se indica otro
+        merge_params = dict(config_params.get("merge_params"))
+        merge_params["voxel_size"] = merge_params.get("voxel_size") or voxel_size
+        with profile_stage("write", points_in=count_points(combinable_pcds)) as stage:
+            write_combined_pcd(combinable_pcds, pose_graph_optimized, config_file,
+                               output_format=config_params.get("output_format"),
+                               visualize=show_result,
+                               lod_params=config_params.get("lod_params"),
+                               merge_params=merge_params)
+            stage.points_out = count_points(combinable_pcds)
+
+        # Guardar el mapa para las próximas actualizaciones incrementales
+        if incremental:
+            file_of = {id(pcd): file for pcd, file in zip(prepared_pcds, files)}
+            with open(config_file, 'r') as f:
+                output_file = json.load(f).get("output_file")
+            save_map_state(state_dir, config_fingerprint(config_params), files,
+                           [file_of[id(pcd)] for pcd in combinable_pcds],
+                           combinable_pcds, pose_graph_optimized, output_file, voxel_size=voxel_size)
         
 if __name__ == "__main__":
-    main()
+    # Se puede indicar otro archivo de configuración como primer argumento
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()
     
\ No newline at end of file
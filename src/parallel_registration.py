@@ -0,0 +1,197 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import open3d as o3d
+from pc_stacking import compute_pairwise_registration, registration_key
+from registration_cache import cloud_hash
+from prepared_cloud import PreparedCloud
+from profiler import record_pair
+from workers import resolve_num_workers
+
+# Estado de cada proceso trabajador: bloques de memoria compartida y nubes reconstruidas
+_worker_state = {}
+
+def _init_worker(cloud_specs, max_correspondence_distance_coarse, max_correspondence_distance_fine,
+                 registration_params, odometry_pairs):
+    """
+    Inicializa un proceso trabajador adjuntando los bloques de memoria compartida de las nubes.
+    """
+    blocks = []
+    arrays = []
+    for name, shape, has_normals, voxel_size in cloud_specs:
+        shm = shared_memory.SharedMemory(name=name)
+        # El proceso principal es el dueño de los bloques; el trabajador no debe liberarlos
+        resource_tracker.unregister(shm._name, "shared_memory")
+        blocks.append(shm)
+        # Cada bloque contiene los puntos y, si la nube está preparada, sus normales a continuación
+        data = np.ndarray((2 if has_normals else 1,) + shape, dtype=np.float64, buffer=shm.buf)
+        arrays.append((data, voxel_size))
+    _worker_state["blocks"] = blocks
+    _worker_state["arrays"] = arrays
+    _worker_state["clouds"] = {}
+    _worker_state["distances"] = (max_correspondence_distance_coarse, max_correspondence_distance_fine)
+    _worker_state["registration_params"] = registration_params
+    _worker_state["odometry_pairs"] = odometry_pairs
+
+def _get_worker_cloud(index):
+    """
+    Devuelve la nube de puntos del índice dado, construyéndola una sola vez por trabajador.
+    """
+    clouds = _worker_state["clouds"]
+    if index not in clouds:
+        data, voxel_size = _worker_state["arrays"][index]
+        if data.shape[0] == 2:
+            clouds[index] = PreparedCloud.from_arrays(data[0], data[1], voxel_size)
+        else:
+            pcd = o3d.geometry.PointCloud()
+            pcd.points = o3d.utility.Vector3dVector(data[0])
+            clouds[index] = pcd
+    return clouds[index]
+
+def _register_job(pair):
+    """
+    Registra un par de nubes de puntos dentro de un proceso trabajador.
+    """
+    source_id, target_id = pair
+    max_correspondence_distance_coarse, max_correspondence_distance_fine = _worker_state["distances"]
+    start = time.perf_counter()
+    result = compute_pairwise_registration(_get_worker_cloud(source_id),
+                                           _get_worker_cloud(target_id),
+                                           max_correspondence_distance_coarse,
+                                           max_correspondence_distance_fine,
+                                           pair_registration_params(_worker_state["registration_params"],
+                                                                    pair in _worker_state["odometry_pairs"]))
+    # El instante de fin se toma del reloj de pared, comparable entre procesos
+    return pair, result, time.perf_counter() - start, os.getpid(), time.time()
+
+def pair_registration_params(registration_params, odometry):
+    """
+    Devuelve los parámetros de registro de un par.
+
+    Los pares de odometría no se descartan tras el registro grueso: su arista
+    es la única que une cada nube con la anterior, y una arista sin
+    información dejaría la pose de la nube sin restricciones en el grafo.
+
+    Parameters:
+        registration_params: dict
+            Parámetros del método de registro, ver pc_stacking.compute_pairwise_registration.
+        odometry: bool
+            True si el par es de odometría.
+
+    Returns:
+        registration_params: dict
+            Parámetros del par (sin umbrales del registro grueso si es de odometría).
+    """
+    if not odometry:
+        return registration_params
+    return dict(registration_params or {}, gate_fitness=0.0, gate_rmse=0.0)
+
+def register_pairs(pcds, pairs, max_correspondence_distance_coarse,
+                   max_correspondence_distance_fine, num_workers=1, cache=None,
+                   registration_params=None, odometry_pairs=None):
+    """
+    Registra una lista de pares de nubes de puntos, en paralelo si se solicitan varios procesos.
+
+    Las coordenadas de cada nube (y sus normales, si está preparada) se copian
+    una sola vez a un bloque de memoria compartida; los trabajadores se adjuntan
+    a esos bloques al iniciar, por lo que cada tarea solo transporta los índices
+    del par.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        pairs: List[Tuple[int, int]]
+            Pares (fuente, objetivo) de índices a registrar.
+        max_correspondence_distance_coarse: float
+            Distancia máxima para buscar correspondencias durante el registro grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante el registro fino.
+        num_workers: int
+            Número de procesos trabajadores (1 para registrar en serie).
+        cache: registration_cache.RegistrationCache
+            Almacén de resultados de registro (None para registrar siempre).
+        registration_params: dict
+            Parámetros del método de registro, ver pc_stacking.compute_pairwise_registration.
+        odometry_pairs: List[Tuple[int, int]]
+            Pares de odometría, que siempre pasan al registro fino, ver pair_registration_params.
+
+    Returns:
+        results: dict
+            Diccionario {(fuente, objetivo): resultado} con el resultado de cada par,
+            según compute_pairwise_registration.
+    """
+    results = {}
+    keys = {}
+    odometry_pairs = set(odometry_pairs or ())
+
+    # Consultar primero el almacén para enviar a los trabajadores solo los pares faltantes
+    if cache is not None:
+        hashes = [cloud_hash(pcd) for pcd in pcds]
+        for pair in pairs:
+            keys[pair] = registration_key(cache, hashes[pair[0]], hashes[pair[1]],
+                                          max_correspondence_distance_coarse,
+                                          max_correspondence_distance_fine,
+                                          pair_registration_params(registration_params, pair in odometry_pairs))
+            cached = cache.get(keys[pair])
+            if cached is not None:
+                results[pair] = cached
+                record_pair(pair[0], pair[1], cached, 0.0, cached=True)
+    pending = [pair for pair in pairs if pair not in results]
+
+    if num_workers <= 1 or len(pending) <= 1:
+        for source_id, target_id in pending:
+            start = time.perf_counter()
+            results[(source_id, target_id)] = compute_pairwise_registration(
+                pcds[source_id], pcds[target_id],
+                max_correspondence_distance_coarse,
+                max_correspondence_distance_fine,
+                pair_registration_params(registration_params, (source_id, target_id) in odometry_pairs))
+            record_pair(source_id, target_id, results[(source_id, target_id)],
+                        time.perf_counter() - start)
+    else:
+        print(f"Registrando {len(pending)} pares con {num_workers} procesos...")
+        blocks = []
+        try:
+            cloud_specs = []
+            for pcd in pcds:
+                voxel_size = None
+                if isinstance(pcd, PreparedCloud):
+                    data = np.stack([pcd.points, pcd.normals])
+                    voxel_size = pcd.voxel_size
+                else:
+                    data = np.asarray(pcd.points, dtype=np.float64)[np.newaxis]
+                shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+                np.ndarray(data.shape, dtype=np.float64, buffer=shm.buf)[:] = data
+                blocks.append(shm)
+                cloud_specs.append((shm.name, data.shape[1:], data.shape[0] == 2, voxel_size))
+
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     initializer=_init_worker,
+                                     initargs=(cloud_specs,
+                                               max_correspondence_distance_coarse,
+                                               max_correspondence_distance_fine,
+                                               registration_params,
+                                               odometry_pairs)) as executor:
+                for pair, result, elapsed, worker, end in executor.map(_register_job, pending):
+                    results[pair] = result
+                    record_pair(pair[0], pair[1], result, elapsed, worker=worker, end=end)
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    if cache is not None:
+        for pair in pending:
+            cache.put(keys[pair], results[pair])
+
+    # Reporte de los pares que no alcanzaron los umbrales del registro grueso
+    params = registration_params or {}
+    if params.get("gate_fitness", 0.0) > 0.0 or params.get("gate_rmse", 0.0) > 0.0:
+        gated = sum(1 for pair in pairs if results[pair].get("gated", False))
+        candidates = sum(1 for pair in pairs if pair not in odometry_pairs)
+        print(f"Pares descartados tras el registro grueso: {gated} de {candidates} "
+              f"(sin registro fino ni matriz de información).")
+
+    return results
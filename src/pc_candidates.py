@@ -0,0 +1,129 @@
+import time
+import numpy as np
+import open3d as o3d
+from pc_comparator import check_pc_combinability
+from prepared_cloud import PreparedCloud, as_point_cloud
+
+def compute_global_descriptor(pcd, descriptor="bbox", voxel_size=0.02):
+    """
+    Calcula un descriptor global y barato de una nube de puntos.
+
+    Parameters:
+        pcd: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos a describir (no se modifica).
+        descriptor: str
+            Tipo de descriptor: "bbox" (centroide y extensiones de la caja orientada)
+            o "fpfh" (histograma FPFH promedio).
+        voxel_size: float
+            Tamaño del voxel usado para los radios de normales y FPFH.
+
+    Returns:
+        vector: numpy.ndarray
+            Vector descriptor de la nube de puntos.
+    """
+    if descriptor == "bbox":
+        cloud = as_point_cloud(pcd)
+        centroid = cloud.get_center()
+        extent = np.sort(cloud.get_oriented_bounding_box().extent)[::-1]
+        return np.concatenate([centroid, extent])
+    elif descriptor == "fpfh" and isinstance(pcd, PreparedCloud):
+        # Las nubes preparadas ya tienen (o guardan) sus descriptores FPFH
+        return np.asarray(pcd.features().data).mean(axis=1)
+    elif descriptor == "fpfh":
+        # Se trabaja sobre una copia para no modificar las normales de la nube original
+        pcd_copy = o3d.geometry.PointCloud(pcd)
+        pcd_copy.estimate_normals(
+            o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+        fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+            pcd_copy, o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5, max_nn=100))
+        return np.asarray(fpfh.data).mean(axis=1)
+    else:
+        raise ValueError(f"Descriptor desconocido: '{descriptor}'.")
+
+def select_candidate_pairs(pcds, k, descriptor="bbox", voxel_size=0.02):
+    """
+    Propone los pares de nubes de puntos con mayor probabilidad de traslape.
+
+    Cada nube se resume en un descriptor global; los descriptores se
+    normalizan y se indexan en un árbol KD, y para cada nube se proponen sus
+    k vecinos más cercanos en el espacio de descriptores.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        k: int
+            Cantidad de vecinos propuestos por nube (0 o más que n-1 para proponer todos los pares).
+        descriptor: str
+            Tipo de descriptor global, ver compute_global_descriptor.
+        voxel_size: float
+            Tamaño del voxel usado para los radios del descriptor FPFH.
+
+    Returns:
+        candidate_pairs: List[Tuple[int, int]]
+            Pares (i, j) con i < j, ordenados.
+    """
+    n = len(pcds)
+    if k <= 0 or k >= n - 1:
+        return [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+    descriptors = np.array([compute_global_descriptor(pcd, descriptor, voxel_size) for pcd in pcds])
+
+    # Normalizar cada dimensión para que ninguna domine la distancia
+    std = descriptors.std(axis=0)
+    std[std == 0] = 1.0
+    descriptors = (descriptors - descriptors.mean(axis=0)) / std
+
+    # Índice de vecinos más cercanos sobre los descriptores (una columna por nube)
+    tree = o3d.geometry.KDTreeFlann(descriptors.T.copy())
+
+    candidate_pairs = set()
+    for i in range(n):
+        _, neighbors, _ = tree.search_knn_vector_xd(descriptors[i], k + 1)
+        for j in neighbors:
+            if j != i:
+                candidate_pairs.add((min(i, j), max(i, j)))
+
+    return sorted(candidate_pairs)
+
+def candidate_recall_report(pcds, candidate_pairs, threshold):
+    """
+    Compara la selección de candidatos contra la evaluación exhaustiva de todos los pares.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        candidate_pairs: List[Tuple[int, int]]
+            Pares propuestos por select_candidate_pairs.
+        threshold: float
+            Umbral para determinar la combinabilidad.
+
+    Returns:
+        report: dict
+            Diccionario con la cantidad de pares evaluados, los tiempos de cada
+            estrategia y el recall de los candidatos sobre los pares combinables.
+    """
+    n = len(pcds)
+    all_pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+    start = time.perf_counter()
+    combinable = {pair for pair in all_pairs
+                  if check_pc_combinability(pcds[pair[0]], pcds[pair[1]], threshold)}
+    exhaustive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = {pair for pair in candidate_pairs
+             if check_pc_combinability(pcds[pair[0]], pcds[pair[1]], threshold)}
+    candidate_time = time.perf_counter() - start
+
+    recall = len(found & combinable) / len(combinable) if combinable else 1.0
+    report = {
+        "exhaustive_pairs": len(all_pairs),
+        "candidate_pairs": len(candidate_pairs),
+        "exhaustive_time": exhaustive_time,
+        "candidate_time": candidate_time,
+        "recall": recall
+    }
+
+    print(f"Candidatos: {len(candidate_pairs)} de {len(all_pairs)} pares, "
+          f"recall {recall:.3f}, tiempo {candidate_time:.2f} s contra {exhaustive_time:.2f} s exhaustivo.")
+    return report
@@ -1,27 +1,58 @@
+import os
 import numpy as np
 import open3d as o3d
 import networkx as nx
+from prepared_cloud import PreparedCloud, as_point_cloud
 
-def check_pc_combinability(source, target, threshold):
+def point_cloud_distances(source, target, indices=None):
+    """
+    Calcula la distancia de los puntos de la nube de origen a su vecino más cercano en la de destino.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de origen.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de destino. Si está preparada, se reutiliza su índice KD.
+        indices: numpy.ndarray
+            Índices de los puntos de origen a consultar (None para todos).
+
+    Returns:
+        distances: numpy.ndarray
+            Distancia de cada punto consultado a la nube de destino.
+    """
+    source_points = np.asarray(as_point_cloud(source).points)
+    if indices is not None:
+        source_points = source_points[indices]
+
+    if isinstance(target, PreparedCloud):
+        return target.nearest_distances(source_points)
+
+    query = o3d.geometry.PointCloud()
+    query.points = o3d.utility.Vector3dVector(source_points)
+    return np.asarray(query.compute_point_cloud_distance(target))
+
+def check_pc_combinability(source, target, threshold, symmetric=False):
     """
     Comprueba la combinabilidad de dos nubes de puntos en función de la distancia entre ellas.
 
     Parameters:
-        source: open3d.geometry.PointCloud
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
             Nube de puntos de origen.
-        target: open3d.geometry.PointCloud
-            Nube de puntos de destino.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de destino. Si está preparada, se reutiliza su índice KD.
         threshold: float
             Umbral para determinar la combinabilidad.
+        symmetric: bool
+            Si es True, se promedia la distancia en ambas direcciones.
 
     Returns:
         combinable: bool
             True si las nubes de puntos son combinables, False de lo contrario.
     """
     # Calcular la distancia entre las nubes de puntos
-    distance = source.compute_point_cloud_distance(target)
-    distance_ = np.asarray(distance)
-    average_distance = np.mean(distance_)
+    average_distance = np.mean(point_cloud_distances(source, target))
+    if symmetric:
+        average_distance = 0.5 * (average_distance + np.mean(point_cloud_distances(target, source)))
     print(f"Pair: ({source}, {target}), O3D Distance: {average_distance}")
 
     # Comprobar si la distancia es menor que el umbral
@@ -29,15 +60,231 @@ def check_pc_combinability(source, target, threshold):
 
     return combinable
 
-def build_combination_graph(pcds, threshold):
+def estimate_pc_combinability(source, target, threshold, symmetric=False, batch_size=2000,
+                              z=2.576, max_fraction=0.25, seed=0):
+    """
+    Estima la combinabilidad de dos nubes de puntos muestreando puntos por lotes.
+
+    Se consultan lotes de puntos elegidos al azar y se mantiene un intervalo de
+    confianza sobre la distancia promedio; la evaluación se detiene en cuanto el
+    intervalo queda completamente por debajo o por encima del umbral. Si después
+    de muestrear max_fraction de los puntos el intervalo aún contiene al umbral,
+    se calcula la distancia promedio exacta.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de origen.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de destino.
+        threshold: float
+            Umbral para determinar la combinabilidad.
+        symmetric: bool
+            Si es True, se estima el promedio de la distancia en ambas direcciones.
+        batch_size: int
+            Cantidad de puntos consultados por lote y por dirección.
+        z: float
+            Cuantil normal del intervalo de confianza (2.576 para 99 %).
+        max_fraction: float
+            Fracción máxima de puntos a muestrear antes de recurrir al cálculo exacto
+            (los valores mayores que 1 equivalen a 1).
+        seed: int
+            Semilla del generador aleatorio, para que el muestreo sea reproducible.
+
+    Returns:
+        combinable: bool
+            True si las nubes de puntos son combinables, False de lo contrario.
+    """
+    rng = np.random.default_rng(seed)
+    directions = [(source, target), (target, source)] if symmetric else [(source, target)]
+
+    # Orden aleatorio de los puntos de origen de cada dirección y estadísticas acumuladas
+    orders = [rng.permutation(len(as_point_cloud(origin).points)) for origin, _ in directions]
+    if any(len(order) == 0 for order in orders):
+        return check_pc_combinability(source, target, threshold, symmetric)
+    sums = [0.0] * len(directions)
+    sums_sq = [0.0] * len(directions)
+    counts = [0] * len(directions)
+
+    while True:
+        for d, (origin, destination) in enumerate(directions):
+            batch = orders[d][counts[d]:counts[d] + batch_size]
+            if len(batch) == 0:
+                continue
+            distances = point_cloud_distances(origin, destination, batch)
+            sums[d] += distances.sum()
+            sums_sq[d] += np.square(distances).sum()
+            counts[d] += len(batch)
+
+        # Promedio e intervalo de confianza de la métrica (promedio de las direcciones)
+        means = [sums[d] / counts[d] for d in range(len(directions))]
+        variances = [max(sums_sq[d] / counts[d] - means[d] ** 2, 0.0) / counts[d]
+                     for d in range(len(directions))]
+        mean = np.mean(means)
+        margin = z * np.sqrt(np.sum(variances)) / len(directions)
+
+        if mean + margin < threshold or mean - margin > threshold:
+            sampled = sum(counts)
+            print(f"Pair: ({source}, {target}), Distancia estimada: {mean} ± {margin} ({sampled} puntos)")
+            return mean < threshold
+
+        # Caso límite: se recurre al promedio exacto (también si ya se muestrearon todos los puntos)
+        if all(counts[d] >= min(max_fraction, 1.0) * len(orders[d]) for d in range(len(directions))):
+            return check_pc_combinability(source, target, threshold, symmetric)
+
+def is_pair_combinable(source, target, threshold, combinability_params=None):
+    """
+    Decide la combinabilidad de un par con el método indicado en los parámetros.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de origen.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de destino.
+        threshold: float
+            Umbral para determinar la combinabilidad.
+        combinability_params: dict
+            Parámetros del método: "mode" ("exact" o "sampled"), "symmetric" y,
+            para el modo muestreado, los argumentos de estimate_pc_combinability
+            (None para el cálculo exacto en una dirección).
+
+    Returns:
+        combinable: bool
+            True si las nubes de puntos son combinables, False de lo contrario.
+    """
+    params = dict(combinability_params or {})
+    mode = params.pop("mode", "exact")
+    if mode == "sampled":
+        return estimate_pc_combinability(source, target, threshold, **params)
+    return check_pc_combinability(source, target, threshold, params.get("symmetric", False))
+
+def load_prefilter_model(model_file, threshold):
+    """
+    Carga el modelo de combinabilidad entrenado por logistic.py.
+
+    El modelo solo se usa si se entrenó con el mismo umbral que el que se
+    aplica; si no, su frontera de decisión no corresponde a la verificación
+    exacta y todos los pares se verifican de forma exacta.
+
+    Parameters:
+        model_file: str
+            Ruta del archivo del modelo (por ejemplo, modelo_entrenado.pkl).
+        threshold: float
+            Umbral de combinabilidad con el que se verificarán los pares.
+
+    Returns:
+        model: sklearn.linear_model.LogisticRegression
+            Modelo cargado, o None si no se puede cargar o su umbral no coincide.
+    """
+    try:
+        from joblib import load
+    except ImportError:
+        print("Advertencia: joblib no está instalado; no se usa el prefiltro de combinabilidad.")
+        return None
+    if not os.path.exists(model_file):
+        print(f"Advertencia: no existe el modelo {model_file}; no se usa el prefiltro de combinabilidad.")
+        return None
+    saved = load(model_file)
+    if not isinstance(saved, dict) or "threshold" not in saved:
+        print(f"Advertencia: el modelo {model_file} no guarda su umbral de entrenamiento; "
+              "no se usa el prefiltro de combinabilidad.")
+        return None
+    if not np.isclose(saved["threshold"], threshold):
+        print(f"Advertencia: el modelo {model_file} se entrenó con el umbral {saved['threshold']} y no con "
+              f"{threshold}; no se usa el prefiltro de combinabilidad.")
+        return None
+    return saved["model"]
+
+def prefilter_features(source, target, sample_size=500, seed=0):
+    """
+    Calcula características baratas de un par, equivalentes a las de generate_data.compute_alignment_quality.
+
+    La distancia promedio al vecino más cercano se estima con una muestra de
+    puntos de origen en lugar de consultar la nube completa.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de origen.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos de destino.
+        sample_size: int
+            Cantidad de puntos de origen usados para estimar la distancia.
+        seed: int
+            Semilla del generador aleatorio, para que la muestra sea reproducible.
+
+    Returns:
+        features: numpy.ndarray
+            Diferencia de puntos, distancia promedio por índice y distancia promedio estimada.
+    """
+    source_points = np.asarray(as_point_cloud(source).points)
+    target_points = np.asarray(as_point_cloud(target).points)
+    num_correspondences = min(len(source_points), len(target_points))
+    if num_correspondences == 0:
+        return np.array([abs(len(source_points) - len(target_points)), np.inf, np.inf])
+
+    mean_distance = np.mean(np.linalg.norm(
+        source_points[:num_correspondences] - target_points[:num_correspondences], axis=1))
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(source_points), min(sample_size, len(source_points)), replace=False)
+    average_distance = np.mean(point_cloud_distances(source, target, sample))
+    return np.array([abs(len(source_points) - len(target_points)), mean_distance, average_distance])
+
+def prefilter_pairs(pcds, pairs, model, low=0.1, high=0.9, sample_size=500):
+    """
+    Clasifica los pares con el modelo entrenado en una sola predicción por lotes.
+
+    El modelo de logistic.py predice la clase 1 cuando las nubes no deben
+    combinarse; los pares con probabilidad intermedia quedan como inciertos.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        pairs: List[Tuple[int, int]]
+            Pares a clasificar.
+        model: sklearn.linear_model.LogisticRegression
+            Modelo cargado con load_prefilter_model.
+        low: float
+            Probabilidad de no combinar por debajo de la cual el par se acepta sin verificar.
+        high: float
+            Probabilidad de no combinar por encima de la cual el par se descarta sin verificar.
+        sample_size: int
+            Cantidad de puntos de origen usados para estimar la distancia, ver prefilter_features.
+
+    Returns:
+        accepted: List[Tuple[int, int]]
+            Pares combinables según el modelo.
+        uncertain: List[Tuple[int, int]]
+            Pares que requieren la verificación exacta.
+    """
+    if not pairs:
+        return [], []
+    features = np.array([prefilter_features(pcds[i], pcds[j], sample_size) for i, j in pairs])
+    if hasattr(model, "feature_names_in_"):
+        # El modelo se entrenó con un DataFrame; se conservan los nombres de las columnas
+        import pandas as pd
+        features = pd.DataFrame(features, columns=model.feature_names_in_)
+    probabilities = model.predict_proba(features)[:, list(model.classes_).index(1)]
+
+    accepted = [pair for pair, p in zip(pairs, probabilities) if p <= low]
+    uncertain = [pair for pair, p in zip(pairs, probabilities) if low < p < high]
+    return accepted, uncertain
+
+def build_combination_graph(pcds, threshold, candidate_pairs=None, combinability_params=None,
+                            prefilter_params=None):
     """
     Construye un grafo de combinabilidad para las nubes de puntos.
 
     Parameters:
-        pcds: List[open3d.geometry.PointCloud]
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
             Lista de nubes de puntos.
         threshold: float
             Umbral para determinar la combinabilidad.
+        candidate_pairs: List[Tuple[int, int]]
+            Pares a evaluar (None para evaluar todos los pares).
+        combinability_params: dict
+            Parámetros del método de combinabilidad, ver is_pair_combinable.
+        prefilter_params: dict
+            Parámetros del prefiltro aprendido: "model" (ruta del modelo, vacío para no usarlo),
+            "low", "high" y "sample_size", ver prefilter_pairs.
 
     Returns:
         G: networkx.Graph
@@ -49,30 +296,54 @@ def build_combination_graph(pcds, threshold):
     for i in range(len(pcds)):
         G.add_node(i)
 
+    # Evaluar todos los pares si no se proporcionan candidatos
+    if candidate_pairs is None:
+        candidate_pairs = [(i, j) for i in range(len(pcds)) for j in range(i + 1, len(pcds))]
+
+    # Prefiltro aprendido: solo los pares inciertos pasan a la verificación exacta
+    pairs_to_check = candidate_pairs
+    prefilter_params = prefilter_params or {}
+    model = load_prefilter_model(prefilter_params["model"], threshold) if prefilter_params.get("model") else None
+    if model is not None:
+        accepted, pairs_to_check = prefilter_pairs(pcds, candidate_pairs, model,
+                                                   prefilter_params.get("low", 0.1),
+                                                   prefilter_params.get("high", 0.9),
+                                                   prefilter_params.get("sample_size", 500))
+        G.add_edges_from(accepted)
+        saved = len(candidate_pairs) - len(pairs_to_check)
+        print(f"Prefiltro de combinabilidad: {saved} de {len(candidate_pairs)} evaluaciones exactas evitadas "
+              f"({len(accepted)} pares aceptados, {saved - len(accepted)} descartados).")
+
     # Añadir aristas al grafo para las nubes de puntos combinables
-    for i in range(len(pcds)):
-        for j in range(i + 1, len(pcds)):
-            if check_pc_combinability(pcds[i], pcds[j], threshold):
-                G.add_edge(i, j)
+    for i, j in pairs_to_check:
+        if is_pair_combinable(pcds[i], pcds[j], threshold, combinability_params):
+            G.add_edge(i, j)
 
     return G
 
-def get_largest_combination_component(pcds, threshold):
+def get_largest_combination_component(pcds, threshold, candidate_pairs=None, combinability_params=None,
+                                      prefilter_params=None):
     """
     Obtiene la lista más grande de nubes de puntos combinables.
 
     Parameters:
-        pcds: List[open3d.geometry.PointCloud]
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
             Lista de nubes de puntos.
         threshold: float
             Umbral para determinar la combinabilidad.
+        candidate_pairs: List[Tuple[int, int]]
+            Pares a evaluar (None para evaluar todos los pares).
+        combinability_params: dict
+            Parámetros del método de combinabilidad, ver is_pair_combinable.
+        prefilter_params: dict
+            Parámetros del prefiltro aprendido, ver build_combination_graph.
 
     Returns:
-        largest_component_pcds: List[open3d.geometry.PointCloud]
+        largest_component_pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
             Lista de nubes de puntos en el componente más grande.
     """
     # Construir el grafo de combinabilidad
-    G = build_combination_graph(pcds, threshold)
+    G = build_combination_graph(pcds, threshold, candidate_pairs, combinability_params, prefilter_params)
 
     # Encontrar el componente conectado más grande
     largest_component = max(nx.connected_components(G), key=len)
@@ -82,19 +353,27 @@ def get_largest_combination_component(pcds, threshold):
 
     return largest_component_pcds
 
-def check_all_pc_combinability(pcds, threshold):
+def check_all_pc_combinability(pcds, threshold, candidate_pairs=None, combinability_params=None,
+                               prefilter_params=None):
     """
     Comprueba la combinabilidad de todas las nubes de puntos en una lista.
 
     Parameters:
-        pcds: List[open3d.geometry.PointCloud]
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
             Lista de nubes de puntos.
         threshold: float
             Umbral para determinar la combinabilidad.
+        candidate_pairs: List[Tuple[int, int]]
+            Pares a evaluar (None para evaluar todos los pares).
+        combinability_params: dict
+            Parámetros del método de combinabilidad, ver is_pair_combinable.
+        prefilter_params: dict
+            Parámetros del prefiltro aprendido, ver build_combination_graph.
 
     Returns:
         combinable_pairs: List[Tuple[int, int]]
             Lista de nubes de puntos combinables.
     """
-    combinable_pairs = get_largest_combination_component(pcds, threshold)
+    combinable_pairs = get_largest_combination_component(pcds, threshold, candidate_pairs,
+                                                         combinability_params, prefilter_params)
     return combinable_pairs
\ No newline at end of file
@@ -1,19 +1,39 @@
 import open3d as o3d
 import numpy as np
-from pc_stacking import pairwise_registration
+from parallel_registration import register_pairs
+from workers import resolve_num_workers
+from pose_graph_optimization import sparsify_pose_graph
 
 def full_registration(pcds, max_correspondence_distance_coarse,
-                      max_correspondence_distance_fine):
+                      max_correspondence_distance_fine, cache=None,
+                      num_workers=1, parallel_min_clouds=4, candidate_pairs=None,
+                      registration_params=None, pose_graph_params=None):
     """
     Realiza el registro completo de todas las nubes de puntos en la lista pcds.
 
     Parameters:
-        pcds: List[open3d.geometry.PointCloud]
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
             Lista de nubes de puntos a registrar.
         max_correspondence_distance_coarse: float
             Distancia máxima para buscar correspondencias durante el registro grueso.
         max_correspondence_distance_fine: float
             Distancia máxima para buscar correspondencias durante el registro fino.
+        cache: registration_cache.RegistrationCache
+            Almacén de resultados de registro compartido (None para registrar siempre).
+        num_workers: int
+            Número de procesos para registrar los pares (0 para usar todos los núcleos).
+        parallel_min_clouds: int
+            Cantidad mínima de nubes para registrar en paralelo; por debajo se registra en serie.
+        candidate_pairs: List[Tuple[int, int]]
+            Pares candidatos para los cierres de bucle (None para usar todos los pares).
+            Los pares consecutivos de odometría se registran siempre.
+        registration_params: dict
+            Parámetros del método de registro, ver pc_stacking.compute_pairwise_registration.
+        pose_graph_params: dict
+            Parámetros de la reducción del grafo: "sparsify" y los argumentos de
+            pose_graph_optimization.sparsify_pose_graph, y "drop_gated" para no agregar
+            los cierres de bucle descartados tras el registro grueso (None para conservar
+            todas las aristas). Las aristas de odometría se conservan siempre.
 
     Returns:
         pose_graph: open3d.pipelines.registration.PoseGraph
@@ -31,42 +51,74 @@ def full_registration(pcds, max_correspondence_distance_coarse,
     # Obtiene el número de nubes de puntos en la lista
     n_pcds = len(pcds)
 
-    # Itera sobre todas las combinaciones posibles de pares de nubes de puntos
-    for source_id in range(n_pcds):
-        for target_id in range(source_id + 1, n_pcds):
-            # Realiza el registro entre la nube de puntos fuente y la nube de puntos objetivo
-            transformation_icp, information_icp = pairwise_registration(
-                pcds[source_id], pcds[target_id],
-                max_correspondence_distance_coarse,
-                max_correspondence_distance_fine)
-
-            # Imprime un mensaje indicando la construcción del grafo de poses
-            print("Construyendo el grafo de poses")
-
-            # Caso de odometría: si la nube objetivo es la siguiente en la secuencia
-            if target_id == source_id + 1:
-                # Actualiza la matriz de odometría acumulativa
-                odometry = np.dot(transformation_icp, odometry)
-
-                # Añade un nuevo nodo al grafo de poses con la inversa de la odometría acumulativa como su pose
-                pose_graph.nodes.append(
-                    o3d.pipelines.registration.PoseGraphNode(
-                        np.linalg.inv(odometry)))
-
-                # Añade una arista al grafo de poses que representa la relación de transformación entre las dos nubes de puntos
-                pose_graph.edges.append(
-                    o3d.pipelines.registration.PoseGraphEdge(source_id,
-                                                             target_id,
-                                                             transformation_icp,
-                                                             information_icp,
-                                                             uncertain=False))
-            else:  # Caso de cierre de bucle: si la nube objetivo no es la siguiente en la secuencia
-                # Añade una arista al grafo de poses que representa la relación de transformación entre las dos nubes de puntos
-                # Se marca como incierta porque no es una relación de odometría directa
-                pose_graph.edges.append(
-                    o3d.pipelines.registration.PoseGraphEdge(source_id,
-                                                             target_id,
-                                                             transformation_icp,
-                                                             information_icp,
-                                                             uncertain=True))
+    # Enumera los pares a registrar: todas las combinaciones o, si se proporcionan,
+    # los candidatos más la cadena de odometría
+    if candidate_pairs is None:
+        pairs = [(source_id, target_id)
+                 for source_id in range(n_pcds)
+                 for target_id in range(source_id + 1, n_pcds)]
+    else:
+        odometry_pairs = [(source_id, source_id + 1) for source_id in range(n_pcds - 1)]
+        pairs = sorted(set(odometry_pairs) | set(candidate_pairs))
+
+    # Realiza el registro de todos los pares, en paralelo si hay suficientes nubes
+    workers = resolve_num_workers(num_workers) if n_pcds >= parallel_min_clouds else 1
+    results = register_pairs(pcds, pairs,
+                             max_correspondence_distance_coarse,
+                             max_correspondence_distance_fine,
+                             num_workers=workers, cache=cache,
+                             registration_params=registration_params,
+                             odometry_pairs=[pair for pair in pairs if pair[1] == pair[0] + 1])
+
+    params = dict(pose_graph_params or {})
+    drop_gated = params.pop("drop_gated", False)
+    edge_fitness = []
+    dropped = 0
+
+    # Construye el grafo en el mismo orden que el recorrido en serie
+    for source_id, target_id in pairs:
+        transformation_icp = results[(source_id, target_id)]["transformation"]
+        information_icp = results[(source_id, target_id)]["information"]
+
+        # Imprime un mensaje indicando la construcción del grafo de poses
+        print("Construyendo el grafo de poses")
+
+        # Caso de odometría: si la nube objetivo es la siguiente en la secuencia
+        if target_id == source_id + 1:
+            # Actualiza la matriz de odometría acumulativa
+            odometry = np.dot(transformation_icp, odometry)
+
+            # Añade un nuevo nodo al grafo de poses con la inversa de la odometría acumulativa como su pose
+            pose_graph.nodes.append(
+                o3d.pipelines.registration.PoseGraphNode(
+                    np.linalg.inv(odometry)))
+
+            # Añade una arista al grafo de poses que representa la relación de transformación entre las dos nubes de puntos
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(source_id,
+                                                         target_id,
+                                                         transformation_icp,
+                                                         information_icp,
+                                                         uncertain=False))
+        elif drop_gated and results[(source_id, target_id)].get("gated", False):
+            # Cierre de bucle sin solapamiento tras el registro grueso: no se agrega al grafo
+            dropped += 1
+            continue
+        else:  # Caso de cierre de bucle: si la nube objetivo no es la siguiente en la secuencia
+            # Añade una arista al grafo de poses que representa la relación de transformación entre las dos nubes de puntos
+            # Se marca como incierta porque no es una relación de odometría directa
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(source_id,
+                                                         target_id,
+                                                         transformation_icp,
+                                                         information_icp,
+                                                         uncertain=True))
+        edge_fitness.append(results[(source_id, target_id)]["fitness"])
+
+    if drop_gated:
+        print(f"Cierres de bucle descartados del grafo de poses: {dropped}.")
+
+    # Reducción del grafo: odometría más los cierres de bucle informativos
+    if params.pop("sparsify", False):
+        sparsify_pose_graph(pose_graph, edge_fitness, **params)
     return pose_graph
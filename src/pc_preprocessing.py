@@ -1,4 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+import numpy as np
 import open3d as o3d
+from pc_reader import count_cloud_points
+from tiled_downsampling import tiled_voxel_down_sample, iter_point_blocks
 
 def voxel_down_sample(pcd, voxel_size=0.0):
     """
@@ -32,32 +36,272 @@ def remove_outliers(pcd, nb_neighbors=20, std_ratio=2.0, print_progress=True):
     cl, ind = pcd.remove_statistical_outlier(nb_neighbors=nb_neighbors, std_ratio=std_ratio, print_progress=print_progress)
     return cl, ind
 
+def sample_cloud_points(pcd, sample_size, seed=0):
+    """
+    Toma una muestra aleatoria uniforme de los puntos de una nube.
+
+    Parámetros:
+        pcd (open3d.geometry.PointCloud o str): Nube de puntos, o ruta de su archivo (se lee por bloques).
+        sample_size (int): Cantidad aproximada de puntos de la muestra.
+        seed (int): Semilla del generador aleatorio.
 
-def pc_preprocessing(pcds, voxel_size=0.0, remove_outliers_params=None):
+    Devuelve:
+        numpy.ndarray: Arreglo (S, 3) de puntos de la muestra.
+        int: Cantidad total de puntos de la nube.
     """
-    Realiza preprocesamiento en una lista de nubes de puntos.
+    rng = np.random.default_rng(seed)
+    if not isinstance(pcd, str):
+        points = np.asarray(pcd.points)
+        if len(points) <= sample_size:
+            return points, len(points)
+        return points[rng.choice(len(points), sample_size, replace=False)], len(points)
+
+    num_points = count_cloud_points(pcd)
+    fraction = min(1.0, sample_size / num_points) if num_points else 1.0
+    samples = []
+    total = 0
+    for points, _, _ in iter_point_blocks(pcd, 1 << 20):
+        samples.append(points[rng.random(len(points)) < fraction])
+        total += len(points)
+    return (np.vstack(samples) if samples else np.zeros((0, 3))), total
+
+def estimate_voxel_size(points, target_points, levels=20):
+    """
+    Estima el tamaño de voxel con el que una nube conserva aproximadamente target_points puntos.
+
+    En lugar de reducir la nube repetidas veces, los puntos se cuantizan una
+    sola vez en la grilla más fina de un octree; la cantidad de voxeles
+    ocupados en cada nivel se obtiene desplazando los índices, se busca por
+    bisección el nivel que encierra target_points y el tamaño se interpola
+    en escala logarítmica entre los dos niveles vecinos.
 
     Parámetros:
-        pcds (list): Lista de nubes de puntos de entrada.
+        points (numpy.ndarray): Arreglo (N, 3) de puntos (o una muestra uniforme de la nube).
+        target_points (int): Cantidad de puntos buscada.
+        levels (int): Cantidad de niveles del octree (a lo sumo 21).
+
+    Devuelve:
+        float: Tamaño de voxel estimado (0.0 si la nube ya tiene a lo sumo target_points puntos).
+    """
+    if len(points) <= target_points:
+        return 0.0
+    min_bound = points.min(axis=0)
+    extent = float((points.max(axis=0) - min_bound).max())
+    if extent <= 0.0:
+        return 0.0
+    finest = extent / (2 ** levels - 1)
+    index = np.clip(np.floor((points - min_bound) / finest).astype(np.int64), 0, 2 ** levels - 1)
+
+    occupancy = {}
+    def occupied(level):
+        # Voxeles ocupados en un nivel: índices de la grilla fina desplazados y empaquetados en un entero
+        if level not in occupancy:
+            keys = index >> level
+            occupancy[level] = len(np.unique((keys[:, 0] << (2 * levels)) | (keys[:, 1] << levels) | keys[:, 2]))
+        return occupancy[level]
+
+    if occupied(0) <= target_points:
+        return finest
+    low, high = 0, levels
+    while high - low > 1:
+        middle = (low + high) // 2
+        if occupied(middle) > target_points:
+            low = middle
+        else:
+            high = middle
+
+    log_low, log_high = np.log(occupied(low)), np.log(occupied(high))
+    t = (log_low - np.log(target_points)) / (log_low - log_high)
+    return finest * 2 ** (low + t)
+
+def adaptive_voxel_sizes(pcds, target_points, sample_size=0):
+    """
+    Elige un tamaño de voxel por nube para que cada una quede cerca de target_points puntos.
+
+    La densidad se estima sobre una muestra uniforme de cada nube; con una
+    muestra de varias veces target_points puntos, casi todos los voxeles del
+    tamaño buscado conservan al menos un punto y la estimación no se sesga.
+
+    Parámetros:
+        pcds (list): Lista de nubes de puntos (o rutas de las nubes demasiado grandes).
+        target_points (int): Cantidad de puntos buscada por nube.
+        sample_size (int): Puntos de la muestra de cada nube (0 para 8 * target_points).
+
+    Devuelve:
+        list: Tamaño de voxel de cada nube (0.0 para las nubes que no necesitan reducirse).
+    """
+    sample_size = sample_size or 8 * target_points
+    voxel_sizes = []
+    for i, pcd in enumerate(pcds):
+        points, num_points = sample_cloud_points(pcd, sample_size, seed=i)
+        voxel = estimate_voxel_size(points, target_points) if num_points > target_points else 0.0
+        voxel_sizes.append(voxel)
+        print(f"Nube {i}: {num_points} puntos, voxel adaptativo {voxel:.4g}.")
+    return voxel_sizes
+
+def reference_voxel_size(voxel_sizes, default):
+    """
+    Devuelve el tamaño de voxel de referencia (la mediana de los tamaños elegidos) para el registro.
+
+    Parámetros:
+        voxel_sizes (list): Tamaño de voxel de cada nube, ver adaptive_voxel_sizes.
+        default (float): Tamaño usado si ninguna nube se redujo.
+
+    Devuelve:
+        float: Tamaño de voxel de referencia.
+    """
+    chosen = [voxel for voxel in voxel_sizes if voxel > 0.0]
+    return float(np.median(chosen)) if chosen else default
+
+def preprocess_cloud(pcd, voxel_size=0.0, remove_outliers_params=None, max_memory_mb=512):
+    """
+    Aplica el muestreo por voxeles y la eliminación de puntos atípicos a una nube de puntos.
+
+    Parámetros:
+        pcd (open3d.geometry.PointCloud o str): Nube de puntos de entrada, o ruta de una nube
+            demasiado grande para cargarla completa.
         voxel_size (float): Tamaño del voxel para el muestreo (0.0 por defecto para no muestrear).
         remove_outliers_params (dict): Parámetros para la función remove_outliers.
+        max_memory_mb (float): Memoria máxima en MB de la reducción por mosaicos de una ruta.
 
     Devuelve:
-        list: Lista de nubes de puntos preprocesadas.
+        open3d.geometry.PointCloud: Nube de puntos preprocesada.
     """
-    processed_pcds = []
-    for pcd in pcds:
-        # Obtener el tipo de datos de la nube de puntos original
-        pcd_type = type(pcd)
-        
+    # Las nubes que no caben en memoria se reducen por mosaicos directamente desde el archivo
+    if isinstance(pcd, str) and voxel_size > 0.0:
+        pcd_processed = tiled_voxel_down_sample(pcd, voxel_size, max_memory_mb)
+    elif isinstance(pcd, str):
+        pcd_processed = o3d.io.read_point_cloud(pcd)
+    else:
         # Aplicar voxel_down_sample si es necesario
         pcd_processed = voxel_down_sample(pcd, voxel_size=voxel_size)
-        
-        # Aplicar remove_outliers si se proporcionan parámetros
-        if remove_outliers_params is not None:
-            pcd_processed, indices = remove_outliers(pcd_processed, **remove_outliers_params)
-            pcd_processed = o3d.geometry.PointCloud(pcd_processed)
-            
-        processed_pcds.append(pcd_processed)
 
+    # Aplicar remove_outliers si se proporcionan parámetros; la nube devuelta ya es nueva
+    if remove_outliers_params is not None:
+        pcd_processed, indices = remove_outliers(pcd_processed, **remove_outliers_params)
+    return pcd_processed
+
+def cloud_to_arrays(pcd):
+    """
+    Extrae los arreglos de coordenadas, normales y colores de una nube de puntos.
+
+    Parámetros:
+        pcd (open3d.geometry.PointCloud): Nube de puntos.
+
+    Devuelve:
+        tuple: Arreglos (N, 3) de puntos, normales y colores (None si la nube no los tiene).
+    """
+    return (np.asarray(pcd.points),
+            np.asarray(pcd.normals) if pcd.has_normals() else None,
+            np.asarray(pcd.colors) if pcd.has_colors() else None)
+
+def arrays_to_cloud(points, normals=None, colors=None):
+    """
+    Construye una nube de puntos a partir de sus arreglos, ver cloud_to_arrays.
+
+    Parámetros:
+        points (numpy.ndarray): Arreglo (N, 3) de coordenadas.
+        normals (numpy.ndarray): Arreglo (N, 3) de normales o None.
+        colors (numpy.ndarray): Arreglo (N, 3) de colores o None.
+
+    Devuelve:
+        open3d.geometry.PointCloud: Nube de puntos.
+    """
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    if normals is not None:
+        pcd.normals = o3d.utility.Vector3dVector(normals)
+    if colors is not None:
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+    return pcd
+
+def _preprocess_job(index, arrays, voxel_size, remove_outliers_params, max_memory_mb):
+    """
+    Preprocesa una nube de puntos (sus arreglos o la ruta del archivo) dentro de un proceso trabajador.
+    """
+    pcd = arrays if isinstance(arrays, str) else arrays_to_cloud(*arrays)
+    pcd_processed = preprocess_cloud(pcd, voxel_size, remove_outliers_params, max_memory_mb)
+    return index, cloud_to_arrays(pcd_processed)
+
+def pc_preprocessing(pcds, voxel_size=0.0, remove_outliers_params=None, cache=None,
+                     num_workers=1, max_inflight_mb=512, max_cloud_mb=512, sources=None):
+    """
+    Realiza preprocesamiento en una lista de nubes de puntos.
+
+    Con varios procesos, cada nube se envía a un trabajador; la cantidad de
+    datos enviados y aún no procesados se limita a max_inflight_mb, y el
+    resultado conserva el orden de entrada.
+
+    Parámetros:
+        pcds (list): Lista de nubes de puntos de entrada.
+        voxel_size (float o list): Tamaño del voxel para el muestreo (0.0 por defecto para no muestrear),
+            o una lista con el tamaño de cada nube (ver adaptive_voxel_sizes).
+        remove_outliers_params (dict): Parámetros para la función remove_outliers.
+        cache (PreprocessingCache): Almacén de nubes preprocesadas (None para no usarlo).
+        num_workers (int): Número de procesos (1 para preprocesar en serie).
+        max_inflight_mb (float): Memoria máxima en MB de las nubes enviadas a los trabajadores a la vez.
+        max_cloud_mb (float): Memoria máxima en MB de la reducción por mosaicos de las nubes dadas por su ruta.
+        sources (list): Rutas de los archivos de las nubes, para que las llaves del almacén dependan
+            del contenido de los archivos y no de las nubes en memoria (None para usar las nubes).
+
+    Las nubes dadas por su ruta (ver pc_reader.load_point_clouds) se reducen
+    por mosaicos sin cargarlas completas en memoria.
+
+    Devuelve:
+        list: Lista de nubes de puntos preprocesadas.
+    """
+    processed_pcds = [None] * len(pcds)
+    voxel_sizes = list(voxel_size) if isinstance(voxel_size, (list, tuple)) else [voxel_size] * len(pcds)
+    keys = {}
+
+    # Reutilizar las nubes preprocesadas que ya se calcularon con los mismos parámetros
+    if cache is not None:
+        for i, pcd in enumerate(pcds):
+            keys[i] = cache.make_key(pcd, voxel_sizes[i], remove_outliers_params,
+                                     sources[i] if sources is not None else None)
+            processed_pcds[i] = cache.get(keys[i])
+    pending = [i for i in range(len(pcds)) if processed_pcds[i] is None]
+
+    if num_workers <= 1 or len(pending) <= 1:
+        for i in pending:
+            processed_pcds[i] = preprocess_cloud(pcds[i], voxel_sizes[i], remove_outliers_params, max_cloud_mb)
+    else:
+        print(f"Preprocesando {len(pending)} nubes con {num_workers} procesos...")
+        max_inflight = max_inflight_mb * 1024 ** 2
+        inflight = {}
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            for i in pending:
+                if isinstance(pcds[i], str):
+                    # El trabajador lee la nube por bloques; su memoria está acotada por max_cloud_mb
+                    arrays = pcds[i]
+                    size = max_cloud_mb * 1024 ** 2
+                else:
+                    arrays = cloud_to_arrays(pcds[i])
+                    size = sum(array.nbytes for array in arrays if array is not None)
+                # Esperar a que terminen trabajos anteriores si se supera el límite de memoria
+                while inflight and sum(inflight.values()) + size > max_inflight:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index, result = future.result()
+                        processed_pcds[index] = arrays_to_cloud(*result)
+                        del inflight[future]
+                future = executor.submit(_preprocess_job, i, arrays, voxel_sizes[i], remove_outliers_params,
+                                         max_cloud_mb)
+                inflight[future] = size
+            for future in as_completed(inflight):
+                index, result = future.result()
+                processed_pcds[index] = arrays_to_cloud(*result)
+
+    if cache is not None:
+        for i in pending:
+            cache.put(keys[i], processed_pcds[i])
+        cache.evict()
+        cache.report()
+
+    # Reporte de la reducción de puntos de cada nube
+    for i, (pcd, pcd_processed) in enumerate(zip(pcds, processed_pcds)):
+        points_in = count_cloud_points(pcd) if isinstance(pcd, str) else len(pcd.points)
+        points_out = len(pcd_processed.points)
+        ratio = points_out / points_in if points_in else 1.0
+        print(f"Nube {i}: {points_in} -> {points_out} puntos ({ratio:.1%}).")
     return processed_pcds
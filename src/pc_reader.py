@@ -1,50 +1,325 @@
 import os
+import re
 import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import open3d as o3d
 
-def load_point_clouds(config_file):
+# Tipos de datos de los campos PCD según (TYPE, SIZE)
+PCD_TYPES = {
+    ("F", 4): "<f4", ("F", 8): "<f8",
+    ("U", 1): "<u1", ("U", 2): "<u2", ("U", 4): "<u4", ("U", 8): "<u8",
+    ("I", 1): "<i1", ("I", 2): "<i2", ("I", 4): "<i4", ("I", 8): "<i8"
+}
+
+# Tipos de las propiedades de archivos .ply
+PLY_TYPES = {
+    "char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"
+}
+
+def natural_sort_key(name):
+    """
+    Llave de ordenamiento natural, para que "cloud_bin_2" quede antes que "cloud_bin_10".
+
+    Parámetros:
+        name (str): Nombre del archivo.
+
+    Devuelve:
+        list: Partes del nombre, con los números convertidos a enteros.
+    """
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+def read_pcd_header(path):
+    """
+    Lee el encabezado de un archivo .pcd.
+
+    Parámetros:
+        path (str): Ruta del archivo .pcd.
+
+    Devuelve:
+        dict: Campos del encabezado (listas de cadenas) y "offset", la posición en bytes
+        donde empiezan los datos.
+    """
+    header = {}
+    with open(path, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            parts = line.decode("ascii", errors="replace").split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            header[parts[0].upper()] = parts[1:]
+            if parts[0].upper() == "DATA":
+                header["offset"] = f.tell()
+                break
+    return header
+
+def read_ply_header(path):
+    """
+    Lee el encabezado de un archivo .ply.
+
+    Parámetros:
+        path (str): Ruta del archivo .ply.
+
+    Devuelve:
+        dict: Formato, cantidad de vértices, propiedades del vértice, "offset" de los datos
+        y "vertex_first" (True si los vértices son el primer elemento).
+    """
+    header = {"format": None, "vertex_count": 0, "properties": [], "vertex_first": False}
+    element = None
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b"ply":
+            return header
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            parts = line.decode("ascii", errors="replace").split()
+            if not parts:
+                continue
+            if parts[0] == "format":
+                header["format"] = parts[1]
+            elif parts[0] == "element":
+                if element is None:
+                    header["vertex_first"] = parts[1] == "vertex"
+                element = parts[1]
+                if element == "vertex":
+                    header["vertex_count"] = int(parts[2])
+            elif parts[0] == "property" and element == "vertex":
+                header["properties"].append((parts[-1], parts[1]))
+            elif parts[0] == "end_header":
+                header["offset"] = f.tell()
+                break
+    return header
+
+def pcd_dtype(header):
+    """
+    Construye el tipo estructurado de numpy de un registro de un archivo .pcd binario.
+
+    Parámetros:
+        header (dict): Encabezado leído con read_pcd_header.
+
+    Devuelve:
+        numpy.dtype: Tipo de un punto, con un campo por cada campo del archivo.
+    """
+    fields = []
+    for i, (name, size, type_, count) in enumerate(zip(header["FIELDS"], header["SIZE"],
+                                                       header["TYPE"], header["COUNT"])):
+        # Los campos de relleno "_" pueden repetirse; se renombran para que sean únicos
+        field_name = f"_{i}" if name == "_" else name
+        dtype = PCD_TYPES[(type_.upper(), int(size))]
+        fields.append((field_name, dtype) if int(count) == 1 else (field_name, dtype, (int(count),)))
+    return np.dtype(fields)
+
+def is_mappable_pcd(header):
+    """
+    Indica si un archivo .pcd puede proyectarse en memoria (datos binarios sin comprimir con x, y, z).
+
+    Parámetros:
+        header (dict): Encabezado leído con read_pcd_header.
+
+    Devuelve:
+        bool: True si el archivo puede leerse con read_binary_pcd.
+    """
+    return ("offset" in header and header["DATA"][0].lower() == "binary" and
+            all(name in header.get("FIELDS", []) for name in ("x", "y", "z")) and
+            all((t.upper(), int(s)) in PCD_TYPES
+                for t, s in zip(header.get("TYPE", []), header.get("SIZE", []))))
+
+def unpack_rgb(values):
+    """
+    Convierte el campo rgb empaquetado de PCD en colores en [0, 1].
+
+    Parámetros:
+        values (numpy.ndarray): Valores del campo rgb (4 bytes por punto).
+
+    Devuelve:
+        numpy.ndarray: Arreglo (N, 3) de colores.
+    """
+    # Formato rgb de PCD: tres bytes empaquetados en 32 bits
+    packed = np.ascontiguousarray(values).view(np.uint32)
+    return np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=1) / 255.0
+
+def count_cloud_points(path):
+    """
+    Devuelve la cantidad de puntos de un archivo a partir de su encabezado.
+
+    Parámetros:
+        path (str): Ruta del archivo .pcd o .ply.
+
+    Devuelve:
+        int: Cantidad de puntos, o None si el encabezado no la indica.
+    """
+    if path.endswith(".pcd"):
+        header = read_pcd_header(path)
+        return int(header["POINTS"][0]) if "POINTS" in header else None
+    if path.endswith(".ply"):
+        return read_ply_header(path)["vertex_count"]
+    return None
+
+def estimate_cloud_bytes(path):
+    """
+    Estima la memoria que ocupa una nube de puntos cargada por completo (coordenadas float64).
+
+    Parámetros:
+        path (str): Ruta del archivo .pcd o .ply.
+
+    Devuelve:
+        int: Memoria estimada en bytes (el tamaño del archivo si no se conoce la cantidad de puntos).
+    """
+    num_points = count_cloud_points(path)
+    if num_points is None:
+        return os.path.getsize(path)
+    return num_points * 3 * 8
+
+def read_binary_pcd(path, header):
+    """
+    Lee un archivo .pcd binario proyectando la sección de datos en memoria.
+
+    Los campos se leen directamente del archivo proyectado con numpy, sin
+    interpretar el archivo completo en una copia intermedia.
+
+    Parámetros:
+        path (str): Ruta del archivo .pcd.
+        header (dict): Encabezado leído con read_pcd_header.
+
+    Devuelve:
+        open3d.geometry.PointCloud: Nube de puntos con coordenadas y, si existen, normales y colores.
+    """
+    dtype = pcd_dtype(header)
+    num_points = int(header["POINTS"][0])
+    pcd = o3d.geometry.PointCloud()
+    if num_points == 0:
+        return pcd
+
+    data = np.memmap(path, dtype=dtype, mode='r', offset=header["offset"], shape=(num_points,))
+
+    def stack(names):
+        array = np.empty((num_points, 3), dtype=np.float64)
+        for column, name in enumerate(names):
+            array[:, column] = data[name]
+        return array
+
+    pcd.points = o3d.utility.Vector3dVector(stack(("x", "y", "z")))
+    if all(name in dtype.names for name in ("normal_x", "normal_y", "normal_z")):
+        pcd.normals = o3d.utility.Vector3dVector(stack(("normal_x", "normal_y", "normal_z")))
+    for name in ("rgb", "rgba"):
+        if name in dtype.names and dtype[name].itemsize == 4 and dtype[name].shape == ():
+            pcd.colors = o3d.utility.Vector3dVector(unpack_rgb(data[name]))
+            break
+    del data
+    return pcd
+
+def read_point_cloud(path):
+    """
+    Lee una nube de puntos; los .pcd binarios se proyectan en memoria y el resto se lee con Open3D.
+
+    Parámetros:
+        path (str): Ruta del archivo.
+
+    Devuelve:
+        open3d.geometry.PointCloud: Nube de puntos leída.
+    """
+    if path.endswith(".pcd"):
+        header = read_pcd_header(path)
+        if is_mappable_pcd(header):
+            return read_binary_pcd(path, header)
+    return o3d.io.read_point_cloud(path)
+
+def list_point_cloud_files(input_path):
+    """
+    Lista los archivos .pcd de una carpeta en orden natural por nombre.
+
+    Parámetros:
+        input_path (str): Carpeta de las nubes de puntos.
+
+    Devuelve:
+        list: Nombres de los archivos .pcd, ordenados.
+    """
+    return sorted((file for file in os.listdir(input_path) if file.endswith(".pcd")),
+                  key=natural_sort_key)
+
+def read_point_clouds(paths, num_workers=None, max_cloud_mb=0):
+    """
+    Lee varias nubes de puntos en paralelo con un grupo de hilos, conservando el orden.
+
+    Parámetros:
+        paths (list): Rutas de los archivos.
+        num_workers (int): Cantidad de hilos de lectura (None o 0 para usar todos los núcleos).
+        max_cloud_mb (float): Memoria máxima en MB de una nube cargada por completo; las nubes más
+            grandes no se leen y se devuelve su ruta para reducirlas por mosaicos (0 para leer todas).
+
+    Devuelve:
+        list: Nubes de puntos leídas (o rutas de las nubes demasiado grandes), en el mismo orden que paths.
+    """
+    # Las nubes que no caben en memoria se reducen por mosaicos en el preprocesamiento
+    large = set()
+    if max_cloud_mb > 0:
+        large = {path for path in paths if estimate_cloud_bytes(path) > max_cloud_mb * 1024 ** 2}
+        for path in sorted(large):
+            print(f"La nube {path} supera {max_cloud_mb} MB; se reducirá por mosaicos sin cargarla completa.")
+    small = [path for path in paths if path not in large]
+    if not small:
+        return list(paths)
+
+    # map conserva el orden de entrada aunque la lectura sea concurrente
+    workers = max(1, min(num_workers or os.cpu_count() or 1, len(small)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = dict(zip(small, executor.map(read_point_cloud, small)))
+    return [loaded.get(path, path) for path in paths]
+
+def load_point_clouds(config_file, num_workers=None, return_files=False, max_cloud_mb=0):
     """
     Carga nubes de puntos desde archivos PCD en una carpeta especificada en un archivo de configuración JSON.
 
+    Los archivos se ordenan de forma natural por nombre (la cadena de odometría
+    del registro depende de este orden) y se leen en paralelo con un grupo de hilos.
+
     Parámetros:
         config_file (str): Ruta al archivo de configuración JSON.
-        voxel_size (float): Tamaño del voxel para el muestreo (0.0 por defecto para no muestrear).
+        num_workers (int): Cantidad de hilos de lectura (None o 0 para usar todos los núcleos).
+        return_files (bool): Si es True, devuelve también los nombres de los archivos leídos.
+        max_cloud_mb (float): Memoria máxima en MB de una nube cargada por completo; las nubes más
+            grandes no se leen y se devuelve su ruta para reducirlas por mosaicos (0 para leer todas).
 
     Devuelve:
-        list: Lista de nubes de puntos cargadas.
+        list: Lista de nubes de puntos cargadas (o rutas de las nubes demasiado grandes).
+        list: Nombres de los archivos, en el mismo orden (solo si return_files es True).
     """
+    empty = ([], []) if return_files else []
     try:
         with open(config_file, 'r') as f:
             config = json.load(f)
-        
+
         input_path = config.get("input_path")
         if input_path is None:
             print("Error: No se proporcionó la ruta de la carpeta en el archivo de configuración.")
-            return []
+            return empty
 
         if not os.path.isdir(input_path):
             print(f"Error: La ruta especificada '{input_path}' no es un directorio válido.")
-            return []
-        
+            return empty
+
         output_path = config.get("output_file")
-        
+
         print(f"Éxito en la lectura del archivo de configuración: La ruta especificada para nubes de puntos de entrada es: '{input_path}'.")
         print(f"Éxito en la lectura del archivo de configuración: La ruta especificada para la nube de puntos de salida es: '{output_path}'.")
-        
-        pcds = []
-        for file in os.listdir(input_path):
-            if file.endswith(".pcd"):
-                pcd_path = os.path.join(input_path, file)
-                pcd = o3d.io.read_point_cloud(pcd_path)
-                pcds.append(pcd)
+
+        files = list_point_cloud_files(input_path)
+        paths = [os.path.join(input_path, file) for file in files]
+        pcds = read_point_clouds(paths, num_workers, max_cloud_mb)
 
         if not pcds:
             print("Advertencia: No se encontraron archivos PCD en la carpeta especificada.")
-        return pcds
+        return (pcds, files) if return_files else pcds
 
     except FileNotFoundError:
         print(f"Error: No se encontró el archivo de configuración {config_file}.")
-        return []
+        return empty
     except json.JSONDecodeError:
         print(f"Error: No se pudo analizar el archivo JSON {config_file}.")
-        return []
+        return empty
@@ -1,44 +1,379 @@
+import time
 import open3d as o3d
 import numpy as np
+from registration_cache import cloud_hash
+from prepared_cloud import PreparedCloud, NORMALS_SEARCH_PARAM, as_point_cloud, voxel_pyramid
+from profiler import profiling_enabled
 
-def pairwise_registration(source, target, max_correspondence_distance_coarse,
-                          max_correspondence_distance_fine):
+def registration_key(cache, source_hash, target_hash, max_correspondence_distance_coarse,
+                     max_correspondence_distance_fine, registration_params=None):
     """
-    Realiza el registro de dos nubes de puntos utilizando el método de registro de ICP punto a plano.
+    Construye la llave con la que se guarda el registro de un par en el almacén.
+
+    Parameters:
+        cache: registration_cache.RegistrationCache
+            Almacén de resultados de registro.
+        source_hash: str
+            Hash del contenido de la nube de puntos fuente.
+        target_hash: str
+            Hash del contenido de la nube de puntos objetivo.
+        max_correspondence_distance_coarse: float
+            Distancia máxima para buscar correspondencias durante el registro grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante el registro fino.
+        registration_params: dict
+            Parámetros del método de registro, ver compute_pairwise_registration.
+
+    Returns:
+        key: str
+            Llave del par en el almacén.
+    """
+    # Los valores por defecto no forman parte de la llave, para conservar las llaves anteriores
+    defaults = {"mode": "two_pass", "init": "identity", "gate_fitness": 0.0, "gate_rmse": 0.0,
+                "track_iterations": False}
+    params = {key: value for key, value in (registration_params or {}).items()
+              if defaults.get(key) != value}
+    if not params:
+        return cache.make_key(source_hash, target_hash,
+                              max_correspondence_distance_coarse,
+                              max_correspondence_distance_fine, "point_to_plane")
+    return cache.make_key(source_hash, target_hash,
+                          max_correspondence_distance_coarse,
+                          max_correspondence_distance_fine, "point_to_plane",
+                          sorted(params.items()))
+
+def resolve_registration_params(registration_params, voxel_size):
+    """
+    Completa los parámetros del método de registro con el tamaño del voxel.
+
+    El modo multiescala y la inicialización global necesitan "voxel_size";
+    si no está configurado, se usa el del preprocesamiento. Con el perfilado
+    activo se cuentan las iteraciones del ICP, salvo que se configure lo contrario.
+
+    Parameters:
+        registration_params: dict
+            Parámetros del método de registro, ver compute_pairwise_registration (no se modifican).
+        voxel_size: float
+            Tamaño del voxel de las nubes preprocesadas.
+
+    Returns:
+        registration_params: dict
+            Copia de los parámetros, con "voxel_size" si el método lo necesita.
+    """
+    params = dict(registration_params or {})
+    if params.get("mode") == "multiscale" or params.get("init", "identity") != "identity":
+        params.setdefault("voxel_size", voxel_size)
+    if profiling_enabled():
+        params.setdefault("track_iterations", True)
+    return params
+
+def _icp_with_iterations(source, target, max_correspondence_distance, init,
+                         criteria, track_iterations):
+    """
+    Aplica ICP punto a plano y, si se solicita, cuenta las iteraciones ejecutadas.
+
+    Open3D no expone la cantidad de iteraciones, por lo que para contarlas se
+    aplica una iteración a la vez con el mismo criterio de convergencia relativo.
+    """
+    estimation = o3d.pipelines.registration.TransformationEstimationPointToPlane()
+    if not track_iterations:
+        result = o3d.pipelines.registration.registration_icp(
+            source, target, max_correspondence_distance, init, estimation, criteria)
+        return result, None
+
+    single_step = o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=1)
+    result = None
+    transformation = init
+    iterations = 0
+    while iterations < criteria.max_iteration:
+        step = o3d.pipelines.registration.registration_icp(
+            source, target, max_correspondence_distance, transformation, estimation, single_step)
+        iterations += 1
+        converged = (result is not None and
+                     abs(result.fitness - step.fitness) < criteria.relative_fitness and
+                     abs(result.inlier_rmse - step.inlier_rmse) < criteria.relative_rmse)
+        result = step
+        transformation = step.transformation
+        if converged:
+            break
+    return result, iterations
+
+def _pass_stats(max_correspondence_distance, iterations, start, icp_result):
+    """
+    Resume una pasada de ICP con el mismo formato que los niveles de multiscale_registration.
+    """
+    return {
+        "distance": float(max_correspondence_distance),
+        "iterations": iterations,
+        "time": time.perf_counter() - start,
+        "fitness": icp_result.fitness,
+        "inlier_rmse": icp_result.inlier_rmse
+    }
+
+def is_hopeless(icp_result, gate_fitness=0.0, gate_rmse=0.0):
+    """
+    Indica si el registro grueso de un par no alcanza los umbrales de calidad.
+
+    Parameters:
+        icp_result: open3d.pipelines.registration.RegistrationResult
+            Resultado del registro grueso.
+        gate_fitness: float
+            Fitness mínimo (0.0 para no exigirlo).
+        gate_rmse: float
+            RMSE máximo de los inliers (0.0 para no exigirlo).
+
+    Returns:
+        hopeless: bool
+            True si el par no debe pasar al registro fino.
+    """
+    return icp_result.fitness < gate_fitness or (gate_rmse > 0.0 and icp_result.inlier_rmse > gate_rmse)
+
+def gated_result(icp_result):
+    """
+    Construye el resultado de un par descartado tras el registro grueso.
+
+    La matriz de información es nula: sin el registro fino no se calcula, y
+    una arista con información nula no aporta a la optimización del grafo.
+    """
+    return {
+        "transformation": icp_result.transformation,
+        "information": np.zeros((6, 6)),
+        "fitness": icp_result.fitness,
+        "inlier_rmse": icp_result.inlier_rmse,
+        "gated": True
+    }
+
+def multiscale_registration(source, target, max_correspondence_distance_coarse,
+                            max_correspondence_distance_fine, voxel_size, levels=3,
+                            max_iterations=None, relative_fitness=1e-6, relative_rmse=1e-6,
+                            track_iterations=False, init=None, gate_fitness=0.0, gate_rmse=0.0):
+    """
+    Aplica ICP punto a plano sobre una pirámide de voxeles, del nivel más grueso al más fino.
+
+    Cada nivel usa su propio criterio de convergencia (con salida temprana) y
+    una distancia de correspondencia que decrece geométricamente desde la
+    distancia gruesa hasta la fina.
 
     Parameters:
-        source: open3d.geometry.PointCloud
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
             La nube de puntos fuente que se registrará a la nube de puntos objetivo.
-        target: open3d.geometry.PointCloud
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
             La nube de puntos objetivo a la cual se registrará la nube de puntos fuente.
+        max_correspondence_distance_coarse: float
+            Distancia máxima de correspondencia en el nivel más grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima de correspondencia en el nivel más fino.
+        voxel_size: float
+            Tamaño del voxel del nivel más fino (el del preprocesamiento).
+        levels: int
+            Cantidad de niveles de la pirámide.
+        max_iterations: List[int]
+            Máximo de iteraciones por nivel, del más grueso al más fino (30 por nivel por defecto).
+        relative_fitness: float
+            Cambio relativo de fitness por debajo del cual un nivel converge.
+        relative_rmse: float
+            Cambio relativo de RMSE por debajo del cual un nivel converge.
+        track_iterations: bool
+            Si es True, cuenta las iteraciones de cada nivel (más lento).
+        init: numpy.ndarray
+            Transformación inicial del nivel más grueso (None para la identidad).
+        gate_fitness: float
+            Fitness mínimo del nivel más grueso; por debajo se omiten los demás niveles, ver is_hopeless.
+        gate_rmse: float
+            RMSE máximo del nivel más grueso (0.0 para no exigirlo).
+
+    Returns:
+        result: dict
+            Diccionario con "transformation", "information", "fitness", "inlier_rmse",
+            "gated" y "levels", una lista con el tamaño de voxel, la distancia, las
+            iteraciones, el tiempo, el fitness y el RMSE de cada nivel.
+    """
+    if max_iterations is None:
+        max_iterations = [30] * levels
+
+    # Las nubes preparadas guardan su pirámide para reutilizarla en todos sus pares
+    pyramids = []
+    for cloud in (source, target):
+        if isinstance(cloud, PreparedCloud):
+            pyramids.append(cloud.pyramid(voxel_size, levels))
+        else:
+            pyramids.append(voxel_pyramid(cloud, voxel_size, levels))
+    source_pyramid, target_pyramid = pyramids
+    distances = np.geomspace(max_correspondence_distance_coarse, max_correspondence_distance_fine, levels)
+
+    transformation = np.identity(4) if init is None else init
+    level_stats = []
+    for level in range(levels):
+        start = time.perf_counter()
+        criteria = o3d.pipelines.registration.ICPConvergenceCriteria(
+            relative_fitness=relative_fitness,
+            relative_rmse=relative_rmse,
+            max_iteration=max_iterations[level])
+        icp_result, iterations = _icp_with_iterations(
+            source_pyramid[level], target_pyramid[level], distances[level],
+            transformation, criteria, track_iterations)
+        transformation = icp_result.transformation
+
+        level_stats.append({
+            "voxel_size": voxel_size * 2 ** (levels - 1 - level),
+            "distance": float(distances[level]),
+            "points": len(source_pyramid[level].points),
+            "iterations": iterations,
+            "time": time.perf_counter() - start,
+            "fitness": icp_result.fitness,
+            "inlier_rmse": icp_result.inlier_rmse
+        })
+        print(f"Nivel {level}: voxel {level_stats[-1]['voxel_size']:.4f}, "
+              f"iteraciones {iterations}, tiempo {level_stats[-1]['time']:.3f} s, "
+              f"fitness {icp_result.fitness:.4f}, RMSE {icp_result.inlier_rmse:.4f}")
+
+        # Un par sin solapamiento en el nivel más grueso no mejora en los niveles finos
+        if level == 0 and is_hopeless(icp_result, gate_fitness, gate_rmse):
+            print("Par descartado tras el nivel más grueso.")
+            return dict(gated_result(icp_result), levels=level_stats)
+
+    information_icp = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+        source_pyramid[-1], target_pyramid[-1], max_correspondence_distance_fine, transformation)
+
+    return {
+        "transformation": transformation,
+        "information": information_icp,
+        "fitness": icp_result.fitness,
+        "inlier_rmse": icp_result.inlier_rmse,
+        "gated": False,
+        "levels": level_stats
+    }
+
+def _fpfh_features(cloud, voxel_size):
+    """
+    Devuelve la nube con normales y sus descriptores FPFH, reutilizando los de una nube preparada.
+    """
+    if isinstance(cloud, PreparedCloud):
+        return cloud.pcd, cloud.features()
+    pcd = o3d.geometry.PointCloud(cloud)
+    pcd.estimate_normals(search_param=NORMALS_SEARCH_PARAM)
+    fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+        pcd, o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 5, max_nn=100))
+    return pcd, fpfh
+
+def global_registration(source, target, voxel_size, method="ransac"):
+    """
+    Estima una transformación inicial a partir de correspondencias de descriptores FPFH.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos fuente (reducida por voxeles).
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos objetivo (reducida por voxeles).
+        voxel_size: float
+            Tamaño del voxel del preprocesamiento, usado para los radios y distancias.
+        method: str
+            "ransac" (RANSAC sobre correspondencias FPFH) o "fgr" (Fast Global Registration).
+
+    Returns:
+        transformation: numpy.ndarray
+            Transformación inicial estimada.
+    """
+    source_pcd, source_fpfh = _fpfh_features(source, voxel_size)
+    target_pcd, target_fpfh = _fpfh_features(target, voxel_size)
+
+    if method == "ransac":
+        distance_threshold = voxel_size * 1.5
+        result = o3d.pipelines.registration.registration_ransac_based_on_feature_matching(
+            source_pcd, target_pcd, source_fpfh, target_fpfh, True, distance_threshold,
+            o3d.pipelines.registration.TransformationEstimationPointToPoint(False), 3,
+            [o3d.pipelines.registration.CorrespondenceCheckerBasedOnEdgeLength(0.9),
+             o3d.pipelines.registration.CorrespondenceCheckerBasedOnDistance(distance_threshold)],
+            o3d.pipelines.registration.RANSACConvergenceCriteria(100000, 0.999))
+    elif method == "fgr":
+        result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+            source_pcd, target_pcd, source_fpfh, target_fpfh,
+            o3d.pipelines.registration.FastGlobalRegistrationOption(
+                maximum_correspondence_distance=voxel_size * 0.5))
+    else:
+        raise ValueError(f"Método de inicialización desconocido: '{method}'.")
+
+    print(f"Inicialización global ({method}): fitness {result.fitness:.4f}, RMSE {result.inlier_rmse:.4f}")
+    return result.transformation
+
+def compute_pairwise_registration(source, target, max_correspondence_distance_coarse,
+                                  max_correspondence_distance_fine, registration_params=None):
+    """
+    Aplica ICP punto a plano grueso y fino entre dos nubes de puntos.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos fuente que se registrará a la nube de puntos objetivo.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos objetivo a la cual se registrará la nube de puntos fuente.
+            Si no está preparada, las normales se estiman sobre una copia.
         max_correspondence_distance_coarse: float
             Distancia máxima para buscar correspondencias durante el registro grueso.
         max_correspondence_distance_fine: float
             Distancia máxima para buscar correspondencias durante el registro fino.
+        registration_params: dict
+            Parámetros del método: "mode" ("two_pass" o "multiscale"), "init"
+            ("identity", "ransac" o "fgr", ver global_registration), "voxel_size",
+            los umbrales del registro grueso "gate_fitness" y "gate_rmse" (ver
+            is_hopeless), "track_iterations" (cuenta las iteraciones de cada pasada,
+            más lento) y, para el modo multiescala, los argumentos de
+            multiscale_registration (None para el registro grueso y fino sobre la
+            nube completa).
 
     Returns:
-        transformation_icp: numpy.ndarray
-            La matriz de transformación resultante del registro ICP.
-        information_icp: numpy.ndarray
-            La matriz de información resultante del registro ICP.
+        result: dict
+            Diccionario con "transformation", "information", "fitness" e "inlier_rmse"
+            del registro fino, "gated" (True si el par no alcanzó los umbrales del
+            registro grueso; entonces se devuelve el registro grueso sin información)
+            y "levels", con la distancia, las iteraciones, el tiempo, el fitness y el
+            RMSE de cada pasada.
     """
+    params = dict(registration_params or {})
+    mode = params.pop("mode", "two_pass")
+    init_method = params.pop("init", "identity")
 
-    # Estimación de normales para la nube de puntos objetivo
-    print("Calculando normales para la nube de puntos objetivo...")
-    target.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
+    # Transformación inicial: identidad o inicialización global por descriptores
+    init = np.identity(4)
+    if init_method != "identity":
+        init = global_registration(source, target, params["voxel_size"], init_method)
+
+    if mode == "multiscale":
+        return multiscale_registration(source, target,
+                                       max_correspondence_distance_coarse,
+                                       max_correspondence_distance_fine, init=init, **params)
+
+    # Las nubes preparadas ya tienen normales; en otro caso se estiman sobre una copia del objetivo
+    if isinstance(target, PreparedCloud):
+        target = target.pcd
+    else:
+        print("Calculando normales para la nube de puntos objetivo...")
+        target = o3d.geometry.PointCloud(target)
+        target.estimate_normals(search_param=NORMALS_SEARCH_PARAM)
+    source = as_point_cloud(source)
 
     # Registro grueso utilizando ICP punto a plano
     print("Aplicando ICP punto a plano (registro grueso)...")
-    icp_coarse = o3d.pipelines.registration.registration_icp(
-        source, target, max_correspondence_distance_coarse, np.identity(4),
-        o3d.pipelines.registration.TransformationEstimationPointToPlane())
+    track_iterations = params.get("track_iterations", False)
+    criteria = o3d.pipelines.registration.ICPConvergenceCriteria()
+    passes = []
+    start = time.perf_counter()
+    icp_coarse, iterations = _icp_with_iterations(source, target, max_correspondence_distance_coarse,
+                                                  init, criteria, track_iterations)
+    passes.append(_pass_stats(max_correspondence_distance_coarse, iterations, start, icp_coarse))
+
+    # Un par sin solapamiento tras el registro grueso no necesita el registro fino ni la matriz de información
+    gate_fitness, gate_rmse = params.get("gate_fitness", 0.0), params.get("gate_rmse", 0.0)
+    if is_hopeless(icp_coarse, gate_fitness, gate_rmse):
+        print(f"Par descartado tras el registro grueso: fitness {icp_coarse.fitness:.4f}, "
+              f"RMSE {icp_coarse.inlier_rmse:.4f}")
+        return dict(gated_result(icp_coarse), levels=passes)
 
     # Registro fino utilizando ICP punto a plano con la transformación obtenida del registro grueso
     print("Aplicando ICP punto a plano (registro fino)...")
-    icp_fine = o3d.pipelines.registration.registration_icp(
-        source, target, max_correspondence_distance_fine,
-        icp_coarse.transformation,
-        o3d.pipelines.registration.TransformationEstimationPointToPlane())
+    start = time.perf_counter()
+    icp_fine, iterations = _icp_with_iterations(source, target, max_correspondence_distance_fine,
+                                                icp_coarse.transformation, criteria, track_iterations)
+    passes.append(_pass_stats(max_correspondence_distance_fine, iterations, start, icp_fine))
 
     # Obtener la matriz de transformación y la matriz de información resultantes
     transformation_icp = icp_fine.transformation
@@ -46,4 +381,98 @@ def pairwise_registration(source, target, max_correspondence_distance_coarse,
         source, target, max_correspondence_distance_fine,
         icp_fine.transformation)
 
-    return transformation_icp, information_icp
+    return {
+        "transformation": transformation_icp,
+        "information": information_icp,
+        "fitness": icp_fine.fitness,
+        "inlier_rmse": icp_fine.inlier_rmse,
+        "gated": False,
+        "levels": passes
+    }
+
+def pairwise_registration(source, target, max_correspondence_distance_coarse,
+                          max_correspondence_distance_fine, cache=None, registration_params=None):
+    """
+    Realiza el registro de dos nubes de puntos utilizando el método de registro de ICP punto a plano.
+
+    Parameters:
+        source: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos fuente que se registrará a la nube de puntos objetivo.
+        target: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            La nube de puntos objetivo a la cual se registrará la nube de puntos fuente.
+        max_correspondence_distance_coarse: float
+            Distancia máxima para buscar correspondencias durante el registro grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante el registro fino.
+        cache: registration_cache.RegistrationCache
+            Almacén de resultados de registro (None para registrar siempre).
+        registration_params: dict
+            Parámetros del método de registro, ver compute_pairwise_registration.
+
+    Returns:
+        transformation_icp: numpy.ndarray
+            La matriz de transformación resultante del registro ICP.
+        information_icp: numpy.ndarray
+            La matriz de información resultante del registro ICP (nula si el par se descartó
+            tras el registro grueso, ver compute_pairwise_registration).
+        fitness: float
+            Fitness del registro (el del registro grueso si el par se descartó).
+        inlier_rmse: float
+            RMSE de los inliers del registro.
+    """
+
+    # Reutilizar el resultado si el par ya se registró con los mismos parámetros
+    if cache is not None:
+        key = registration_key(cache, cloud_hash(source), cloud_hash(target),
+                               max_correspondence_distance_coarse,
+                               max_correspondence_distance_fine, registration_params)
+        result = cache.get(key)
+        if result is not None:
+            return result["transformation"], result["information"], result["fitness"], result["inlier_rmse"]
+
+    result = compute_pairwise_registration(source, target,
+                                           max_correspondence_distance_coarse,
+                                           max_correspondence_distance_fine,
+                                           registration_params)
+
+    if cache is not None:
+        cache.put(key, result)
+
+    return result["transformation"], result["information"], result["fitness"], result["inlier_rmse"]
+
+def compare_initializations(pcds, pairs, max_correspondence_distance_coarse,
+                            max_correspondence_distance_fine, registration_params):
+    """
+    Compara el registro con la inicialización configurada contra la inicialización identidad.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+        pairs: List[Tuple[int, int]]
+            Pares (fuente, objetivo) de índices a comparar.
+        max_correspondence_distance_coarse: float
+            Distancia máxima para buscar correspondencias durante el registro grueso.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante el registro fino.
+        registration_params: dict
+            Parámetros del método de registro, ver compute_pairwise_registration.
+
+    Returns:
+        report: List[dict]
+            Tiempo y fitness de cada par con ambas inicializaciones.
+    """
+    identity_params = dict(registration_params, init="identity")
+    report = []
+    for source_id, target_id in pairs:
+        row = {"pair": (source_id, target_id)}
+        for label, params in (("identity", identity_params), ("global", registration_params)):
+            start = time.perf_counter()
+            result = compute_pairwise_registration(pcds[source_id], pcds[target_id],
+                                                   max_correspondence_distance_coarse,
+                                                   max_correspondence_distance_fine, params)
+            row[label + "_time"] = time.perf_counter() - start
+            row[label + "_fitness"] = result["fitness"]
+        report.append(row)
+        print(f"Par {row['pair']}: identidad {row['identity_time']:.2f} s, fitness {row['identity_fitness']:.4f} | "
+              f"{registration_params.get('init')} {row['global_time']:.2f} s, fitness {row['global_fitness']:.4f}")
+    return report
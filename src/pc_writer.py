@@ -1,42 +1,481 @@
+import os
+import shutil
 import open3d as o3d
+import numpy as np
 import json
+from prepared_cloud import as_point_cloud
+from pc_reader import read_pcd_header
+from tiled_downsampling import VoxelTileAccumulator
 
-def write_combined_pcd(preprocessed_pcds, pose_graph_optimized, config_file):
+# Ancho fijo de los campos WIDTH y POINTS para poder corregirlos al cerrar el archivo
+HEADER_COUNT_WIDTH = 20
+
+# Formatos de salida admitidos por write_combined_pcd
+OUTPUT_FORMATS = ("binary", "binary_compressed")
+
+class StreamingPCDWriter:
+    """
+    Escritor de archivos .pcd binarios que agrega las nubes una a una.
+
+    El encabezado se escribe al inicio con la cantidad de puntos reservada a
+    ancho fijo y se corrige al cerrar, de modo que la memoria necesaria es la
+    de una sola nube de entrada y el archivo nunca se vuelve a leer.
+    """
+
+    def __init__(self, output_file, with_normals=False, with_colors=False, append=False, with_counts=False):
+        """
+        Parameters:
+            output_file: str
+                Ruta del archivo .pcd de salida.
+            with_normals: bool
+                Si es True, se escriben los campos normal_x, normal_y y normal_z.
+            with_colors: bool
+                Si es True, se escribe el campo rgb empaquetado.
+            append: bool
+                Si es True, se agregan puntos a un archivo escrito antes por este escritor
+                con los mismos campos (ValueError si el archivo no es compatible).
+            with_counts: bool
+                Si es True, se escribe el campo count (entero sin signo) con la cantidad de
+                puntos combinados en cada punto.
+        """
+        fields = [("x", "<f4"), ("y", "<f4"), ("z", "<f4")]
+        if with_normals:
+            fields += [("normal_x", "<f4"), ("normal_y", "<f4"), ("normal_z", "<f4")]
+        if with_colors:
+            fields += [("rgb", "<f4")]
+        if with_counts:
+            fields += [("count", "<u4")]
+        self.dtype = np.dtype(fields)
+        self.with_normals = with_normals
+        self.with_colors = with_colors
+        self.with_counts = with_counts
+        self.output_file = output_file
+        self.num_points = 0
+
+        if append:
+            header = read_pcd_header(output_file)
+            if (header.get("FIELDS") != list(self.dtype.names) or header.get("DATA") != ["binary"]
+                    or header.get("offset") != len(self._header())):
+                raise ValueError(f"El archivo {output_file} no es compatible con la escritura por bloques.")
+            self.num_points = int(header["POINTS"][0])
+            self.file = open(output_file, 'r+b')
+            # Se descarta cualquier dato posterior a los puntos declarados en el encabezado
+            self.file.seek(header["offset"] + self.num_points * self.dtype.itemsize)
+            self.file.truncate()
+        else:
+            self.file = open(output_file, 'wb')
+            self.file.write(self._header().encode("ascii"))
+
+    def _header(self):
+        names = self.dtype.names
+        types = ["U" if self.dtype[name].kind == "u" else "F" for name in names]
+        count = str(self.num_points).ljust(HEADER_COUNT_WIDTH)
+        return ("# .PCD v0.7 - Point Cloud Data file format\n"
+                "VERSION 0.7\n"
+                f"FIELDS {' '.join(names)}\n"
+                f"SIZE {' '.join(['4'] * len(names))}\n"
+                f"TYPE {' '.join(types)}\n"
+                f"COUNT {' '.join(['1'] * len(names))}\n"
+                f"WIDTH {count}\n"
+                "HEIGHT 1\n"
+                "VIEWPOINT 0 0 0 1 0 0 0\n"
+                f"POINTS {count}\n"
+                "DATA binary\n")
+
+    def append(self, points, normals=None, colors=None, counts=None):
+        """
+        Agrega un bloque de puntos al final del archivo.
+
+        Parameters:
+            points: numpy.ndarray
+                Arreglo (N, 3) de coordenadas.
+            normals: numpy.ndarray
+                Arreglo (N, 3) de normales (requerido si el escritor tiene normales).
+            colors: numpy.ndarray
+                Arreglo (N, 3) de colores en [0, 1] (requerido si el escritor tiene colores).
+            counts: numpy.ndarray
+                Arreglo (N,) de cantidades de puntos combinados (requerido si el escritor tiene cantidades).
+        """
+        records = np.empty(len(points), dtype=self.dtype)
+        records["x"], records["y"], records["z"] = points[:, 0], points[:, 1], points[:, 2]
+        if self.with_normals:
+            records["normal_x"], records["normal_y"], records["normal_z"] = \
+                normals[:, 0], normals[:, 1], normals[:, 2]
+        if self.with_colors:
+            # Formato rgb de PCD: tres bytes empaquetados en un entero interpretado como flotante
+            rgb = np.round(np.clip(colors, 0.0, 1.0) * 255).astype(np.uint32)
+            packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+            records["rgb"] = packed.view(np.float32)
+        if self.with_counts:
+            records["count"] = counts
+        self.file.write(records.tobytes())
+        self.num_points += len(points)
+
+    def close(self):
+        """
+        Corrige la cantidad de puntos del encabezado y cierra el archivo.
+        """
+        self.file.seek(0)
+        self.file.write(self._header().encode("ascii"))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class OctreeTileWriter:
+    """
+    Escritor de un conjunto de mosaicos de octree con varios niveles de detalle.
+
+    El nivel 0 es un único mosaico (la raíz) que cubre el cubo de la nube
+    combinada y cada nivel divide los mosaicos del anterior en ocho. Cada
+    punto se guarda en el nivel más grueso cuya celda de muestreo (resolution
+    celdas por lado de mosaico) sigue libre, y el último nivel recibe los
+    puntos restantes: cargar los niveles 0 a l da una versión uniforme de la
+    nube y cargar todos da la nube completa. Los mosaicos se escriben con
+    StreamingPCDWriter a medida que llegan las nubes; al cerrar se escribe el
+    índice index.json con los límites y la cantidad de puntos de cada mosaico.
+    """
+
+    def __init__(self, output_dir, min_bound, max_bound, max_level=4, resolution=128,
+                 with_normals=False, with_colors=False):
+        """
+        Parameters:
+            output_dir: str
+                Carpeta de los mosaicos (se reemplaza si contiene un conjunto anterior).
+            min_bound: numpy.ndarray
+                Límite inferior de todos los puntos que se agregarán.
+            max_bound: numpy.ndarray
+                Límite superior de todos los puntos que se agregarán.
+            max_level: int
+                Nivel más fino del octree.
+            resolution: int
+                Celdas de muestreo por lado de cada mosaico.
+            with_normals: bool
+                Si es True, los mosaicos tienen normales.
+            with_colors: bool
+                Si es True, los mosaicos tienen colores.
+        """
+        # Las celdas de cada eje se empaquetan en 21 bits de una clave entera
+        if resolution * 2 ** max_level > 2 ** 21:
+            raise ValueError("resolution * 2 ** max_level no puede superar 2 ** 21.")
+        if os.path.exists(os.path.join(output_dir, "index.json")):
+            shutil.rmtree(output_dir)
+        elif os.path.isdir(output_dir) and os.listdir(output_dir):
+            raise ValueError(f"La carpeta {output_dir} no está vacía y no contiene mosaicos anteriores.")
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.output_dir = output_dir
+        self.min_bound = np.asarray(min_bound, dtype=np.float64)
+        # Cubo con un pequeño margen para que el límite superior quede dentro de la última celda
+        self.size = float(np.max(np.asarray(max_bound) - self.min_bound)) * (1 + 1e-6) or 1.0
+        self.max_level = max_level
+        self.resolution = resolution
+        self.with_normals = with_normals
+        self.with_colors = with_colors
+        self.occupied = [np.zeros(0, dtype=np.int64) for _ in range(max_level)]
+        self.nodes = {}
+
+    def spacing(self, level):
+        """
+        Devuelve la separación mínima entre los puntos de un nivel.
+        """
+        return self.size / (self.resolution * 2 ** level)
+
+    def append(self, points, normals=None, colors=None):
+        """
+        Reparte un bloque de puntos entre los niveles y mosaicos del octree.
+
+        Parameters:
+            points: numpy.ndarray
+                Arreglo (N, 3) de coordenadas dentro de los límites del escritor.
+            normals: numpy.ndarray
+                Arreglo (N, 3) de normales (requerido si el escritor tiene normales).
+            colors: numpy.ndarray
+                Arreglo (N, 3) de colores en [0, 1] (requerido si el escritor tiene colores).
+        """
+        relative = points - self.min_bound
+        remaining = np.arange(len(points))
+        for level in range(self.max_level + 1):
+            if len(remaining) == 0:
+                break
+            if level < self.max_level:
+                # Se conserva el primer punto de cada celda de muestreo aún libre en este nivel
+                cells = np.clip(np.floor(relative[remaining] / self.spacing(level)).astype(np.int64),
+                                0, self.resolution * 2 ** level - 1)
+                keys = (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+                unique_keys, first = np.unique(keys, return_index=True)
+                free = ~np.isin(unique_keys, self.occupied[level], assume_unique=True)
+                selected = first[free]
+                self.occupied[level] = np.union1d(self.occupied[level], unique_keys[free])
+                tiles = cells[selected] // self.resolution
+            else:
+                selected = np.arange(len(remaining))
+                tiles = np.clip(np.floor(relative[remaining] / (self.size / 2 ** level)).astype(np.int64),
+                                0, 2 ** level - 1)
+            self._write_level(level, remaining[selected], tiles, points, normals, colors)
+            keep = np.ones(len(remaining), dtype=bool)
+            keep[selected] = False
+            remaining = remaining[keep]
+
+    def _write_level(self, level, indices, tiles, points, normals, colors):
+        """
+        Agrega a cada mosaico de un nivel los puntos que le corresponden.
+        """
+        if len(indices) == 0:
+            return
+        keys, inverse = np.unique(tiles, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for k, key in enumerate(keys):
+            rows = indices[inverse == k]
+            name = f"{level}-{key[0]}-{key[1]}-{key[2]}"
+            path = os.path.join(self.output_dir, name + ".pcd")
+            with StreamingPCDWriter(path, self.with_normals, self.with_colors,
+                                    append=name in self.nodes) as writer:
+                writer.append(points[rows],
+                              normals[rows] if self.with_normals else None,
+                              colors[rows] if self.with_colors else None)
+            self.nodes[name] = {"level": level, "key": key.tolist(), "points": writer.num_points}
+
+    def close(self):
+        """
+        Escribe el índice del conjunto de mosaicos.
+        """
+        nodes = []
+        for name, node in sorted(self.nodes.items(), key=lambda item: (item[1]["level"], item[1]["key"])):
+            tile_size = self.size / 2 ** node["level"]
+            low = self.min_bound + np.array(node["key"]) * tile_size
+            nodes.append({"name": name, "file": name + ".pcd", "level": node["level"], "key": node["key"],
+                          "bounds": [low.tolist(), (low + tile_size).tolist()], "points": node["points"]})
+        with open(os.path.join(self.output_dir, "index.json"), 'w') as f:
+            json.dump({
+                "bounds": [self.min_bound.tolist(), (self.min_bound + self.size).tolist()],
+                "max_level": self.max_level,
+                "resolution": self.resolution,
+                "spacing": [self.spacing(level) for level in range(self.max_level)],
+                "nodes": nodes
+            }, f, indent=4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def transformed_bounds(pcds, poses):
+    """
+    Calcula límites que contienen todas las nubes transformadas, sin transformar sus puntos.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud]
+            Lista de nubes de puntos.
+        poses: List[numpy.ndarray]
+            Matriz de transformación 4x4 de cada nube.
+
+    Returns:
+        min_bound: numpy.ndarray
+            Límite inferior (el de las esquinas transformadas de la caja de cada nube).
+        max_bound: numpy.ndarray
+            Límite superior.
+    """
+    corners = []
+    for pcd, pose in zip(pcds, poses):
+        if not pcd.has_points():
+            continue
+        low, high = pcd.get_min_bound(), pcd.get_max_bound()
+        box = np.array([[x, y, z] for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])])
+        corners.append(box @ np.asarray(pose)[:3, :3].T + np.asarray(pose)[:3, 3])
+    if not corners:
+        return np.zeros(3), np.zeros(3)
+    corners = np.vstack(corners)
+    return corners.min(axis=0), corners.max(axis=0)
+
+def transform_cloud_arrays(pcd, pose):
+    """
+    Aplica una pose a los puntos y normales de una nube sin modificarla.
+
+    Parameters:
+        pcd: open3d.geometry.PointCloud
+            Nube de puntos de entrada.
+        pose: numpy.ndarray
+            Matriz de transformación 4x4.
+
+    Returns:
+        points: numpy.ndarray
+            Arreglo (N, 3) de coordenadas transformadas.
+        normals: numpy.ndarray
+            Arreglo (N, 3) de normales rotadas, o None si la nube no tiene normales.
+    """
+    rotation, translation = pose[:3, :3], pose[:3, 3]
+    points = np.asarray(pcd.points) @ rotation.T + translation
+    normals = np.asarray(pcd.normals) @ rotation.T if pcd.has_normals() else None
+    return points, normals
+
+def _merged_blocks(merger, with_normals, with_colors):
+    """
+    Separa los voxeles combinados de cada mosaico en puntos, normales, colores y cantidades.
+    """
+    for means, counts in merger.reduce():
+        yield (means[:, :3],
+               means[:, 3:6] if with_normals else None,
+               means[:, -3:] if with_colors else None,
+               counts)
+
+def write_combined_pcd(preprocessed_pcds, pose_graph_optimized, config_file,
+                       output_format="binary", visualize=True, lod_params=None, merge_params=None):
     """
     Transforma y combina todas las nubes de puntos y las guarda en un solo archivo .pcd.
 
+    Con el formato "binary" las nubes se transforman y se escriben una a una en
+    el archivo de salida, sin construir la nube combinada en memoria; si se pide
+    visualizarla, se lee el archivo escrito al terminar. El formato
+    "binary_compressed" comprime todos los datos en un solo bloque, por lo que
+    requiere construir la nube combinada y escribirla con Open3D.
+
+    Si lod_params["enabled"] es True, en la misma pasada se escribe además un
+    conjunto de mosaicos de octree con niveles de detalle (ver
+    OctreeTileWriter) en la carpeta <salida>_lod junto al archivo de salida.
+
+    Si merge_params["enabled"] es True, los puntos duplicados de las zonas
+    solapadas se combinan en una grilla de voxeles: las nubes transformadas se
+    reparten en mosaicos en disco a medida que se agregan y cada mosaico se
+    reduce y se escribe por separado, promediando posiciones, normales y
+    colores, con la memoria acotada por merge_params["max_memory_mb"].
+
     Parameters:
-        preprocessed_pcds: List[open3d.geometry.PointCloud]
-            Lista de nubes de puntos preprocesadas.
+        preprocessed_pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos preprocesadas (no se modifican).
         pose_graph_optimized: open3d.pipelines.registration.PoseGraph
             Grafo de poses optimizado.
         config_file: str
             Ruta del archivo de configuración JSON que contiene la ruta del archivo de salida .pcd.
+        output_format: str
+            "binary" (escritura por bloques) o "binary_compressed", ver OUTPUT_FORMATS.
+        visualize: bool
+            Si es True, muestra la nube combinada al terminar.
+        lod_params: dict
+            Parámetros de los mosaicos: "enabled", "max_level" y "resolution" (None para no escribirlos).
+        merge_params: dict
+            Parámetros de la combinación de duplicados: "enabled", "voxel_size", "max_memory_mb" y
+            "counts" (agrega el campo count con los puntos de cada voxel; solo con el formato "binary").
 
     Returns:
         None
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato de salida desconocido: '{output_format}'.")
+
     # Abrir y leer el archivo de configuración JSON
     with open(config_file, 'r') as f:
         config_data = json.load(f)
-    
+
     # Obtener la ruta del archivo de salida .pcd del archivo de configuración
     output_file = config_data.get("output_file")
 
     print("Transformando puntos y combinando en una sola nube de puntos")
 
-    # Inicializar una nube de puntos vacía para combinar todas las nubes transformadas
-    combined_pcd = o3d.geometry.PointCloud()
-
-    # Transformar y combinar todas las nubes de puntos
-    for point_id in range(len(preprocessed_pcds)):
-        print(pose_graph_optimized.nodes[point_id].pose)
-        preprocessed_pcds[point_id].transform(pose_graph_optimized.nodes[point_id].pose)
-        # Agregar los puntos de la nube de puntos transformada a la nube de puntos combinada
-        combined_pcd += preprocessed_pcds[point_id]
-
-    # Guardar la nube de puntos combinada en un archivo .pcd
-    o3d.io.write_point_cloud(output_file, combined_pcd)
-    
-    output_pcd = o3d.io.read_point_cloud(output_file)
-    o3d.visualization.draw_geometries([output_pcd])
+    pcds = [as_point_cloud(pcd) for pcd in preprocessed_pcds]
+    with_normals = all(pcd.has_normals() for pcd in pcds)
+    with_colors = all(pcd.has_colors() for pcd in pcds)
+    combined_pcd = None
+
+    lod_enabled = lod_params is not None and lod_params.get("enabled", False)
+    merge_enabled = merge_params is not None and merge_params.get("enabled", False)
+    if lod_enabled or merge_enabled:
+        poses = [pose_graph_optimized.nodes[point_id].pose for point_id in range(len(pcds))]
+        bounds = transformed_bounds(pcds, poses)
+
+    lod_writer = None
+    if lod_enabled:
+        lod_dir = os.path.splitext(output_file)[0] + "_lod"
+        lod_writer = OctreeTileWriter(lod_dir, *bounds,
+                                      max_level=lod_params.get("max_level", 4),
+                                      resolution=lod_params.get("resolution", 128),
+                                      with_normals=with_normals, with_colors=with_colors)
+
+    merger = None
+    with_counts = False
+    if merge_enabled:
+        num_points = sum(len(pcd.points) for pcd in pcds)
+        merger = VoxelTileAccumulator(*bounds, merge_params["voxel_size"], num_points,
+                                      3 + 3 * with_normals + 3 * with_colors,
+                                      normal_columns=3 if with_normals else None,
+                                      max_memory_mb=merge_params.get("max_memory_mb", 512))
+        with_counts = merge_params.get("counts", False) and output_format == "binary"
+
+    try:
+        if output_format == "binary":
+            with StreamingPCDWriter(output_file, with_normals, with_colors, with_counts=with_counts) as writer:
+                # Transformar y escribir cada nube de puntos por separado
+                for point_id, pcd in enumerate(pcds):
+                    pose = pose_graph_optimized.nodes[point_id].pose
+                    print(pose)
+                    points, normals = transform_cloud_arrays(pcd, pose)
+                    colors = np.asarray(pcd.colors) if with_colors else None
+                    if merger is not None:
+                        merger.add(np.hstack([array for array in (points, normals, colors) if array is not None]))
+                    else:
+                        writer.append(points, normals, colors)
+                        if lod_writer is not None:
+                            lod_writer.append(points, normals, colors)
+
+                # Escribir los voxeles combinados, un mosaico a la vez
+                if merger is not None:
+                    for points, normals, colors, counts in _merged_blocks(merger, with_normals, with_colors):
+                        writer.append(points, normals, colors, counts)
+                        if lod_writer is not None:
+                            lod_writer.append(points, normals, colors)
+            if merger is not None:
+                print(f"Se combinaron {num_points} puntos en {writer.num_points} voxeles "
+                      f"({writer.num_points / max(num_points, 1):.1%}).")
+            print(f"Se escribieron {writer.num_points} puntos en {output_file}")
+        else:
+            # Inicializar una nube de puntos vacía para combinar todas las nubes transformadas
+            combined_pcd = o3d.geometry.PointCloud()
+
+            # Transformar y combinar todas las nubes de puntos
+            for point_id, pcd in enumerate(pcds):
+                print(pose_graph_optimized.nodes[point_id].pose)
+                # Transformar una copia para no modificar la nube del llamador
+                transformed_pcd = o3d.geometry.PointCloud(pcd)
+                transformed_pcd.transform(pose_graph_optimized.nodes[point_id].pose)
+                arrays = (np.asarray(transformed_pcd.points),
+                          np.asarray(transformed_pcd.normals) if with_normals else None,
+                          np.asarray(transformed_pcd.colors) if with_colors else None)
+                if merger is not None:
+                    merger.add(np.hstack([array for array in arrays if array is not None]))
+                    continue
+                if lod_writer is not None:
+                    lod_writer.append(*arrays)
+                # Agregar los puntos de la nube de puntos transformada a la nube de puntos combinada
+                combined_pcd += transformed_pcd
+
+            if merger is not None:
+                blocks = list(_merged_blocks(merger, with_normals, with_colors))
+                for points, normals, colors, _ in blocks:
+                    if lod_writer is not None:
+                        lod_writer.append(points, normals, colors)
+                combined_pcd.points = o3d.utility.Vector3dVector(np.vstack([block[0] for block in blocks]))
+                if with_normals:
+                    combined_pcd.normals = o3d.utility.Vector3dVector(np.vstack([block[1] for block in blocks]))
+                if with_colors:
+                    combined_pcd.colors = o3d.utility.Vector3dVector(np.vstack([block[2] for block in blocks]))
+                print(f"Se combinaron {num_points} puntos en {len(combined_pcd.points)} voxeles.")
+
+            # Guardar la nube de puntos combinada en un archivo .pcd
+            o3d.io.write_point_cloud(output_file, combined_pcd, compressed=True)
+    finally:
+        if merger is not None:
+            merger.cleanup()
+
+    if lod_writer is not None:
+        lod_writer.close()
+        print(f"Se escribieron {len(lod_writer.nodes)} mosaicos de {lod_writer.max_level + 1} niveles en {lod_dir}")
+
+    if visualize:
+        # En el formato "binary" la nube combinada no está en memoria: se lee del archivo escrito
+        if combined_pcd is None:
+            combined_pcd = o3d.io.read_point_cloud(output_file)
+        o3d.visualization.draw_geometries([combined_pcd])
@@ -1,38 +1,157 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import networkx as nx
 import open3d as o3d
 
-def optimize_pose_graph(pose_graph, max_correspondence_distance_fine):
+def sparsify_pose_graph(pose_graph, edge_fitness, min_fitness=0.3, min_correspondences=100,
+                        max_loop_closures=5):
     """
-    Optimiza el grafo de poses utilizando el método de optimización global.
+    Reduce las aristas del grafo de poses antes de optimizarlo.
+
+    Se conserva la cadena de odometría (aristas no inciertas) y solo los
+    cierres de bucle con suficiente fitness y correspondencias, elegidos de
+    mayor a menor fitness y limitados a max_loop_closures por nodo.
 
     Parámetros:
         pose_graph: open3d.pipelines.registration.PoseGraph
-            El grafo de poses a optimizar.
-        max_correspondence_distance_fine: float
-            Distancia máxima para buscar correspondencias durante la optimización.
+            El grafo de poses a reducir (se modifica).
+        edge_fitness: List[float]
+            Fitness del registro de cada arista, en el mismo orden que pose_graph.edges.
+        min_fitness: float
+            Fitness mínimo de un cierre de bucle.
+        min_correspondences: float
+            Cantidad mínima de correspondencias de un cierre de bucle, tomada de su matriz de información.
+        max_loop_closures: int
+            Cantidad máxima de cierres de bucle por nodo.
 
     Retorna:
-        pose_graph_optimized: open3d.pipelines.registration.PoseGraph
-            El grafo de poses optimizado.
+        pose_graph: open3d.pipelines.registration.PoseGraph
+            El grafo de poses reducido.
+    """
+    edges = list(pose_graph.edges)
+    kept = [edge for edge in edges if not edge.uncertain]
+
+    # La matriz de información de Open3D acumula una unidad por correspondencia en su bloque de traslación
+    candidates = [(fitness, index) for index, (edge, fitness) in enumerate(zip(edges, edge_fitness))
+                  if edge.uncertain and fitness >= min_fitness
+                  and edge.information[5, 5] >= min_correspondences]
+
+    loop_closures = {}
+    selected = []
+    for fitness, index in sorted(candidates, key=lambda candidate: (-candidate[0], candidate[1])):
+        edge = edges[index]
+        if (loop_closures.get(edge.source_node_id, 0) < max_loop_closures
+                and loop_closures.get(edge.target_node_id, 0) < max_loop_closures):
+            loop_closures[edge.source_node_id] = loop_closures.get(edge.source_node_id, 0) + 1
+            loop_closures[edge.target_node_id] = loop_closures.get(edge.target_node_id, 0) + 1
+            selected.append(index)
+    kept += [edges[index] for index in sorted(selected)]
+
+    pose_graph.edges.clear()
+    pose_graph.edges.extend(kept)
+    num_loop_closures = sum(1 for edge in edges if edge.uncertain)
+    print(f"Grafo de poses reducido de {len(edges)} a {len(kept)} aristas "
+          f"({len(selected)} de {num_loop_closures} cierres de bucle).")
+    return pose_graph
+
+def _global_optimization(pose_graph, max_correspondence_distance_fine):
+    """
+    Aplica la optimización global de Open3D a un grafo de poses (se modifica).
     """
-    # Imprime un mensaje para indicar que se está realizando la optimización del grafo de poses
-    print("Optimizando PoseGraph ...")
-    
     # Configura las opciones para la optimización global
     option = o3d.pipelines.registration.GlobalOptimizationOption(
         max_correspondence_distance=max_correspondence_distance_fine,
         edge_prune_threshold=0.25,
         reference_node=0)
-    
+
     # Utiliza un contexto de verbosidad para temporariamente establecer el nivel de verbosidad en "Debug"
     with o3d.utility.VerbosityContextManager(
             o3d.utility.VerbosityLevel.Debug) as cm:
-        
+
         # Realiza la optimización global del grafo de poses
         o3d.pipelines.registration.global_optimization(
             pose_graph,
             o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(),
             o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria(),
             option)
-    
+    return pose_graph
+
+def _optimize_component_job(poses, edges, max_correspondence_distance_fine):
+    """
+    Optimiza un componente del grafo dentro de un proceso trabajador.
+
+    Los nodos y aristas viajan como arreglos para no depender de la
+    serialización de los objetos de Open3D.
+    """
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for pose in poses:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+    for source_id, target_id, transformation, information, uncertain, confidence in edges:
+        pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+            source_id, target_id, transformation, information, uncertain, confidence))
+
+    start = time.perf_counter()
+    _global_optimization(pose_graph, max_correspondence_distance_fine)
+    return [np.asarray(node.pose) for node in pose_graph.nodes], time.perf_counter() - start
+
+def optimize_pose_graph(pose_graph, max_correspondence_distance_fine, num_workers=1):
+    """
+    Optimiza el grafo de poses utilizando el método de optimización global.
+
+    Si el grafo tiene varios componentes conexos, cada uno se optimiza por
+    separado (en paralelo con varios procesos) tomando su primer nodo como referencia.
+
+    Parámetros:
+        pose_graph: open3d.pipelines.registration.PoseGraph
+            El grafo de poses a optimizar.
+        max_correspondence_distance_fine: float
+            Distancia máxima para buscar correspondencias durante la optimización.
+        num_workers: int
+            Número de procesos para optimizar los componentes (1 para optimizar en serie).
+
+    Retorna:
+        pose_graph_optimized: open3d.pipelines.registration.PoseGraph
+            El grafo de poses optimizado.
+    """
+    # Imprime un mensaje para indicar que se está realizando la optimización del grafo de poses
+    print("Optimizando PoseGraph ...")
+
+    graph = nx.Graph()
+    graph.add_nodes_from(range(len(pose_graph.nodes)))
+    graph.add_edges_from((edge.source_node_id, edge.target_node_id) for edge in pose_graph.edges)
+    components = sorted((sorted(component) for component in nx.connected_components(graph)
+                         if len(component) > 1), key=lambda component: component[0])
+
+    start = time.perf_counter()
+    if len(components) <= 1:
+        # Un solo componente: se optimiza el grafo completo directamente
+        _global_optimization(pose_graph, max_correspondence_distance_fine)
+        print(f"Optimización de {len(pose_graph.edges)} aristas en {time.perf_counter() - start:.2f} s.")
+        return pose_graph
+
+    # Separar cada componente con índices locales
+    jobs = []
+    for component in components:
+        position = {node: i for i, node in enumerate(component)}
+        poses = [np.asarray(pose_graph.nodes[node].pose) for node in component]
+        edges = [(position[edge.source_node_id], position[edge.target_node_id],
+                  np.asarray(edge.transformation), np.asarray(edge.information),
+                  edge.uncertain, edge.confidence)
+                 for edge in pose_graph.edges if edge.source_node_id in position]
+        jobs.append((poses, edges, max_correspondence_distance_fine))
+
+    if num_workers <= 1:
+        results = [_optimize_component_job(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs))) as executor:
+            results = list(executor.map(_optimize_component_job, *zip(*jobs)))
+
+    for component, job, (poses, elapsed) in zip(components, jobs, results):
+        for node, pose in zip(component, poses):
+            pose_graph.nodes[node].pose = pose
+        print(f"Componente de {len(component)} nodos y {len(job[1])} aristas optimizado en {elapsed:.2f} s.")
+    print(f"Optimización de {len(components)} componentes en {time.perf_counter() - start:.2f} s.")
+
     # Retorna el grafo de poses optimizado
     return pose_graph
@@ -0,0 +1,217 @@
+import numpy as np
+import open3d as o3d
+from registration_cache import cloud_hash
+
+# Parámetros de estimación de normales usados por el registro ICP punto a plano
+NORMALS_SEARCH_PARAM = o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30)
+
+class PreparedCloud:
+    """
+    Nube de puntos preparada una sola vez para las etapas de comparación, registro y escritura.
+
+    Contiene una copia propia de la nube (la nube original nunca se modifica),
+    sus normales, un índice KD para consultas de vecino más cercano por lotes,
+    el hash de su contenido y, opcionalmente, sus descriptores FPFH.
+    """
+
+    def __init__(self, pcd, voxel_size=0.02, compute_features=False, estimate_normals=True):
+        """
+        Parameters:
+            pcd: open3d.geometry.PointCloud
+                Nube de puntos preprocesada.
+            voxel_size: float
+                Tamaño del voxel usado para el radio de los descriptores FPFH.
+            compute_features: bool
+                Si es True, calcula los descriptores FPFH de inmediato.
+            estimate_normals: bool
+                Si es False, se conservan las normales que ya tenga la nube.
+        """
+        self.pcd = o3d.geometry.PointCloud(pcd)
+        self.voxel_size = voxel_size
+        if estimate_normals or not self.pcd.has_normals():
+            self.pcd.estimate_normals(search_param=NORMALS_SEARCH_PARAM)
+        self.content_hash = cloud_hash(self.pcd)
+        self._kdtree = None
+        self._fpfh = None
+        self._pyramids = {}
+        if compute_features:
+            self.features()
+
+    @classmethod
+    def from_arrays(cls, points, normals, voxel_size=0.02, colors=None):
+        """
+        Reconstruye una nube preparada a partir de sus arreglos de puntos y normales.
+
+        Parameters:
+            points: numpy.ndarray
+                Arreglo (N, 3) de coordenadas.
+            normals: numpy.ndarray
+                Arreglo (N, 3) de normales ya estimadas.
+            voxel_size: float
+                Tamaño del voxel usado para el radio de los descriptores FPFH.
+            colors: numpy.ndarray
+                Arreglo (N, 3) de colores en [0, 1] (None si la nube no tiene colores).
+
+        Returns:
+            prepared: PreparedCloud
+                Nube preparada sin volver a estimar normales.
+        """
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(points)
+        pcd.normals = o3d.utility.Vector3dVector(normals)
+        if colors is not None:
+            pcd.colors = o3d.utility.Vector3dVector(colors)
+        return cls(pcd, voxel_size=voxel_size, estimate_normals=False)
+
+    def __len__(self):
+        return len(self.pcd.points)
+
+    def __repr__(self):
+        return f"PreparedCloud with {len(self)} points."
+
+    @property
+    def points(self):
+        """
+        Coordenadas de la nube como arreglo (N, 3) de solo lectura.
+        """
+        points = np.asarray(self.pcd.points)
+        points.flags.writeable = False
+        return points
+
+    @property
+    def normals(self):
+        """
+        Normales de la nube como arreglo (N, 3) de solo lectura.
+        """
+        normals = np.asarray(self.pcd.normals)
+        normals.flags.writeable = False
+        return normals
+
+    @property
+    def kdtree(self):
+        """
+        Índice de vecinos más cercanos sobre los puntos, construido una sola vez.
+        """
+        if self._kdtree is None:
+            self._kdtree = o3d.core.nns.NearestNeighborSearch(
+                o3d.core.Tensor(np.asarray(self.pcd.points), dtype=o3d.core.Dtype.Float64))
+            self._kdtree.knn_index()
+        return self._kdtree
+
+    def features(self):
+        """
+        Devuelve los descriptores FPFH de la nube, calculándolos la primera vez.
+
+        Returns:
+            fpfh: open3d.pipelines.registration.Feature
+                Descriptores FPFH de cada punto.
+        """
+        if self._fpfh is None:
+            self._fpfh = o3d.pipelines.registration.compute_fpfh_feature(
+                self.pcd,
+                o3d.geometry.KDTreeSearchParamHybrid(radius=self.voxel_size * 5, max_nn=100))
+        return self._fpfh
+
+    def pyramid(self, voxel_size, levels):
+        """
+        Devuelve la pirámide de voxeles de la nube, construyéndola una sola vez por configuración.
+
+        Parameters:
+            voxel_size: float
+                Tamaño del voxel del nivel más fino.
+            levels: int
+                Cantidad de niveles de la pirámide.
+
+        Returns:
+            pyramid: List[open3d.geometry.PointCloud]
+                Niveles ordenados del más grueso al más fino, ver voxel_pyramid.
+        """
+        key = (voxel_size, levels)
+        if key not in self._pyramids:
+            self._pyramids[key] = voxel_pyramid(self, voxel_size, levels)
+        return self._pyramids[key]
+
+    def nearest_distances(self, query_points):
+        """
+        Calcula la distancia de cada punto consultado a su vecino más cercano en esta nube.
+
+        Parameters:
+            query_points: numpy.ndarray
+                Arreglo (M, 3) de puntos a consultar.
+
+        Returns:
+            distances: numpy.ndarray
+                Arreglo (M,) con la distancia al vecino más cercano.
+        """
+        query = o3d.core.Tensor(np.ascontiguousarray(query_points, dtype=np.float64))
+        _, squared_distances = self.kdtree.knn_search(query, 1)
+        return np.sqrt(squared_distances.numpy()[:, 0])
+
+def as_point_cloud(cloud):
+    """
+    Devuelve la nube de Open3D subyacente de una nube preparada o la nube misma.
+
+    Parameters:
+        cloud: PreparedCloud u open3d.geometry.PointCloud
+            Nube de puntos.
+
+    Returns:
+        pcd: open3d.geometry.PointCloud
+            Nube de puntos de Open3D (no debe modificarse).
+    """
+    if isinstance(cloud, PreparedCloud):
+        return cloud.pcd
+    return cloud
+
+def voxel_pyramid(cloud, voxel_size, levels):
+    """
+    Construye una pirámide de voxeles con normales para el registro multiescala.
+
+    El nivel más fino es la nube misma (ya reducida con voxel_size en el
+    preprocesamiento); cada nivel anterior duplica el tamaño del voxel.
+
+    Parameters:
+        cloud: PreparedCloud u open3d.geometry.PointCloud
+            Nube de puntos (no se modifica).
+        voxel_size: float
+            Tamaño del voxel del nivel más fino.
+        levels: int
+            Cantidad de niveles de la pirámide.
+
+    Returns:
+        pyramid: List[open3d.geometry.PointCloud]
+            Niveles ordenados del más grueso al más fino, todos con normales.
+    """
+    if isinstance(cloud, PreparedCloud):
+        finest = cloud.pcd
+    else:
+        finest = o3d.geometry.PointCloud(cloud)
+        finest.estimate_normals(search_param=NORMALS_SEARCH_PARAM)
+
+    pyramid = []
+    for level in range(levels - 1, 0, -1):
+        level_voxel = voxel_size * 2 ** level
+        level_pcd = finest.voxel_down_sample(level_voxel)
+        level_pcd.estimate_normals(
+            search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=level_voxel * 2, max_nn=30))
+        pyramid.append(level_pcd)
+    pyramid.append(finest)
+    return pyramid
+
+def prepare_clouds(pcds, voxel_size=0.02, compute_features=False):
+    """
+    Prepara una lista de nubes de puntos preprocesadas.
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud]
+            Lista de nubes de puntos preprocesadas.
+        voxel_size: float
+            Tamaño del voxel usado para el radio de los descriptores FPFH.
+        compute_features: bool
+            Si es True, calcula los descriptores FPFH de cada nube.
+
+    Returns:
+        prepared_pcds: List[PreparedCloud]
+            Lista de nubes preparadas, en el mismo orden.
+    """
+    return [PreparedCloud(pcd, voxel_size, compute_features) for pcd in pcds]
@@ -0,0 +1,173 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+import open3d as o3d
+
+# Arreglos de la nube que se guardan, cada uno en su propio archivo .npy
+CACHED_ARRAYS = ("points", "normals", "colors")
+
+def input_hash(pcd):
+    """
+    Calcula un hash del contenido de una nube de entrada (coordenadas, normales y colores).
+
+    Si la nube se da por su ruta, se calcula el hash del archivo leyéndolo por bloques.
+
+    Parameters:
+        pcd: open3d.geometry.PointCloud o str
+            Nube de puntos de entrada o ruta de su archivo.
+
+    Returns:
+        digest: str
+            Hash SHA-1 hexadecimal del contenido de la nube.
+    """
+    hasher = hashlib.sha1()
+    if isinstance(pcd, str):
+        with open(pcd, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+    for name in CACHED_ARRAYS:
+        array = np.ascontiguousarray(np.asarray(getattr(pcd, name), dtype=np.float64))
+        hasher.update(f"{name}{array.shape}".encode())
+        hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+class PreprocessingCache:
+    """
+    Almacén en disco de nubes preprocesadas (reducidas y sin puntos atípicos).
+
+    Cada entrada es una carpeta con un archivo .npy por arreglo. Las entradas
+    se identifican por el hash de la nube de entrada (o de su archivo) y los
+    parámetros del preprocesamiento; al superar el tamaño máximo se eliminan
+    las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        """
+        Parameters:
+            cache_dir: str
+                Carpeta donde se guardan las nubes preprocesadas.
+            max_bytes: int
+                Tamaño máximo de la carpeta en bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(pcd, voxel_size, remove_outliers_params, source=None):
+        """
+        Construye la llave de una nube a partir de su contenido y los parámetros del preprocesamiento.
+
+        Parameters:
+            pcd: open3d.geometry.PointCloud o str
+                Nube de puntos de entrada o ruta de su archivo.
+            voxel_size: float
+                Tamaño del voxel para el muestreo.
+            remove_outliers_params: dict
+                Parámetros de la eliminación de puntos atípicos (None si no se aplica).
+            source: str
+                Ruta del archivo del que se leyó la nube; si se da, la llave depende del
+                contenido del archivo y no de la nube en memoria, que puede haberse pintado.
+
+        Returns:
+            key: str
+                Llave hexadecimal de la nube.
+        """
+        params = sorted(remove_outliers_params.items()) if remove_outliers_params is not None else None
+        hasher = hashlib.sha1()
+        hasher.update(input_hash(source if source is not None else pcd).encode())
+        hasher.update(repr((float(voxel_size), params)).encode())
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key):
+        """
+        Busca una nube preprocesada en el almacén.
+
+        Parameters:
+            key: str
+                Llave de la nube.
+
+        Returns:
+            pcd: open3d.geometry.PointCloud
+                Nube preprocesada, o None si no está en el almacén.
+        """
+        path = self._path(key)
+        if not os.path.isdir(path):
+            self.misses += 1
+            return None
+
+        # Vector3dVector copia los datos y no acepta arreglos de solo lectura, por lo que se leen completos
+        pcd = o3d.geometry.PointCloud()
+        for name in CACHED_ARRAYS:
+            array_path = os.path.join(path, name + ".npy")
+            if os.path.exists(array_path):
+                setattr(pcd, name, o3d.utility.Vector3dVector(np.load(array_path)))
+        # Se actualiza la fecha de uso para el desalojo por antigüedad
+        os.utime(path)
+        self.hits += 1
+        return pcd
+
+    def put(self, key, pcd):
+        """
+        Guarda una nube preprocesada en el almacén.
+
+        Parameters:
+            key: str
+                Llave de la nube.
+            pcd: open3d.geometry.PointCloud
+                Nube preprocesada.
+        """
+        path = self._path(key)
+        if os.path.isdir(path):
+            return
+        # Se escribe en una carpeta temporal y se renombra para no dejar entradas incompletas
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(tmp_path, exist_ok=True)
+        for name in CACHED_ARRAYS:
+            array = np.asarray(getattr(pcd, name))
+            if len(array) > 0:
+                np.save(os.path.join(tmp_path, name + ".npy"), array)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Otro proceso guardó la misma entrada
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def evict(self):
+        """
+        Elimina las entradas usadas hace más tiempo hasta que el almacén no supere el tamaño máximo.
+
+        Returns:
+            removed: int
+                Cantidad de entradas eliminadas.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = self._path(name)
+            if not os.path.isdir(path) or name.endswith(".tmp"):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, path))
+
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def report(self):
+        """
+        Imprime la cantidad de aciertos y fallos del almacén.
+        """
+        print(f"Caché de preprocesamiento: {self.hits} aciertos, {self.misses} fallos.")
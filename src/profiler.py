@@ -0,0 +1,348 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+try:
+    import resource
+except ImportError:  # Windows no tiene el módulo resource
+    resource = None
+
+# Variable de entorno que activa el perfilado y define el archivo de salida
+PROFILE_ENV_VAR = "PCG_PROFILE"
+
+# Perfilador activo (None cuando el perfilado está desactivado)
+_profiler = None
+
+def peak_rss():
+    """
+    Devuelve el pico de memoria residente del proceso y de sus hijos terminados, en bytes.
+
+    Es acumulado: el mayor valor desde el inicio del proceso (en Linux, desde el
+    último reset_peak_rss), no el de una etapa.
+
+    Returns:
+        rss: int
+            Pico de memoria residente, o None si la plataforma no lo permite.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss está en kilobytes en Linux y en bytes en macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+def current_peak_rss():
+    """
+    Devuelve el pico de memoria residente del proceso desde el último reinicio (VmHWM), en bytes.
+
+    Returns:
+        rss: int
+            Pico de memoria residente, o None si /proc no está disponible.
+    """
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss():
+    """
+    Reinicia el pico de memoria residente del proceso (VmHWM) al uso actual.
+
+    Returns:
+        reset: bool
+            True si se pudo reiniciar (solo en Linux).
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+class StageRecord:
+    """
+    Medición de una etapa del procesamiento; se usa como administrador de contexto.
+
+    El pico de memoria de la etapa se mide reiniciando VmHWM al entrar; como el
+    reinicio afecta a todo el proceso, el pico observado se propaga a las etapas
+    que la contienen.
+    """
+
+    def __init__(self, profiler, name, points_in=None):
+        self.profiler = profiler
+        self.name = name
+        self.points_in = points_in
+        self.points_out = None
+        self.peak = None
+
+    def __enter__(self):
+        self.profiler.enter_stage(self)
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_wall = time.perf_counter()
+        end_cpu = time.process_time()
+        self.profiler.exit_stage(self)
+        self.profiler.add_stage({
+            "name": self.name,
+            "start": self.start_wall,
+            "wall_time": end_wall - self.start_wall,
+            "cpu_time": end_cpu - self.start_cpu,
+            "peak_rss": self.peak,
+            "process_peak_rss": self.profiler.process_peak_rss(),
+            "points_in": self.points_in,
+            "points_out": self.points_out
+        })
+
+class _NullStage:
+    """
+    Etapa sin efecto usada cuando el perfilado está desactivado.
+    """
+    points_in = None
+    points_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        # Se ignoran las asignaciones para no acumular estado
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class Profiler:
+    """
+    Acumula las mediciones de etapas y pares y las escribe como traza de Chrome.
+    """
+
+    def __init__(self, output_file):
+        """
+        Parameters:
+            output_file: str
+                Ruta del archivo JSON de salida.
+        """
+        self.output_file = output_file
+        self.origin = time.perf_counter()
+        # Los pares registrados en otros procesos se ubican con el reloj de pared, común a todos
+        self.origin_time = time.time()
+        self.stages = []
+        self.pairs = []
+        # Etapas abiertas, de la más externa a la más interna
+        self.open_stages = []
+        # El reinicio de VmHWM también reinicia ru_maxrss, así que el pico acumulado se lleva aquí
+        self.process_peak = current_peak_rss() or 0
+        self.track_peaks = reset_peak_rss()
+        self.lock = threading.Lock()
+
+    def _update_open_peaks(self):
+        peak = current_peak_rss() if self.track_peaks else None
+        if peak is None:
+            return
+        self.process_peak = max(self.process_peak, peak)
+        for stage in self.open_stages:
+            stage.peak = peak if stage.peak is None else max(stage.peak, peak)
+
+    def enter_stage(self, stage):
+        with self.lock:
+            # El pico previo al reinicio pertenece a las etapas que contienen a la nueva
+            self._update_open_peaks()
+            self.open_stages.append(stage)
+            # Sin reinicio el pico sería el acumulado del proceso, así que la etapa no lo reporta
+            if self.track_peaks:
+                reset_peak_rss()
+
+    def exit_stage(self, stage):
+        with self.lock:
+            self._update_open_peaks()
+            self.open_stages.remove(stage)
+
+    def process_peak_rss(self):
+        """
+        Devuelve el pico acumulado de memoria residente del proceso y de sus hijos, en bytes.
+        """
+        rss = peak_rss()
+        if not self.track_peaks:
+            return rss
+        with self.lock:
+            self._update_open_peaks()
+            return max(self.process_peak, rss or 0)
+
+    def add_stage(self, record):
+        with self.lock:
+            self.stages.append(record)
+
+    def add_pair(self, record):
+        with self.lock:
+            self.pairs.append(record)
+
+    def _to_us(self, seconds):
+        return int((seconds - self.origin) * 1e6)
+
+    def _time_to_us(self, seconds):
+        return int((seconds - self.origin_time) * 1e6)
+
+    def write(self):
+        """
+        Escribe la traza en formato Chrome (chrome://tracing o Perfetto) con un resumen por etapa y por par.
+        """
+        pid = os.getpid()
+        events = []
+        for stage in self.stages:
+            events.append({
+                "name": stage["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": self._to_us(stage["start"]),
+                "dur": int(stage["wall_time"] * 1e6),
+                "pid": pid,
+                "tid": 0,
+                "args": {key: value for key, value in stage.items() if key not in ("name", "start")}
+            })
+        for pair in self.pairs:
+            events.append({
+                "name": f"par {pair['source']}-{pair['target']}",
+                "cat": "pair",
+                "ph": "X",
+                "ts": self._time_to_us(pair["end"] - pair["time"]),
+                "dur": int(pair["time"] * 1e6),
+                "pid": pid,
+                "tid": pair["worker"] or 1,
+                "args": {key: value for key, value in pair.items() if key != "end"}
+            })
+
+        output_dir = os.path.dirname(self.output_file)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with open(self.output_file, 'w') as f:
+            json.dump({
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "stages": [{key: value for key, value in stage.items() if key != "start"}
+                           for stage in self.stages],
+                "pairs": [{key: value for key, value in pair.items() if key != "end"}
+                          for pair in self.pairs]
+            }, f, indent=2)
+        print(f"Traza de perfilado guardada en {self.output_file}")
+
+def enable_profiling(output_file=None):
+    """
+    Activa el perfilado si se indica un archivo de salida o la variable de entorno PCG_PROFILE.
+
+    La traza se escribe automáticamente al terminar el proceso.
+
+    Parameters:
+        output_file: str
+            Ruta del archivo JSON de salida (la variable de entorno tiene prioridad).
+
+    Returns:
+        profiler: Profiler
+            Perfilador activo, o None si el perfilado queda desactivado.
+    """
+    global _profiler
+    output_file = os.environ.get(PROFILE_ENV_VAR) or output_file
+    if not output_file:
+        return None
+    if _profiler is None:
+        _profiler = Profiler(output_file)
+        atexit.register(_profiler.write)
+    return _profiler
+
+def profiling_enabled():
+    """
+    Indica si el perfilado está activo.
+
+    Returns:
+        enabled: bool
+            True si enable_profiling activó un perfilador.
+    """
+    return _profiler is not None
+
+def profile_stage(name, points_in=None):
+    """
+    Mide una etapa del procesamiento.
+
+    Uso: with profile_stage("preprocesamiento", points_in=n) as stage: ...; stage.points_out = m
+
+    Parameters:
+        name: str
+            Nombre de la etapa.
+        points_in: int
+            Cantidad de puntos que entran a la etapa.
+
+    Returns:
+        stage: StageRecord
+            Administrador de contexto de la etapa (sin efecto si el perfilado está desactivado).
+    """
+    if _profiler is None:
+        return _NULL_STAGE
+    return StageRecord(_profiler, name, points_in)
+
+def record_pair(source_id, target_id, result, elapsed, cached=False, worker=None, end=None):
+    """
+    Registra las métricas del registro de un par.
+
+    Parameters:
+        source_id: int
+            Índice de la nube fuente.
+        target_id: int
+            Índice de la nube objetivo.
+        result: dict
+            Resultado del registro, ver pc_stacking.compute_pairwise_registration.
+        elapsed: float
+            Tiempo de registro del par en segundos.
+        cached: bool
+            True si el resultado provino del almacén de registros.
+        worker: int
+            Identificador del proceso que registró el par (None para el proceso principal).
+        end: float
+            Instante (time.time()) en que terminó el registro del par, medido en el proceso
+            que lo registró (None para el instante actual).
+    """
+    if _profiler is None:
+        return
+    levels = result.get("levels")
+    iterations = None
+    if levels and all(level["iterations"] is not None for level in levels):
+        iterations = sum(level["iterations"] for level in levels)
+    _profiler.add_pair({
+        "source": source_id,
+        "target": target_id,
+        "time": elapsed,
+        "end": end if end is not None else time.time(),
+        "iterations": iterations,
+        "fitness": float(result["fitness"]),
+        "inlier_rmse": float(result["inlier_rmse"]),
+        "gated": bool(result.get("gated", False)),
+        "cached": cached,
+        "worker": worker
+    })
+
+def count_points(pcds):
+    """
+    Devuelve la cantidad total de puntos de una lista de nubes (solo si el perfilado está activo).
+
+    Parameters:
+        pcds: List[open3d.geometry.PointCloud o prepared_cloud.PreparedCloud]
+            Lista de nubes de puntos.
+
+    Returns:
+        total: int
+            Cantidad total de puntos, o None si el perfilado está desactivado.
+    """
+    if _profiler is None:
+        return None
+    # Las nubes dadas por su ruta (no cargadas en memoria) no se cuentan
+    return sum(len(pcd.points) for pcd in pcds if not isinstance(pcd, str))
@@ -0,0 +1,136 @@
+import os
+import hashlib
+import numpy as np
+
+def cloud_hash(pcd):
+    """
+    Calcula un hash del contenido de una nube de puntos.
+
+    Parameters:
+        pcd: open3d.geometry.PointCloud o prepared_cloud.PreparedCloud
+            Nube de puntos a identificar.
+
+    Returns:
+        digest: str
+            Hash SHA-1 hexadecimal de las coordenadas de los puntos.
+    """
+    # Las nubes preparadas ya guardan su hash
+    content_hash = getattr(pcd, "content_hash", None)
+    if content_hash is not None:
+        return content_hash
+
+    points = np.ascontiguousarray(np.asarray(pcd.points, dtype=np.float64))
+    hasher = hashlib.sha1()
+    hasher.update(str(points.shape).encode())
+    hasher.update(points.tobytes())
+    return hasher.hexdigest()
+
+class RegistrationCache:
+    """
+    Almacén de resultados de registro por pares, en memoria y en disco.
+
+    Cada resultado se identifica por el hash del contenido de la nube fuente,
+    el de la nube objetivo y los parámetros del registro (distancias de
+    correspondencia y método), de modo que una nueva ejecución con las mismas
+    entradas no vuelve a aplicar ICP.
+    """
+
+    def __init__(self, cache_dir=None):
+        """
+        Parameters:
+            cache_dir: str
+                Carpeta donde se guardan los resultados (None para usar solo memoria).
+        """
+        self.cache_dir = cache_dir
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(source_hash, target_hash, *params):
+        """
+        Construye la llave de un par a partir de los hashes de las nubes y los parámetros.
+
+        Parameters:
+            source_hash: str
+                Hash de la nube de puntos fuente.
+            target_hash: str
+                Hash de la nube de puntos objetivo.
+            params: Tuple
+                Parámetros del registro (distancias de correspondencia, método, ...).
+
+        Returns:
+            key: str
+                Llave hexadecimal del par.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(source_hash.encode())
+        hasher.update(target_hash.encode())
+        hasher.update(repr(params).encode())
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        """
+        Busca un resultado de registro, primero en memoria y luego en disco.
+
+        Parameters:
+            key: str
+                Llave del par.
+
+        Returns:
+            result: dict
+                Diccionario con "transformation", "information", "fitness",
+                "inlier_rmse" y "gated", o None si el par no se ha registrado antes.
+        """
+        result = self.memory.get(key)
+        if result is None and self.cache_dir is not None and os.path.exists(self._path(key)):
+            with np.load(self._path(key)) as data:
+                result = {
+                    "transformation": data["transformation"],
+                    "information": data["information"],
+                    "fitness": float(data["fitness"]),
+                    "inlier_rmse": float(data["inlier_rmse"]),
+                    # Los resultados guardados antes de los umbrales del registro grueso no se descartaron
+                    "gated": bool(data["gated"]) if "gated" in data.files else False
+                }
+            self.memory[key] = result
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Guarda un resultado de registro en memoria y en disco.
+
+        Parameters:
+            key: str
+                Llave del par.
+            result: dict
+                Diccionario con "transformation", "information", "fitness", "inlier_rmse" y "gated".
+        """
+        self.memory[key] = result
+        if self.cache_dir is not None:
+            # Se escribe en un archivo temporal y se renombra para no dejar archivos incompletos
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(f,
+                         transformation=np.asarray(result["transformation"]),
+                         information=np.asarray(result["information"]),
+                         fitness=result["fitness"],
+                         inlier_rmse=result["inlier_rmse"],
+                         gated=result.get("gated", False))
+            os.replace(tmp_path, self._path(key))
+
+    def report(self):
+        """
+        Imprime la cantidad de aciertos y fallos del almacén.
+        """
+        print(f"Caché de registro: {self.hits} aciertos, {self.misses} fallos.")
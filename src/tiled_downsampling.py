@@ -0,0 +1,332 @@
+import os
+import tempfile
+import numpy as np
+import open3d as o3d
+from pc_reader import read_pcd_header, read_ply_header, is_mappable_pcd, pcd_dtype, unpack_rgb, PLY_TYPES
+
+def _map_point_data(path):
+    """
+    Proyecta en memoria los datos de un archivo .pcd binario o .ply binario.
+
+    Returns:
+        data: numpy.memmap
+            Registros estructurados de los puntos, o None si el formato no puede proyectarse.
+        colors_field: str
+            Campo de color ("rgb" para PCD, "ply" para red/green/blue) o None.
+    """
+    if path.endswith(".pcd"):
+        header = read_pcd_header(path)
+        if not is_mappable_pcd(header):
+            return None, None
+        dtype = pcd_dtype(header)
+        num_points = int(header["POINTS"][0])
+        colors_field = next((name for name in ("rgb", "rgba") if name in dtype.names
+                             and dtype[name].itemsize == 4 and dtype[name].shape == ()), None)
+    elif path.endswith(".ply"):
+        header = read_ply_header(path)
+        if (header["format"] != "binary_little_endian" or not header["vertex_first"]
+                or any(type_ not in PLY_TYPES for _, type_ in header["properties"])):
+            return None, None
+        dtype = np.dtype([(name, "<" + PLY_TYPES[type_]) for name, type_ in header["properties"]])
+        num_points = header["vertex_count"]
+        colors_field = "ply" if all(name in dtype.names for name in ("red", "green", "blue")) else None
+    else:
+        return None, None
+    if num_points == 0:
+        return np.zeros(0, dtype=dtype), colors_field
+    return np.memmap(path, dtype=dtype, mode='r', offset=header["offset"], shape=(num_points,)), colors_field
+
+def iter_point_blocks(path, block_points):
+    """
+    Recorre los puntos de un archivo por bloques, sin cargar el archivo completo.
+
+    Los .pcd binarios y los .ply binarios se proyectan en memoria; otros
+    formatos (ascii, binary_compressed) se leen completos con Open3D.
+
+    Parameters:
+        path: str
+            Ruta del archivo .pcd o .ply.
+        block_points: int
+            Cantidad de puntos por bloque.
+
+    Yields:
+        points: numpy.ndarray
+            Arreglo (B, 3) de coordenadas float64.
+        normals: numpy.ndarray
+            Arreglo (B, 3) de normales o None.
+        colors: numpy.ndarray
+            Arreglo (B, 3) de colores en [0, 1] o None.
+    """
+    data, colors_field = _map_point_data(path)
+    if data is None:
+        print(f"Advertencia: el formato de {path} no permite la lectura por bloques; se lee completo.")
+        pcd = o3d.io.read_point_cloud(path)
+        points = np.asarray(pcd.points)
+        normals = np.asarray(pcd.normals) if pcd.has_normals() else None
+        colors = np.asarray(pcd.colors) if pcd.has_colors() else None
+        for start in range(0, len(points), block_points):
+            end = start + block_points
+            yield (points[start:end],
+                   normals[start:end] if normals is not None else None,
+                   colors[start:end] if colors is not None else None)
+        return
+
+    names = data.dtype.names
+    normal_names = ("normal_x", "normal_y", "normal_z") if "normal_x" in names else ("nx", "ny", "nz")
+    has_normals = all(name in names for name in normal_names)
+
+    def stack(block, fields):
+        array = np.empty((len(block), 3), dtype=np.float64)
+        for column, name in enumerate(fields):
+            array[:, column] = block[name]
+        return array
+
+    for start in range(0, len(data), block_points):
+        block = data[start:start + block_points]
+        colors = None
+        if colors_field == "ply":
+            colors = stack(block, ("red", "green", "blue"))
+            if data.dtype["red"].kind == "u":
+                colors /= 255.0
+        elif colors_field is not None:
+            colors = unpack_rgb(block[colors_field])
+        yield (stack(block, ("x", "y", "z")),
+               stack(block, normal_names) if has_normals else None,
+               colors)
+
+def _tiles_per_axis(extent_voxels, num_tiles):
+    """
+    Reparte la cantidad de mosaicos entre los ejes, dividiendo siempre el eje con mosaicos más largos.
+    """
+    tiles = np.ones(3, dtype=np.int64)
+    while np.prod(tiles) < num_tiles:
+        axis = int(np.argmax(extent_voxels / tiles))
+        if tiles[axis] >= extent_voxels[axis]:
+            break
+        tiles[axis] += 1
+    return tiles
+
+class VoxelTileAccumulator:
+    """
+    Acumula puntos en mosaicos en disco alineados con una grilla de voxeles y los reduce por voxel.
+
+    La grilla sigue la convención de Open3D (origen en el límite inferior
+    menos medio voxel) y los mosaicos contienen voxeles enteros, por lo que
+    cada mosaico se reduce por separado con memoria acotada y ningún voxel
+    queda dividido entre dos mosaicos. La cantidad inicial de mosaicos supone
+    una densidad uniforme; los mosaicos que al reducirse superan la memoria
+    máxima se parten en mitades por bloques hasta que caben.
+    """
+
+    def __init__(self, min_bound, max_bound, voxel_size, num_points, columns, normal_columns=None,
+                 max_memory_mb=512, tmp_dir=None):
+        """
+        Parameters:
+            min_bound: numpy.ndarray
+                Límite inferior de todos los puntos que se agregarán.
+            max_bound: numpy.ndarray
+                Límite superior de todos los puntos que se agregarán.
+            voxel_size: float
+                Tamaño del voxel.
+            num_points: int
+                Cantidad total (o estimada) de puntos que se agregarán, para dimensionar los mosaicos.
+            columns: int
+                Columnas de cada registro; las tres primeras son las coordenadas.
+            normal_columns: int
+                Primera de las tres columnas de normales, que se normalizan tras promediarlas (None si no hay).
+            max_memory_mb: float
+                Memoria máxima en MB de un mosaico en proceso.
+            tmp_dir: str
+                Carpeta donde se crean los mosaicos temporales (None para la carpeta temporal del sistema).
+        """
+        self.voxel_size = voxel_size
+        self.voxel_min_bound = np.asarray(min_bound, dtype=np.float64) - voxel_size * 0.5
+        self.columns = columns
+        self.normal_columns = normal_columns
+        # Cada mosaico se procesa con varias copias de sus registros (índices, sumas y promedios)
+        self.tile_points = max(1, int(max_memory_mb * 1024 ** 2 // (4 * columns * 8)))
+        extent_voxels = np.floor((np.asarray(max_bound) - self.voxel_min_bound) / voxel_size).astype(np.int64) + 1
+        self.tiles = _tiles_per_axis(extent_voxels, int(np.ceil(num_points / self.tile_points)))
+        self.tile_voxels = -(-extent_voxels // self.tiles)
+        self.work_dir = tempfile.TemporaryDirectory(dir=tmp_dir)
+        self.tile_ids = set()
+
+    def _voxel_index(self, records):
+        return np.floor((records[:, :3] - self.voxel_min_bound) / self.voxel_size).astype(np.int64)
+
+    def _read_chunks(self, path):
+        """
+        Lee los registros de un mosaico por bloques de a lo sumo tile_points registros.
+        """
+        chunk_values = self.tile_points * self.columns
+        for offset in range(0, os.path.getsize(path), chunk_values * 8):
+            yield np.fromfile(path, dtype=np.float64, count=chunk_values, offset=offset).reshape(-1, self.columns)
+
+    def _split(self, path):
+        """
+        Parte un mosaico en dos mitades de voxeles enteros a lo largo de su eje más largo.
+
+        Returns:
+            paths: List[str]
+                Archivos de las dos mitades, o None si el mosaico tiene un solo voxel.
+        """
+        low = np.full(3, np.iinfo(np.int64).max)
+        high = np.full(3, np.iinfo(np.int64).min)
+        for records in self._read_chunks(path):
+            voxel_index = self._voxel_index(records)
+            low = np.minimum(low, voxel_index.min(axis=0))
+            high = np.maximum(high, voxel_index.max(axis=0))
+        extent = high - low + 1
+        if np.all(extent == 1):
+            return None
+        axis = int(np.argmax(extent))
+        middle = low[axis] + extent[axis] // 2
+
+        paths = [path + ".0", path + ".1"]
+        with open(paths[0], 'ab') as first, open(paths[1], 'ab') as second:
+            for records in self._read_chunks(path):
+                upper = self._voxel_index(records)[:, axis] >= middle
+                records[~upper].tofile(first)
+                records[upper].tofile(second)
+        os.remove(path)
+        return paths
+
+    def _means(self, sums, counts):
+        """
+        Convierte las sumas por voxel en promedios, normalizando las normales.
+        """
+        means = sums / counts[:, np.newaxis]
+        if self.normal_columns is not None:
+            normals = means[:, self.normal_columns:self.normal_columns + 3]
+            norms = np.linalg.norm(normals, axis=1, keepdims=True)
+            np.divide(normals, norms, out=normals, where=norms > 0)
+        return means
+
+    def add(self, records):
+        """
+        Reparte un bloque de registros (N, columns) en los archivos de sus mosaicos.
+        """
+        voxel_index = self._voxel_index(records)
+        tile_index = np.ravel_multi_index(tuple((voxel_index // self.tile_voxels).T), tuple(self.tiles),
+                                          mode='clip')
+        order = np.argsort(tile_index, kind="stable")
+        block_tiles, starts = np.unique(tile_index[order], return_index=True)
+        for tile_id, rows in zip(block_tiles, np.split(order, starts[1:])):
+            with open(os.path.join(self.work_dir.name, f"{tile_id}.bin"), 'ab') as f:
+                np.ascontiguousarray(records[rows], dtype=np.float64).tofile(f)
+            self.tile_ids.add(int(tile_id))
+
+    def reduce(self):
+        """
+        Reduce cada mosaico por voxel, de a uno por vez y con a lo sumo tile_points registros en memoria.
+
+        Yields:
+            means: numpy.ndarray
+                Arreglo (M, columns) con el promedio de los registros de cada voxel del mosaico.
+            counts: numpy.ndarray
+                Cantidad de puntos que aportaron a cada voxel.
+        """
+        tile_bytes = self.tile_points * self.columns * 8
+        # Pila de mosaicos por reducir; las mitades de un mosaico partido se reducen a continuación
+        pending = [os.path.join(self.work_dir.name, f"{tile_id}.bin")
+                   for tile_id in sorted(self.tile_ids, reverse=True)]
+        while pending:
+            path = pending.pop()
+            if os.path.getsize(path) > tile_bytes:
+                halves = self._split(path)
+                if halves is not None:
+                    pending.extend(reversed(halves))
+                    continue
+                # Un único voxel con más puntos que los que caben: se suma por bloques
+                sums = np.zeros(self.columns)
+                count = 0
+                for records in self._read_chunks(path):
+                    sums += records.sum(axis=0)
+                    count += len(records)
+                yield self._means(sums[np.newaxis], np.array([count])), np.array([count])
+                continue
+
+            records = np.fromfile(path, dtype=np.float64).reshape(-1, self.columns)
+            _, inverse, counts = np.unique(self._voxel_index(records), axis=0,
+                                           return_inverse=True, return_counts=True)
+            inverse = inverse.reshape(-1)
+            sums = np.column_stack([np.bincount(inverse, weights=records[:, c], minlength=len(counts))
+                                    for c in range(self.columns)])
+            del records
+            yield self._means(sums, counts), counts
+
+    def cleanup(self):
+        """
+        Elimina los mosaicos temporales.
+        """
+        self.work_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+def tiled_voxel_down_sample(path, voxel_size, max_memory_mb=512, tmp_dir=None):
+    """
+    Reduce por voxeles una nube de puntos más grande que la memoria disponible.
+
+    El archivo se recorre por bloques dos veces: primero para obtener los
+    límites de la nube y luego para repartir los puntos en mosaicos espaciales
+    guardados en disco (ver VoxelTileAccumulator); cada mosaico se reduce por
+    separado y los resultados se unen. El resultado coincide con
+    open3d.geometry.PointCloud.voxel_down_sample salvo el orden de los puntos y
+    errores de redondeo en los promedios.
+
+    Parameters:
+        path: str
+            Ruta del archivo .pcd o .ply.
+        voxel_size: float
+            Tamaño del voxel.
+        max_memory_mb: float
+            Memoria máxima en MB de un bloque o mosaico en proceso.
+        tmp_dir: str
+            Carpeta donde se crean los mosaicos temporales (None para la carpeta temporal del sistema).
+
+    Returns:
+        pcd: open3d.geometry.PointCloud
+            Nube de puntos reducida.
+    """
+    max_bytes = max_memory_mb * 1024 ** 2
+
+    # Primera pasada: límites, cantidad de puntos y atributos presentes
+    min_bound = np.full(3, np.inf)
+    max_bound = np.full(3, -np.inf)
+    num_points = 0
+    has_normals = has_colors = None
+    block_points = max(1, int(max_bytes // (4 * 9 * 8)))
+    for points, normals, colors in iter_point_blocks(path, block_points):
+        if len(points) == 0:
+            continue
+        min_bound = np.minimum(min_bound, points.min(axis=0))
+        max_bound = np.maximum(max_bound, points.max(axis=0))
+        num_points += len(points)
+        has_normals = normals is not None
+        has_colors = colors is not None
+
+    pcd = o3d.geometry.PointCloud()
+    if num_points == 0:
+        return pcd
+
+    columns = 3 + 3 * has_normals + 3 * has_colors
+    with VoxelTileAccumulator(min_bound, max_bound, voxel_size, num_points, columns,
+                              normal_columns=3 if has_normals else None,
+                              max_memory_mb=max_memory_mb, tmp_dir=tmp_dir) as accumulator:
+        # Segunda pasada: repartir los puntos en los mosaicos
+        for points, normals, colors in iter_point_blocks(path, block_points):
+            accumulator.add(np.hstack([array for array in (points, normals, colors) if array is not None]))
+
+        # Reducir cada mosaico por separado
+        result = np.vstack([means for means, _ in accumulator.reduce()])
+
+    pcd.points = o3d.utility.Vector3dVector(result[:, :3])
+    if has_normals:
+        pcd.normals = o3d.utility.Vector3dVector(result[:, 3:6])
+    if has_colors:
+        pcd.colors = o3d.utility.Vector3dVector(result[:, columns - 3:])
+    return pcd
@@ -0,0 +1,17 @@
+import os
+
+def resolve_num_workers(num_workers):
+    """
+    Traduce el número de procesos configurado a un valor concreto.
+
+    Parameters:
+        num_workers: int
+            Número de procesos solicitado (0 o None para usar todos los núcleos).
+
+    Returns:
+        num_workers: int
+            Número de procesos a utilizar (al menos 1).
+    """
+    if not num_workers:
+        return os.cpu_count() or 1
+    return max(1, int(num_workers))
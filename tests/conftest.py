@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Permite importar los módulos de src/ y de utils/ desde las pruebas
+for folder in ("src", "utils"):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", folder))
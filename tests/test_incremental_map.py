@@ -0,0 +1,96 @@
+import os
+import json
+import numpy as np
+import open3d as o3d
+import main
+from incremental_map import map_state_dir, pose_displacement
+
+def make_scene(seed=0):
+    """
+    Escena sintética: cajas sobre un piso, de 5 m de largo en x.
+    """
+    rng = np.random.default_rng(seed)
+    points = [rng.random((20000, 3)) * [5.0, 1.5, 0.0]]
+    for corner in rng.random((12, 3)) * [4.0, 1.0, 1.0]:
+        box = o3d.geometry.TriangleMesh.create_box(*(0.2 + rng.random(3) * 0.3))
+        box.translate(corner)
+        points.append(np.asarray(box.sample_points_uniformly(4000).points))
+    return np.vstack(points)
+
+def write_scan(scene, input_dir, index):
+    # Vistas superpuestas de 1.5 m, desplazadas 0.6 m
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(scene[(scene[:, 0] > index * 0.6) & (scene[:, 0] < index * 0.6 + 1.5)])
+    o3d.io.write_point_cloud(os.path.join(input_dir, f"cloud_{index}.pcd"), pcd)
+
+def transformed_nodes(state_dir, pose_graph, num_nodes):
+    points = []
+    for index in range(num_nodes):
+        node_points = np.load(os.path.join(state_dir, "nodes", str(index), "points.npy"))
+        pose = np.asarray(pose_graph.nodes[index].pose)
+        points.append(node_points @ pose[:3, :3].T + pose[:3, 3])
+    return np.vstack(points)
+
+def test_update_adds_scan_consistent_with_graph(tmp_path):
+    o3d.utility.random.seed(0)
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    scene = make_scene()
+    for index in range(4):
+        write_scan(scene, str(input_dir), index)
+
+    config_file = str(tmp_path / "config.json")
+    output_file = str(tmp_path / "map.pcd")
+    cache_dir = str(tmp_path / "cache")
+    with open(config_file, 'w') as f:
+        json.dump({
+            "input_path": str(input_dir),
+            "output_file": output_file,
+            "config_params": {
+                "voxel_size": 0.05,
+                "remove_outliers_params": {"nb_neighbors": 20, "std_ratio": 2.0},
+                "combinability_threshold": 0.5,
+                "cache_dir": cache_dir,
+                "num_workers": 1,
+                "show_result": False,
+                "incremental": True
+            }
+        }, f)
+
+    main.main(config_file)
+    write_scan(scene, str(input_dir), 4)
+    main.main(config_file)
+
+    state_dir = map_state_dir(cache_dir, config_file)
+    with open(os.path.join(state_dir, "state.json")) as f:
+        state = json.load(f)
+    assert len(state["files"]) == 5
+    assert state["nodes"][-1] == "cloud_4.pcd"
+
+    # El archivo de salida coincide con las nubes del mapa transformadas con el grafo guardado
+    pose_graph = o3d.io.read_pose_graph(os.path.join(state_dir, "pose_graph.json"))
+    assert len(pose_graph.nodes) == len(state["nodes"])
+    expected = transformed_nodes(state_dir, pose_graph, len(state["nodes"]))
+    written = o3d.io.read_point_cloud(output_file)
+    assert len(written.points) == len(expected)
+    expected_pcd = o3d.geometry.PointCloud()
+    expected_pcd.points = o3d.utility.Vector3dVector(expected)
+    assert np.max(written.compute_point_cloud_distance(expected_pcd)) < 1e-5
+    assert np.max(expected_pcd.compute_point_cloud_distance(written)) < 1e-5
+
+def test_pose_displacement_bounds_point_motion(tmp_path):
+    node_dir = tmp_path / "nodes" / "0"
+    node_dir.mkdir(parents=True)
+    points = np.random.default_rng(0).random((100, 3)) * 2.0
+    np.save(node_dir / "points.npy", points)
+
+    old_pose = np.identity(4)
+    assert pose_displacement(str(tmp_path), 0, old_pose, old_pose) == 0.0
+
+    new_pose = np.identity(4)
+    new_pose[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz([0.0, 0.0, 0.1])
+    new_pose[:3, 3] = [0.01, 0.0, 0.0]
+    moved = points @ new_pose[:3, :3].T + new_pose[:3, 3]
+    bound = pose_displacement(str(tmp_path), 0, old_pose, new_pose)
+    assert bound >= np.max(np.linalg.norm(moved - points, axis=1))
+    assert bound < 0.4
@@ -0,0 +1,38 @@
+import numpy as np
+import open3d as o3d
+import pytest
+from pc_candidates import compute_global_descriptor, select_candidate_pairs
+from prepared_cloud import PreparedCloud
+
+def make_cloud(offset, num_points=500, seed=0):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)) + offset)
+    return pcd
+
+def test_small_k_or_large_k_proposes_all_pairs():
+    pcds = [make_cloud([i, 0, 0], seed=i) for i in range(4)]
+    all_pairs = [(i, j) for i in range(4) for j in range(i + 1, 4)]
+    assert select_candidate_pairs(pcds, 0) == all_pairs
+    assert select_candidate_pairs(pcds, 3) == all_pairs
+
+def test_bbox_candidates_are_nearest_clouds():
+    # Nubes cada vez más lejanas y más grandes: cada una se parece solo a sus vecinas
+    pcds = []
+    for i in range(6):
+        pcd = make_cloud([0, 0, 0], seed=i).scale(1.0 + 0.5 * i, np.zeros(3))
+        pcds.append(pcd.translate([10.0 * i, 0, 0], relative=False))
+    pairs = select_candidate_pairs(pcds, 1, "bbox")
+    assert pairs == sorted(pairs)
+    assert all(j == i + 1 for i, j in pairs)
+    assert {index for pair in pairs for index in pair} == set(range(6))
+
+def test_fpfh_descriptor_matches_for_prepared_cloud():
+    pcd = make_cloud([0, 0, 0])
+    descriptor = compute_global_descriptor(pcd, "fpfh", 0.05)
+    prepared = compute_global_descriptor(PreparedCloud(pcd, 0.05, compute_features=True), "fpfh", 0.05)
+    assert descriptor.shape == prepared.shape == (33,)
+    # La nube original no recibe normales
+    assert not pcd.has_normals()
+    with pytest.raises(ValueError):
+        compute_global_descriptor(pcd, "unknown")
@@ -0,0 +1,59 @@
+import json
+import numpy as np
+import open3d as o3d
+from pc_reader import (read_pcd_header, is_mappable_pcd, read_point_cloud, estimate_cloud_bytes,
+                       read_point_clouds, load_point_clouds)
+
+def make_cloud(num_points=300, seed=0):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    normals = rng.standard_normal((num_points, 3))
+    pcd.normals = o3d.utility.Vector3dVector(normals / np.linalg.norm(normals, axis=1, keepdims=True))
+    pcd.colors = o3d.utility.Vector3dVector(rng.integers(0, 256, (num_points, 3)) / 255.0)
+    return pcd
+
+def assert_same_cloud(pcd, expected):
+    for name in ("points", "normals", "colors"):
+        assert np.allclose(np.asarray(getattr(pcd, name)), np.asarray(getattr(expected, name)), atol=1e-6)
+
+def test_binary_pcd_is_mapped_and_matches_open3d(tmp_path):
+    path = str(tmp_path / "cloud.pcd")
+    o3d.io.write_point_cloud(path, make_cloud())
+    header = read_pcd_header(path)
+    assert is_mappable_pcd(header)
+    assert int(header["POINTS"][0]) == 300
+
+    pcd = read_point_cloud(path)
+    assert_same_cloud(pcd, o3d.io.read_point_cloud(path))
+    # La nube leída es independiente del archivo proyectado
+    np.asarray(pcd.points)[0] = 10.0
+    assert_same_cloud(read_point_cloud(path), o3d.io.read_point_cloud(path))
+
+def test_ascii_and_compressed_pcd_fall_back_to_open3d(tmp_path):
+    for name, write_ascii, compressed in [("ascii.pcd", True, False), ("compressed.pcd", False, True)]:
+        path = str(tmp_path / name)
+        o3d.io.write_point_cloud(path, make_cloud(), write_ascii=write_ascii, compressed=compressed)
+        assert not is_mappable_pcd(read_pcd_header(path))
+        assert_same_cloud(read_point_cloud(path), o3d.io.read_point_cloud(path))
+
+def test_load_in_natural_order_and_skip_large_clouds(tmp_path):
+    input_path = tmp_path / "clouds"
+    input_path.mkdir()
+    for index, num_points in [(10, 300), (2, 300), (1, 20000)]:
+        o3d.io.write_point_cloud(str(input_path / f"cloud_{index}.pcd"), make_cloud(num_points, seed=index))
+    config_file = str(tmp_path / "config.json")
+    with open(config_file, 'w') as f:
+        json.dump({"input_path": str(input_path)}, f)
+
+    pcds, files = load_point_clouds(config_file, num_workers=2, return_files=True)
+    assert files == ["cloud_1.pcd", "cloud_2.pcd", "cloud_10.pcd"]
+    assert [len(pcd.points) for pcd in pcds] == [20000, 300, 300]
+
+    # La nube que supera el límite se devuelve por su ruta, sin leerla
+    large = str(input_path / "cloud_1.pcd")
+    assert estimate_cloud_bytes(large) == 20000 * 3 * 8
+    paths = [str(input_path / file) for file in files]
+    pcds = read_point_clouds(paths, num_workers=2, max_cloud_mb=0.1)
+    assert pcds[0] == large
+    assert [len(pcd.points) for pcd in pcds[1:]] == [300, 300]
@@ -0,0 +1,146 @@
+import json
+import numpy as np
+import open3d as o3d
+import pytest
+from pc_reader import read_pcd_header, pcd_dtype
+from pc_writer import StreamingPCDWriter, OctreeTileWriter, write_combined_pcd, transformed_bounds
+
+def make_cloud(num_points=300, seed=0):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    normals = rng.standard_normal((num_points, 3))
+    pcd.normals = o3d.utility.Vector3dVector(normals / np.linalg.norm(normals, axis=1, keepdims=True))
+    pcd.colors = o3d.utility.Vector3dVector(rng.integers(0, 256, (num_points, 3)) / 255.0)
+    return pcd
+
+def make_pose_graph(num_nodes, seed=0):
+    rng = np.random.default_rng(seed)
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for _ in range(num_nodes):
+        pose = np.identity(4)
+        pose[:3, :3] = o3d.geometry.get_rotation_matrix_from_xyz(rng.random(3))
+        pose[:3, 3] = rng.random(3)
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+    return pose_graph
+
+def write_config(tmp_path, output_file):
+    config_file = str(tmp_path / "config.json")
+    with open(config_file, 'w') as f:
+        json.dump({"output_file": output_file}, f)
+    return config_file
+
+def test_streaming_writer_round_trip_and_append(tmp_path):
+    output_file = str(tmp_path / "out.pcd")
+    first, second = make_cloud(seed=0), make_cloud(seed=1)
+    with StreamingPCDWriter(output_file, with_normals=True, with_colors=True) as writer:
+        writer.append(np.asarray(first.points), np.asarray(first.normals), np.asarray(first.colors))
+    with StreamingPCDWriter(output_file, with_normals=True, with_colors=True, append=True) as writer:
+        writer.append(np.asarray(second.points), np.asarray(second.normals), np.asarray(second.colors))
+    assert writer.num_points == 600
+
+    written = o3d.io.read_point_cloud(output_file)
+    for name in ("points", "normals", "colors"):
+        expected = np.vstack([np.asarray(getattr(first, name)), np.asarray(getattr(second, name))])
+        np.testing.assert_allclose(np.asarray(getattr(written, name)), expected, atol=1e-6)
+
+def test_append_rejects_incompatible_file(tmp_path):
+    output_file = str(tmp_path / "out.pcd")
+    o3d.io.write_point_cloud(output_file, make_cloud(), write_ascii=True)
+    with pytest.raises(ValueError):
+        StreamingPCDWriter(output_file, with_normals=True, with_colors=True, append=True)
+
+@pytest.mark.parametrize("output_format", ["binary", "binary_compressed"])
+def test_write_combined_pcd_matches_transformed_clouds(tmp_path, output_format):
+    output_file = str(tmp_path / "combined.pcd")
+    pcds = [make_cloud(seed=seed) for seed in range(3)]
+    pose_graph = make_pose_graph(len(pcds))
+    write_combined_pcd(pcds, pose_graph, write_config(tmp_path, output_file),
+                       output_format=output_format, visualize=False)
+
+    expected = o3d.geometry.PointCloud()
+    for pcd, node in zip(pcds, pose_graph.nodes):
+        expected += o3d.geometry.PointCloud(pcd).transform(node.pose)
+    written = o3d.io.read_point_cloud(output_file)
+    np.testing.assert_allclose(np.asarray(written.points), np.asarray(expected.points), atol=1e-5)
+    np.testing.assert_allclose(np.asarray(written.normals), np.asarray(expected.normals), atol=1e-5)
+    # Las nubes de entrada no se modifican
+    np.testing.assert_array_equal(np.asarray(pcds[0].points), np.asarray(make_cloud(seed=0).points))
+
+def test_write_combined_pcd_rejects_unknown_format(tmp_path):
+    output_file = str(tmp_path / "combined.pcd")
+    with pytest.raises(ValueError):
+        write_combined_pcd([make_cloud()], make_pose_graph(1), write_config(tmp_path, output_file),
+                           output_format="ascii", visualize=False)
+
+def sorted_points(points):
+    points = np.asarray(points)
+    return points[np.lexsort(points.T[::-1])]
+
+def test_octree_tiles_partition_the_combined_cloud(tmp_path):
+    output_file = str(tmp_path / "combined.pcd")
+    pcds = [make_cloud(num_points=2000, seed=seed) for seed in range(3)]
+    config_file = write_config(tmp_path, output_file)
+    lod_params = {"enabled": True, "max_level": 2, "resolution": 4}
+    write_combined_pcd(pcds, make_pose_graph(len(pcds)), config_file, visualize=False, lod_params=lod_params)
+
+    lod_dir = tmp_path / "combined_lod"
+    with open(lod_dir / "index.json", 'r') as f:
+        index = json.load(f)
+    tiles = []
+    for node in index["nodes"]:
+        tile = o3d.io.read_point_cloud(str(lod_dir / node["file"]))
+        points = np.asarray(tile.points)
+        assert len(points) == node["points"]
+        low, high = np.array(node["bounds"][0]), np.array(node["bounds"][1])
+        assert np.all(points >= low - 1e-5) and np.all(points <= high + 1e-5)
+        if node["level"] < index["max_level"]:
+            # Los niveles intermedios tienen a lo sumo un punto por celda de muestreo
+            assert len(points) <= index["resolution"] ** 3
+        tiles.append(points)
+
+    # Todos los niveles juntos contienen exactamente los puntos de la nube combinada
+    written = np.asarray(o3d.io.read_point_cloud(output_file).points)
+    np.testing.assert_array_equal(sorted_points(np.vstack(tiles)), sorted_points(written))
+
+    # Una nueva escritura reemplaza el conjunto anterior
+    write_combined_pcd(pcds[:1], make_pose_graph(1), config_file, visualize=False, lod_params=lod_params)
+    with open(lod_dir / "index.json", 'r') as f:
+        nodes = json.load(f)["nodes"]
+    assert sum(node["points"] for node in nodes) == 2000
+    assert sorted(path.name for path in lod_dir.glob("*.pcd")) == sorted(node["file"] for node in nodes)
+
+def test_octree_writer_refuses_foreign_directory(tmp_path):
+    (tmp_path / "other.txt").write_text("")
+    with pytest.raises(ValueError):
+        OctreeTileWriter(str(tmp_path), np.zeros(3), np.ones(3))
+
+@pytest.mark.parametrize("output_format", ["binary", "binary_compressed"])
+def test_merge_combines_overlapping_points(tmp_path, output_format):
+    output_file = str(tmp_path / "combined.pcd")
+    pcds = [make_cloud(num_points=2000, seed=0), make_cloud(num_points=2000, seed=1)]
+    pose_graph = make_pose_graph(2)
+    merge_params = {"enabled": True, "voxel_size": 0.1, "counts": True, "max_memory_mb": 512}
+    write_combined_pcd(pcds, pose_graph, write_config(tmp_path, output_file),
+                       output_format=output_format, visualize=False, merge_params=merge_params)
+
+    # Promedio por voxel de la grilla que parte de los límites de las nubes transformadas
+    poses = [node.pose for node in pose_graph.nodes]
+    points = np.vstack([np.asarray(pcd.points) @ pose[:3, :3].T + pose[:3, 3] for pcd, pose in zip(pcds, poses)])
+    origin = transformed_bounds(pcds, poses)[0] - 0.05
+    _, inverse, counts = np.unique(np.floor((points - origin) / 0.1).astype(np.int64), axis=0,
+                                   return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    means = np.stack([np.bincount(inverse, points[:, axis]) for axis in range(3)], axis=1) / counts[:, None]
+
+    written = o3d.io.read_point_cloud(output_file)
+    np.testing.assert_allclose(sorted_points(written.points), sorted_points(means), atol=1e-5)
+
+    header = read_pcd_header(output_file)
+    if output_format == "binary":
+        # Cada voxel guarda cuántos puntos combinó
+        data = np.fromfile(output_file, dtype=pcd_dtype(header), offset=header["offset"])
+        assert sorted(data["count"]) == sorted(counts)
+        assert data["count"].sum() == 4000
+    else:
+        assert "count" not in header["FIELDS"]
@@ -0,0 +1,43 @@
+import os
+import numpy as np
+import open3d as o3d
+import pytest
+from ply2pcd import convert_folder
+
+def make_cloud(num_points=300, seed=0):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    pcd.colors = o3d.utility.Vector3dVector(rng.integers(0, 256, (num_points, 3)) / 255.0)
+    return pcd
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_convert_folder_is_incremental(tmp_path, num_workers):
+    input_folder, output_folder = tmp_path / "ply", tmp_path / "pcd"
+    input_folder.mkdir()
+    for seed in range(3):
+        o3d.io.write_point_cloud(str(input_folder / f"cloud_{seed}.ply"), make_cloud(seed=seed))
+
+    assert convert_folder(str(input_folder), str(output_folder), num_workers=num_workers) == 3
+    for seed in range(3):
+        written = o3d.io.read_point_cloud(str(output_folder / f"cloud_{seed}.pcd"))
+        np.testing.assert_allclose(np.asarray(written.points), np.asarray(make_cloud(seed=seed).points),
+                                   atol=1e-6)
+    assert not [name for name in os.listdir(output_folder) if name.startswith(".ply2pcd-")]
+
+    # Las salidas actualizadas no se vuelven a convertir
+    assert convert_folder(str(input_folder), str(output_folder), num_workers=num_workers) == 0
+
+    # Una entrada más reciente con el mismo contenido se reconoce por su hash
+    input_file = str(input_folder / "cloud_0.ply")
+    output_time = os.path.getmtime(output_folder / "cloud_0.pcd")
+    os.utime(input_file, (output_time + 10, output_time + 10))
+    assert convert_folder(str(input_folder), str(output_folder), num_workers=num_workers) == 0
+
+    # Una entrada con otro contenido se convierte otra vez
+    o3d.io.write_point_cloud(input_file, make_cloud(seed=7))
+    os.utime(input_file, (output_time + 20, output_time + 20))
+    assert convert_folder(str(input_folder), str(output_folder), num_workers=num_workers) == 1
+    written = o3d.io.read_point_cloud(str(output_folder / "cloud_0.pcd"))
+    np.testing.assert_allclose(np.asarray(written.points), np.asarray(make_cloud(seed=7).points), atol=1e-6)
+    assert convert_folder(str(input_folder), str(output_folder), num_workers=num_workers, force=True) == 3
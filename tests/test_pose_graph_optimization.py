@@ -0,0 +1,67 @@
+import numpy as np
+import open3d as o3d
+from pose_graph_optimization import sparsify_pose_graph, optimize_pose_graph
+
+def make_edge(source_id, target_id, uncertain, correspondences=1000, offset=None):
+    transformation = np.identity(4)
+    if offset is not None:
+        transformation[:3, 3] = offset
+    information = np.identity(6) * correspondences
+    return o3d.pipelines.registration.PoseGraphEdge(source_id, target_id, transformation,
+                                                    information, uncertain)
+
+def make_chain(num_nodes, loop_closures):
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for _ in range(num_nodes):
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(np.identity(4)))
+    fitness = []
+    for i in range(num_nodes - 1):
+        pose_graph.edges.append(make_edge(i, i + 1, False))
+        fitness.append(0.9)
+    for source_id, target_id, edge_fitness, correspondences in loop_closures:
+        pose_graph.edges.append(make_edge(source_id, target_id, True, correspondences))
+        fitness.append(edge_fitness)
+    return pose_graph, fitness
+
+def edge_ids(pose_graph):
+    return [(edge.source_node_id, edge.target_node_id, edge.uncertain) for edge in pose_graph.edges]
+
+def test_sparsify_keeps_odometry_and_best_loop_closures():
+    pose_graph, fitness = make_chain(5, [
+        (0, 2, 0.8, 1000),
+        (0, 3, 0.9, 1000),
+        (0, 4, 0.7, 1000),
+        (1, 3, 0.2, 1000),  # fitness insuficiente
+        (1, 4, 0.9, 10),    # pocas correspondencias
+        (2, 4, 0.6, 1000)
+    ])
+    sparsify_pose_graph(pose_graph, fitness, min_fitness=0.3, min_correspondences=100, max_loop_closures=2)
+
+    # El nodo 0 admite solo sus dos mejores cierres de bucle; el orden original se conserva
+    assert edge_ids(pose_graph) == [(0, 1, False), (1, 2, False), (2, 3, False), (3, 4, False),
+                                    (0, 2, True), (0, 3, True), (2, 4, True)]
+
+def test_parallel_component_optimization_matches_serial():
+    def make_components():
+        pose_graph = o3d.pipelines.registration.PoseGraph()
+        rng = np.random.default_rng(0)
+        for _ in range(6):
+            pose = np.identity(4)
+            pose[:3, 3] = rng.random(3) * 0.1
+            pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+        # Dos componentes: 0-1-2 y 3-4-5, cada uno con un cierre de bucle
+        for source_id, target_id, uncertain in [(0, 1, False), (1, 2, False), (0, 2, True),
+                                                (3, 4, False), (4, 5, False), (3, 5, True)]:
+            pose_graph.edges.append(make_edge(source_id, target_id, uncertain,
+                                              offset=[0.05 * (target_id - source_id), 0, 0]))
+        return pose_graph
+
+    serial = optimize_pose_graph(make_components(), 0.03, num_workers=1)
+    parallel = optimize_pose_graph(make_components(), 0.03, num_workers=2)
+
+    for serial_node, parallel_node in zip(serial.nodes, parallel.nodes):
+        assert np.allclose(serial_node.pose, parallel_node.pose)
+    # El primer nodo de cada componente es su referencia y no se mueve
+    initial = make_components()
+    for node in (0, 3):
+        assert np.allclose(serial.nodes[node].pose, initial.nodes[node].pose)
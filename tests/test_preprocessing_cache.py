@@ -0,0 +1,46 @@
+import numpy as np
+import open3d as o3d
+from preprocessing_cache import PreprocessingCache
+from pc_preprocessing import pc_preprocessing
+
+def make_cloud(num_points=200, seed=0):
+    rng = np.random.default_rng(seed)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    pcd.normals = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    pcd.colors = o3d.utility.Vector3dVector(rng.random((num_points, 3)))
+    return pcd
+
+def test_put_get_round_trip(tmp_path):
+    cache = PreprocessingCache(str(tmp_path))
+    pcd = make_cloud()
+    key = cache.make_key(pcd, 0.05, None)
+    assert cache.get(key) is None
+    cache.put(key, pcd)
+
+    cached = cache.get(key)
+    assert cached is not None
+    for name in ("points", "normals", "colors"):
+        np.testing.assert_array_equal(np.asarray(getattr(cached, name)), np.asarray(getattr(pcd, name)))
+    # La nube devuelta debe poder modificarse como cualquier otra
+    cached.paint_uniform_color([1.0, 0.0, 0.0])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_key_uses_source_file_not_colors(tmp_path):
+    pcd = make_cloud()
+    path = str(tmp_path / "cloud.pcd")
+    o3d.io.write_point_cloud(path, pcd)
+
+    key = PreprocessingCache.make_key(pcd, 0.05, None, source=path)
+    pcd.paint_uniform_color([0.0, 1.0, 0.0])
+    assert PreprocessingCache.make_key(pcd, 0.05, None, source=path) == key
+    assert PreprocessingCache.make_key(pcd, 0.1, None, source=path) != key
+
+def test_pc_preprocessing_reuses_cache(tmp_path):
+    cache = PreprocessingCache(str(tmp_path / "cache"))
+    pcds = [make_cloud(seed=seed) for seed in range(3)]
+    first = pc_preprocessing(pcds, 0.2, cache=cache)
+    second = pc_preprocessing(pcds, 0.2, cache=cache)
+    assert cache.hits == 3
+    for a, b in zip(first, second):
+        np.testing.assert_allclose(np.asarray(a.points), np.asarray(b.points))
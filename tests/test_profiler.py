@@ -0,0 +1,58 @@
+import json
+import numpy as np
+import open3d as o3d
+import pytest
+import profiler
+from pc_stacking import compute_pairwise_registration, resolve_registration_params
+
+@pytest.fixture
+def active_profiler(tmp_path, monkeypatch):
+    # Perfilador sin registro en atexit, para no escribir trazas al terminar las pruebas
+    active = profiler.Profiler(str(tmp_path / "trace.json"))
+    monkeypatch.setattr(profiler, "_profiler", active)
+    return active
+
+def make_surface(num_points=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.random((num_points, 2))
+    points = np.column_stack([xy, 0.1 * np.sin(6 * xy[:, 0]) * np.cos(6 * xy[:, 1])])
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    return pcd
+
+def test_stage_peak_is_measured_per_stage(active_profiler):
+    if not active_profiler.track_peaks:
+        pytest.skip("El pico por etapa requiere /proc/self/clear_refs")
+    with profiler.profile_stage("outer"):
+        with profiler.profile_stage("heavy"):
+            heavy = np.ones(32 * 1024 ** 2)  # 256 MB
+            del heavy
+        with profiler.profile_stage("light"):
+            light = np.ones(1024)
+            del light
+    stages = {stage["name"]: stage for stage in active_profiler.stages}
+
+    assert stages["heavy"]["peak_rss"] - stages["light"]["peak_rss"] > 200 * 1024 ** 2
+    # La etapa externa contiene el pico de sus etapas internas
+    assert stages["outer"]["peak_rss"] >= stages["heavy"]["peak_rss"]
+    # El pico acumulado del proceso no baja después de la etapa más pesada
+    assert stages["light"]["process_peak_rss"] >= stages["heavy"]["process_peak_rss"]
+
+def test_two_pass_pair_records_iterations(active_profiler):
+    source, target = make_surface(seed=0), make_surface(seed=1)
+    registration_params = resolve_registration_params(None, 0.02)
+    assert registration_params["track_iterations"]
+
+    result = compute_pairwise_registration(source, target, 0.3, 0.03, registration_params)
+    profiler.record_pair(0, 1, result, 0.1)
+    active_profiler.write()
+
+    assert [level["iterations"] is not None for level in result["levels"]] == [True, True]
+    with open(active_profiler.output_file, 'r') as f:
+        pair = json.load(f)["pairs"][0]
+    assert pair["iterations"] == sum(level["iterations"] for level in result["levels"])
+    assert pair["iterations"] > 0
+
+def test_iterations_are_not_tracked_without_profiling():
+    registration_params = resolve_registration_params(None, 0.02)
+    assert "track_iterations" not in registration_params
@@ -0,0 +1,69 @@
+import numpy as np
+import open3d as o3d
+from registration_cache import RegistrationCache, cloud_hash
+from pc_stacking import pairwise_registration, registration_key
+
+def make_surface(num_points=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.random((num_points, 2))
+    points = np.column_stack([xy, 0.1 * np.sin(6 * xy[:, 0]) * np.cos(6 * xy[:, 1])])
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(points)
+    return pcd
+
+def make_result(seed=0, gated=False):
+    rng = np.random.default_rng(seed)
+    transformation = np.identity(4)
+    transformation[:3, 3] = rng.random(3)
+    return {
+        "transformation": transformation,
+        "information": rng.random((6, 6)),
+        "fitness": 0.75,
+        "inlier_rmse": 0.01,
+        "gated": gated
+    }
+
+def test_put_get_round_trip_from_disk(tmp_path):
+    key = RegistrationCache.make_key("a", "b", 0.3, 0.03, "point_to_plane")
+    result = make_result(gated=True)
+    RegistrationCache(str(tmp_path)).put(key, result)
+
+    # Un almacén nuevo sobre la misma carpeta solo puede leer el resultado desde el disco
+    cache = RegistrationCache(str(tmp_path))
+    cached = cache.get(key)
+    assert np.array_equal(cached["transformation"], result["transformation"])
+    assert np.array_equal(cached["information"], result["information"])
+    assert cached["fitness"] == result["fitness"]
+    assert cached["inlier_rmse"] == result["inlier_rmse"]
+    assert cached["gated"] is True
+    assert cache.get(RegistrationCache.make_key("b", "a", 0.3, 0.03, "point_to_plane")) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_key_depends_on_clouds_and_parameters():
+    cache = RegistrationCache()
+    source, target = make_surface(seed=0), make_surface(seed=1)
+    key = registration_key(cache, cloud_hash(source), cloud_hash(target), 0.3, 0.03)
+
+    # Los parámetros por defecto conservan la llave sin parámetros
+    assert registration_key(cache, cloud_hash(source), cloud_hash(target), 0.3, 0.03,
+                            {"mode": "two_pass", "track_iterations": False}) == key
+    assert registration_key(cache, cloud_hash(target), cloud_hash(source), 0.3, 0.03) != key
+    assert registration_key(cache, cloud_hash(source), cloud_hash(target), 0.3, 0.02) != key
+    assert registration_key(cache, cloud_hash(source), cloud_hash(target), 0.3, 0.03,
+                            {"mode": "multiscale"}) != key
+
+def test_pairwise_registration_reuses_cached_result(tmp_path, monkeypatch):
+    source, target = make_surface(seed=0), make_surface(seed=1)
+    first = pairwise_registration(source, target, 0.3, 0.03, cache=RegistrationCache(str(tmp_path)))
+
+    # Una nueva ejecución con las mismas nubes no vuelve a aplicar ICP
+    def fail(*args, **kwargs):
+        raise AssertionError("El par debió leerse del almacén.")
+    monkeypatch.setattr(o3d.pipelines.registration, "registration_icp", fail)
+    cache = RegistrationCache(str(tmp_path))
+    second = pairwise_registration(source, target, 0.3, 0.03, cache=cache)
+
+    assert cache.hits == 1
+    for expected, cached in zip(first, second):
+        assert np.allclose(expected, cached)
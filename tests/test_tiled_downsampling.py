@@ -0,0 +1,84 @@
+import numpy as np
+import open3d as o3d
+import tiled_downsampling
+from tiled_downsampling import VoxelTileAccumulator, tiled_voxel_down_sample
+
+def sorted_rows(array):
+    return array[np.lexsort(array.T[::-1])]
+
+def reference_reduce(records, min_bound, voxel_size):
+    """
+    Promedio por voxel calculado en memoria, con la grilla de Open3D.
+    """
+    voxel_index = np.floor((records[:, :3] - (min_bound - voxel_size * 0.5)) / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(voxel_index, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    sums = np.column_stack([np.bincount(inverse, weights=records[:, c]) for c in range(records.shape[1])])
+    return sums / counts[:, np.newaxis], counts
+
+def skewed_points(seed=0):
+    # El 95 % de los puntos cae en un cubo de 1 cm dentro de una nube de 10 m
+    rng = np.random.default_rng(seed)
+    return np.vstack([rng.random((2000, 3)) * 10.0, 5.0 + rng.random((38000, 3)) * 0.01])
+
+def test_reduce_matches_in_memory_reference():
+    records = np.random.default_rng(1).random((5000, 3)) * 4.0
+    min_bound, max_bound = records.min(axis=0), records.max(axis=0)
+    with VoxelTileAccumulator(min_bound, max_bound, 0.1, len(records), 3, max_memory_mb=0.01) as accumulator:
+        accumulator.add(records[:2500])
+        accumulator.add(records[2500:])
+        blocks = list(accumulator.reduce())
+    assert len(blocks) > 1
+    means = np.vstack([means for means, _ in blocks])
+    counts = np.concatenate([counts for _, counts in blocks])
+    expected_means, expected_counts = reference_reduce(records, min_bound, 0.1)
+    np.testing.assert_allclose(sorted_rows(means), sorted_rows(expected_means))
+    assert counts.sum() == len(records)
+    np.testing.assert_array_equal(np.sort(counts), np.sort(expected_counts))
+
+def test_skewed_cloud_stays_within_memory(monkeypatch):
+    records = skewed_points()
+    min_bound, max_bound = records.min(axis=0), records.max(axis=0)
+    max_memory_mb = 0.05
+    accumulator = VoxelTileAccumulator(min_bound, max_bound, 0.001, len(records), 3, max_memory_mb=max_memory_mb)
+
+    # Se registra el arreglo más grande leído de los mosaicos
+    largest = []
+    fromfile = np.fromfile
+    def tracked_fromfile(*args, **kwargs):
+        array = fromfile(*args, **kwargs)
+        largest.append(len(array))
+        return array
+    monkeypatch.setattr(tiled_downsampling.np, "fromfile", tracked_fromfile)
+
+    with accumulator:
+        accumulator.add(records)
+        means = np.vstack([means for means, _ in accumulator.reduce()])
+    assert max(largest) <= accumulator.tile_points * 3
+    expected_means, _ = reference_reduce(records, min_bound, 0.001)
+    np.testing.assert_allclose(sorted_rows(means), sorted_rows(expected_means))
+
+def test_single_dense_voxel_is_reduced_in_chunks():
+    records = np.full((20000, 3), 0.5) + np.random.default_rng(2).random((20000, 3)) * 1e-4
+    records = np.vstack([records, [[0.0, 0.0, 0.0], [1.0, 1.0, 1.0]]])
+    with VoxelTileAccumulator(records.min(axis=0), records.max(axis=0), 0.1, len(records), 3,
+                              max_memory_mb=0.01) as accumulator:
+        accumulator.add(records)
+        blocks = list(accumulator.reduce())
+    counts = np.concatenate([counts for _, counts in blocks])
+    assert sorted(counts) == [1, 1, 20000]
+
+def test_tiled_voxel_down_sample_matches_open3d(tmp_path):
+    rng = np.random.default_rng(3)
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(skewed_points())
+    pcd.colors = o3d.utility.Vector3dVector(rng.random((len(pcd.points), 3)))
+    path = str(tmp_path / "cloud.pcd")
+    o3d.io.write_point_cloud(path, pcd)
+    pcd = o3d.io.read_point_cloud(path)
+
+    tiled = tiled_voxel_down_sample(path, 0.002, max_memory_mb=0.05)
+    expected = pcd.voxel_down_sample(0.002)
+    assert len(tiled.points) == len(expected.points)
+    np.testing.assert_allclose(sorted_rows(np.hstack([tiled.points, tiled.colors])),
+                               sorted_rows(np.hstack([expected.points, expected.colors])), atol=1e-6)
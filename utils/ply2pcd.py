@@ -1,26 +1,174 @@
 import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import open3d as o3d
 
-def ply_to_pcd(input_file, output_file):
+# Permite reutilizar la resolución del número de procesos de src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from workers import resolve_num_workers
+
+# Archivo de la carpeta de salida con el hash de cada archivo .ply ya convertido
+MANIFEST_FILE = ".ply2pcd.json"
+
+def file_hash(path):
+    """
+    Calcula el hash SHA-1 del contenido de un archivo, leyéndolo por bloques.
+    """
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 24), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def ply_to_pcd(input_file, output_file, compressed=False):
+    """
+    Convierte un archivo .ply en un archivo .pcd binario.
+
+    Parámetros:
+        input_file (str): Ruta del archivo .ply.
+        output_file (str): Ruta del archivo .pcd de salida.
+        compressed (bool): Si es True, se guarda en formato binary_compressed.
+
+    Devuelve:
+        int: Cantidad de puntos convertidos.
+    """
     # Cargar el archivo PLY
     pcd = o3d.io.read_point_cloud(input_file)
-    
-    # Guardar como archivo PCD
-    o3d.io.write_point_cloud(output_file, pcd)
-    print(f"El archivo PCD se ha guardado en: {output_file}")
 
-if __name__ == "__main__":
-    # Ruta de la carpeta de entrada y salida
-    input_folder = "../data/7-scenes-redkitchen"
-    output_folder = "../data/7-scenes-redkitchen"
+    # Guardar como archivo PCD en una carpeta temporal, para no dejar salidas a medio escribir
+    tmp_dir = tempfile.mkdtemp(prefix=".ply2pcd-", dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        tmp_file = os.path.join(tmp_dir, os.path.basename(output_file))
+        o3d.io.write_point_cloud(tmp_file, pcd, write_ascii=False, compressed=compressed)
+        os.replace(tmp_file, output_file)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return len(pcd.points)
+
+def _convert_job(input_file, output_file, compressed):
+    """
+    Convierte un archivo dentro de un proceso trabajador y mide su rendimiento.
+    """
+    start = time.perf_counter()
+    digest = file_hash(input_file)
+    num_points = ply_to_pcd(input_file, output_file, compressed)
+    return digest, num_points, time.perf_counter() - start
+
+def is_up_to_date(input_file, output_file, stored_hash):
+    """
+    Indica si la salida de un archivo ya está actualizada.
+
+    La salida está actualizada si es más reciente que la entrada o, si no lo
+    es (por ejemplo, tras copiar la carpeta), si el hash guardado coincide
+    con el contenido actual de la entrada.
+
+    Parámetros:
+        input_file (str): Ruta del archivo .ply.
+        output_file (str): Ruta del archivo .pcd.
+        stored_hash (str): Hash de la entrada en la última conversión, o None.
+
+    Devuelve:
+        bool: True si no hace falta volver a convertir el archivo.
+    """
+    if not os.path.exists(output_file):
+        return False
+    if os.path.getmtime(output_file) >= os.path.getmtime(input_file):
+        return True
+    return stored_hash is not None and stored_hash == file_hash(input_file)
+
+def convert_folder(input_folder, output_folder, num_workers=0, compressed=False, force=False):
+    """
+    Convierte todos los archivos .ply de una carpeta a .pcd, en paralelo y de forma incremental.
 
+    Parámetros:
+        input_folder (str): Carpeta con los archivos .ply.
+        output_folder (str): Carpeta de salida de los archivos .pcd.
+        num_workers (int): Número de procesos (0 para usar todos los núcleos, 1 para convertir en serie).
+        compressed (bool): Si es True, los .pcd se guardan en formato binary_compressed.
+        force (bool): Si es True, se convierten todos los archivos aunque estén actualizados.
+
+    Devuelve:
+        int: Cantidad de archivos convertidos.
+    """
     # Crear la carpeta de salida si no existe
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    # Listar todos los archivos en la carpeta de entrada
-    for file_name in os.listdir(input_folder):
-        if file_name.endswith(".ply"):
-            input_file = os.path.join(input_folder, file_name)
-            output_file = os.path.join(output_folder, file_name[:-4] + ".pcd")  # Cambiar la extensión a .pcd
-            ply_to_pcd(input_file, output_file)
+    os.makedirs(output_folder, exist_ok=True)
+
+    manifest_path = os.path.join(output_folder, MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    # Listar los archivos de la carpeta de entrada que necesitan conversión
+    jobs = []
+    skipped = 0
+    for file_name in sorted(os.listdir(input_folder)):
+        if not file_name.endswith(".ply"):
+            continue
+        input_file = os.path.join(input_folder, file_name)
+        output_file = os.path.join(output_folder, file_name[:-4] + ".pcd")  # Cambiar la extensión a .pcd
+        if not force and is_up_to_date(input_file, output_file, manifest.get(file_name)):
+            skipped += 1
+            continue
+        jobs.append((file_name, input_file, output_file))
+    print(f"{len(jobs)} archivos por convertir, {skipped} ya actualizados.")
+
+    start = time.perf_counter()
+    total_bytes = 0
+
+    def report(file_name, input_file, digest, num_points, elapsed):
+        nonlocal total_bytes
+        manifest[file_name] = digest
+        size = os.path.getsize(input_file)
+        total_bytes += size
+        size_mb = size / 1024 ** 2
+        print(f"{file_name}: {num_points} puntos, {size_mb:.1f} MB en {elapsed:.2f} s "
+              f"({size_mb / max(elapsed, 1e-9):.1f} MB/s).")
+
+    workers = resolve_num_workers(num_workers)
+    try:
+        if workers <= 1 or len(jobs) <= 1:
+            for file_name, input_file, output_file in jobs:
+                report(file_name, input_file, *_convert_job(input_file, output_file, compressed))
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+                futures = {executor.submit(_convert_job, input_file, output_file, compressed):
+                           (file_name, input_file) for file_name, input_file, output_file in jobs}
+                for future in as_completed(futures):
+                    report(*futures[future], *future.result())
+    finally:
+        # Guardar los hashes de los archivos convertidos, aunque la conversión se haya interrumpido
+        with open(manifest_path + ".tmp", 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    elapsed = time.perf_counter() - start
+    if jobs:
+        total_mb = total_bytes / 1024 ** 2
+        print(f"Se convirtieron {len(jobs)} archivos ({total_mb:.1f} MB) en {elapsed:.2f} s "
+              f"({total_mb / max(elapsed, 1e-9):.1f} MB/s).")
+    return len(jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convierte los archivos .ply de una carpeta a .pcd binario.")
+    parser.add_argument("input_folder", nargs="?", default="../data/7-scenes-redkitchen",
+                        help="Carpeta con los archivos .ply.")
+    parser.add_argument("output_folder", nargs="?",
+                        help="Carpeta de salida de los archivos .pcd (la de entrada por defecto).")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Número de procesos (0 para usar todos los núcleos).")
+    parser.add_argument("--compressed", action="store_true", help="Guardar en formato binary_compressed.")
+    parser.add_argument("--force", action="store_true", help="Convertir todos los archivos aunque estén actualizados.")
+    args = parser.parse_args()
+
+    convert_folder(args.input_folder, args.output_folder or args.input_folder,
+                   num_workers=args.workers, compressed=args.compressed, force=args.force)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 import open3d as o3d
 import numpy as np
 import os
+import sys
+
+# Permite reutilizar el almacén de resultados de registro de src/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from registration_cache import RegistrationCache, cloud_hash
 
 def load_point_clouds(folder_path, voxel_size=0.0):
     pcds = []
@@ -15,24 +20,45 @@ def load_point_clouds(folder_path, voxel_size=0.0):
     
     return pcds
 
-def calculate_pairwise_transformations(pcds):
+def calculate_pairwise_transformations(pcds, cache=None):
     pairs = []
     transformations = []
+    hashes = [cloud_hash(pcd) for pcd in pcds] if cache is not None else None
     
     for i in range(len(pcds)):
         for j in range(i + 1, len(pcds)):
             source_pcd = pcds[i]
             target_pcd = pcds[j]
             threshold = 0.02  # Umbral para ICP
-            
-            # Registro ICP para calcular la transformación entre las nubes de puntos
-            result = o3d.pipelines.registration.registration_icp(
-                source_pcd, target_pcd, threshold, np.identity(4),
-                o3d.pipelines.registration.TransformationEstimationPointToPoint())
+
+            # Reutilizar la transformación si el par ya se registró
+            cached = None
+            if cache is not None:
+                key = cache.make_key(hashes[i], hashes[j], threshold, "point_to_point")
+                cached = cache.get(key)
+
+            if cached is not None:
+                transformation = cached["transformation"]
+            else:
+                # Registro ICP para calcular la transformación entre las nubes de puntos
+                result = o3d.pipelines.registration.registration_icp(
+                    source_pcd, target_pcd, threshold, np.identity(4),
+                    o3d.pipelines.registration.TransformationEstimationPointToPoint())
+                transformation = result.transformation
+
+                if cache is not None:
+                    information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+                        source_pcd, target_pcd, threshold, transformation)
+                    cache.put(key, {
+                        "transformation": transformation,
+                        "information": information,
+                        "fitness": result.fitness,
+                        "inlier_rmse": result.inlier_rmse
+                    })
             
             # Añadir el par y la transformación correspondiente a la lista
             pairs.append((source_pcd, target_pcd))
-            transformations.append(result.transformation)
+            transformations.append(transformation)
     
     return pairs, transformations
 
@@ -41,7 +67,8 @@ folder_path = "../data/"
 pcds = load_point_clouds(folder_path)
 
 # Calcular los pares de nubes de puntos con sus transformaciones correspondientes
-pcd_pairs, transformations = calculate_pairwise_transformations(pcds)
+registration_cache = RegistrationCache("../cache/registration")
+pcd_pairs, transformations = calculate_pairwise_transformations(pcds, cache=registration_cache)
 
 # Imprimir los pares y sus transformaciones
 for i, (pair, transformation) in enumerate(zip(pcd_pairs, transformations)):